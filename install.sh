@@ -18,10 +18,17 @@ TARGET="$HOME/.local/bin"
 # Create target directory
 mkdir -p "$TARGET"
 
-# Create launcher
+# Precompile so the launcher loads cached bytecode instead of compiling
+# playbook.py on every run
+python3 -m compileall -q "$ROOT_DIR/playbook.py"
+
+# Create launcher (imports playbook as a module so __pycache__ is used;
+# running playbook.py as a script would recompile it each time). With -c,
+# sys.path[0] is the current directory; replacing it keeps modules there
+# from shadowing the stdlib.
 cat > "$TARGET/playbook" <<EOF
 #!/usr/bin/env bash
-exec "$ROOT_DIR/playbook.py" "\$@"
+exec python3 -c 'import sys; sys.path[0] = sys.argv.pop(1); import playbook; playbook.main()' "$ROOT_DIR" "\$@"
 EOF
 
 # Make executable
@@ -4,12 +4,14 @@
 # Turn messy inputs like diffs, contracts, and notes into consistent prompts
 # ============================================================================
 
-import argparse
+import contextlib
+import functools
 import json
 import os
 import re
-import subprocess
 import sys
+import time
+from collections import OrderedDict
 from datetime import datetime
 from pathlib import Path
 
@@ -23,7 +25,193 @@ PACKS_DIR = ROOT / "packs"
 HOOKS_DIR = ROOT / "hooks"
 OUT_DIR = ROOT / "out"
 
+# Compiled-template cache (in-process LRU plus optional on-disk copy)
+CACHE_DIR = (
+    Path(os.environ["XDG_CACHE_HOME"]) / "claude-playbooks"
+    if os.environ.get("XDG_CACHE_HOME")
+    else OUT_DIR / ".cache"
+)
+DISK_CACHE_ENV = "PLAYBOOK_DISK_CACHE"
+PACK_INDEX_VERSION = 3
+VARS_INDEX_VERSION = 2
+BUNDLE_SUFFIX = ".pbpack"
+TEMPLATE_CACHE_SIZE = 128
+
+# Inputs at least this large are streamed from an mmap instead of read into memory
+STREAM_THRESHOLD = 64 * 1024 * 1024
+STREAM_CHUNK = 1024 * 1024
+
+# --max-tokens estimates one token per this many characters (no tokenizer needed)
+CHARS_PER_TOKEN = 4
+CHUNK_KINDS = ["auto", "diff", "solidity", "text"]
+
+# playbook watch: quiet time before re-rendering, and polling fallback interval
+WATCH_DEBOUNCE = 0.2
+WATCH_POLL_INTERVAL = 0.5
+WATCH_POLL_ENV = "PLAYBOOK_WATCH_POLL"
+
+# Threads reading files ahead when --input matches many files
+INPUT_READERS = 8
+
+# --git-diff keeps this many committed-range diffs under CACHE_DIR/git-diff
+GIT_DIFF_CACHE_ENTRIES = 64
+
+# Seconds a hook script may run before it is killed (0 = no limit)
+HOOK_TIMEOUT_ENV = "PLAYBOOK_HOOK_TIMEOUT"
+HOOK_TIMEOUT = 300
+# each: post hooks run per prompt; batch: once per run with a manifest of outputs
+HOOK_MODES = ["each", "batch"]
+
+# Variables larger than this many bytes reach hooks as PB_<VAR>_FILE/_SIZE
+HOOK_ENV_MAX_ENV = "PLAYBOOK_HOOK_ENV_MAX"
+HOOK_ENV_MAX = 32 * 1024
+
+# Rendered-prompt cache limits (override with the matching env vars)
+NO_CACHE_ENV = "PLAYBOOK_NO_CACHE"
+RENDER_CACHE_ENTRIES_ENV = "PLAYBOOK_RENDER_CACHE_ENTRIES"
+RENDER_CACHE_ENTRIES = 1000
+RENDER_CACHE_BYTES_ENV = "PLAYBOOK_RENDER_CACHE_BYTES"
+RENDER_CACHE_BYTES = 256 * 1024 * 1024
+
+# Output layout for saved prompts: "flat" (default) or "cas"
+STORE_ENV = "PLAYBOOK_STORE"
+
+# Sinks (--out-format jsonl|sqlite) commit prompts in groups of this size
+SINK_GROUP_RECORDS = 256
+SINK_GROUP_BYTES = 4 * 1024 * 1024
+
+# Per-phase timings: PLAYBOOK_TRACE=1 (stderr) or a file path, like --trace
+TRACE_ENV = "PLAYBOOK_TRACE"
+TRACE_MEMORY_ENV = "PLAYBOOK_TRACE_MEMORY"
+PROFILE_ENV = "PLAYBOOK_PROFILE"
+
+# `playbook serve` socket; `playbook run` renders through it when it is up
+SOCKET_ENV = "PLAYBOOK_SOCKET"
+NO_DAEMON_ENV = "PLAYBOOK_NO_DAEMON"
+DAEMON_TIMEOUT = 30
+
+SUBCOMMANDS = ["run", "list", "batch", "serve", "bench", "watch", "gc", "pack", "init", "completion"]
+COMPLETION_SHELLS = ["bash", "zsh", "fish"]
+
 VAR_PATTERN = re.compile(r"\{\{([a-zA-Z0-9_]+)\}\}")
+# {{> name}} includes playbooks/partials/name.md (a pack's own partials/ first)
+PARTIAL_PATTERN = re.compile(r"\{\{>\s*([a-zA-Z0-9_-]+)\s*\}\}")
+PARTIALS_DIR = "partials"
+
+# ============================================================================
+# TRACING AND PROFILING
+# ============================================================================
+
+class Tracer:
+    """Collects timed spans and writes them as JSON lines.
+
+    Each span records its name, start and duration in milliseconds on the
+    monotonic clock (relative to the tracer's start) plus any attributes the
+    caller adds, such as byte counts. out is "-" for stderr or a file path
+    that spans are appended to. Batch workers share the parent's origin, so
+    their start times line up on one timeline.
+    """
+
+    def __init__(self, out: str = "-", memory: bool = False, origin: float = None):
+        self.out = out
+        self.memory = memory
+        self.origin = time.perf_counter() if origin is None else origin
+        self.spans = []
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attrs):
+        record = {"span": name}
+        record.update(attrs)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            end = time.perf_counter()
+            record["start_ms"] = round((start - self.origin) * 1000, 3)
+            record["ms"] = round((end - start) * 1000, 3)
+            self.spans.append(record)
+
+    def flush(self):
+        """Write and forget the spans recorded so far."""
+        if not self.spans:
+            return
+        data = "".join(json.dumps(span, default=str) + "\n" for span in self.spans)
+        self.spans = []
+        if self.out == "-":
+            sys.stderr.write(data)
+            sys.stderr.flush()
+            return
+        fd = os.open(self.out, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data.encode("utf-8"))
+        finally:
+            os.close(fd)
+
+# The active tracer, or None when tracing is off
+_tracer = None
+
+def trace_span(name: str, **attrs):
+    """Time a phase when tracing is on.
+
+    Yields the span record so callers can add counts, or None when tracing
+    is off; the disabled path costs one global lookup.
+    """
+    if _tracer is None:
+        return contextlib.nullcontext()
+    return _tracer.span(name, **attrs)
+
+def trace_settings(args=None, environ: dict = None):
+    """Return (trace_out or None, memory, profile_path) from flags and environment."""
+    environ = os.environ if environ is None else environ
+    out = getattr(args, "trace", None) or environ.get(TRACE_ENV, "")
+    if out in ("", "0"):
+        out = None
+    elif out == "1":
+        out = "-"
+    memory = getattr(args, "trace_memory", False) or environ.get(TRACE_MEMORY_ENV, "") not in ("", "0")
+    if memory and out is None:
+        out = "-"
+    profile = getattr(args, "profile", None) or environ.get(PROFILE_ENV) or None
+    return out, memory, profile
+
+@contextlib.contextmanager
+def instrumented(command: str, args=None):
+    """Trace and/or profile one command according to trace_settings()."""
+    global _tracer
+    out, memory, profile = trace_settings(args)
+    if out is None and profile is None:
+        yield
+        return
+
+    profiler = None
+    if profile:
+        import cProfile
+        profiler = cProfile.Profile()
+    if out is not None:
+        _tracer = Tracer(out, memory)
+        if memory:
+            import tracemalloc
+            tracemalloc.start()
+    try:
+        with trace_span("command", command=command) as span:
+            if profiler:
+                profiler.enable()
+            try:
+                yield
+            finally:
+                if profiler:
+                    profiler.disable()
+                if span is not None and memory:
+                    span["mem_peak"] = tracemalloc.get_traced_memory()[1]
+                    stats = tracemalloc.take_snapshot().statistics("lineno")[:10]
+                    span["top_allocations"] = [f"{stat.traceback} {stat.size}" for stat in stats]
+                    tracemalloc.stop()
+    finally:
+        if profiler:
+            profiler.dump_stats(profile)
+        if _tracer is not None:
+            _tracer.flush()
+            _tracer = None
 
 # ============================================================================
 # CORE UTILITIES (unchanged from v1)
@@ -43,186 +231,3439 @@ def parse_vars(pairs):
         vars_dict[k] = v
     return vars_dict
 
-def run_hook(path: Path, env: dict):
-    """Execute a hook script if it exists."""
-    if not path.exists():
-        return
-    if not os.access(path, os.X_OK):
-        # try to run with bash anyway
-        subprocess.run(["bash", str(path)], check=True, env=env)
+def hook_timeout():
+    """Return the per-hook timeout in seconds, or None for no limit."""
+    raw = os.environ.get(HOOK_TIMEOUT_ENV)
+    if not raw:
+        return HOOK_TIMEOUT
+    try:
+        timeout = float(raw)
+    except ValueError:
+        raise ValueError(f"Invalid {HOOK_TIMEOUT_ENV} value: {raw}. Use seconds, or 0 for no limit")
+    return timeout if timeout > 0 else None
+
+def hook_stdout():
+    """Return where hook output goes: stderr, since stdout carries prompts and JSON results."""
+    try:
+        return sys.stderr.fileno()
+    except (AttributeError, OSError, ValueError):
+        return 2
+
+def run_hook(path: Path, env: dict, timeout: float = None):
+    """Execute a hook script if it exists, killing it after timeout seconds.
+
+    The script's stdout is sent to stderr (see hook_stdout).
+    """
+    import subprocess
+    if not path.exists():
+        return
+    if os.access(path, os.X_OK):
+        command = [str(path)]
+    elif path.suffix == ".py":
+        command = [sys.executable, str(path)]
+    else:
+        # try to run with bash anyway
+        command = ["bash", str(path)]
+    try:
+        subprocess.run(command, check=True, env=env, timeout=timeout, stdout=hook_stdout())
+    except subprocess.TimeoutExpired:
+        raise ValueError(f"Hook {path} timed out after {timeout:g}s (set {HOOK_TIMEOUT_ENV})")
+
+def hook_scripts(directory: Path, phase: str) -> list:
+    """Return the scripts in directory/<phase>.d, sorted, skipping hidden and backup files."""
+    try:
+        entries = os.scandir(str(directory / f"{phase}.d"))
+    except OSError:
+        return []
+    with entries:
+        return sorted(Path(e.path) for e in entries
+                      if e.is_file() and not e.name.startswith(".") and not e.name.endswith("~"))
+
+def run_hook_scripts(scripts: list, env: dict, timeout: float = None):
+    """Run independent hook scripts concurrently and wait for all of them.
+
+    The first failure in name order is raised once every script finished.
+    """
+    if len(scripts) == 1:
+        run_hook(scripts[0], env, timeout)
+        return
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(len(scripts)) as pool:
+        futures = [pool.submit(run_hook, script, env, timeout) for script in scripts]
+    for future in futures:
+        future.result()
+
+def load_python_hook(path: Path):
+    """Import a Python hook file once and return its hook() callable."""
+    import hashlib
+    mtime = path.stat().st_mtime_ns
+    cached = _python_hooks.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    import importlib.util
+    module_name = "playbook_hook_" + hashlib.sha1(str(path).encode("utf-8")).hexdigest()[:12]
+    spec = importlib.util.spec_from_file_location(module_name, str(path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    func = getattr(module, "hook", None)
+    if not callable(func):
+        raise ValueError(f"Python hook {path} must define hook(vars, out_file)")
+
+    _python_hooks[path] = (mtime, func)
+    return func
+
+# path -> (mtime_ns, hook callable)
+_python_hooks = {}
+
+def hook_dirs(pack: str = None) -> list:
+    """Return hook directories to run, core first, then the pack's own."""
+    dirs = [HOOKS_DIR]
+    if pack:
+        dirs.append(PACKS_DIR / pack / "hooks")
+    return dirs
+
+def has_hooks(phase: str, pack: str = None) -> bool:
+    """Return True if any hook directory has a <phase>.py/.sh hook or <phase>.d scripts."""
+    return any(
+        (directory / f"{phase}.py").exists() or (directory / f"{phase}.sh").exists()
+        or hook_scripts(directory, phase)
+        for directory in hook_dirs(pack)
+    )
+
+def run_hooks(phase: str, pack: str, env: dict, vars_dict: dict, out_file: Path = None):
+    """Run the pre or post hooks of each hook directory, core first."""
+    timeout = hook_timeout()
+    for directory in hook_dirs(pack):
+        run_hook_directory(directory, phase, env, vars_dict, out_file, timeout)
+
+def run_hook_directory(directory: Path, phase: str, env: dict, vars_dict: dict, out_file: Path = None,
+                       timeout: float = None):
+    """Run one directory's hooks for phase.
+
+    A <phase>.py file is imported once and its hook(vars, out_file) is called
+    in-process (pre hooks may add or change vars). Otherwise <phase>.sh runs
+    as a subprocess with env. Then every script in <phase>.d/ runs, all at
+    once; subprocess hooks are killed after timeout seconds. Either way,
+    what a hook prints goes to stderr.
+    """
+    py_hook = directory / f"{phase}.py"
+    sh_hook = directory / f"{phase}.sh"
+    if py_hook.exists():
+        with trace_span("hook", phase=phase, path=str(py_hook)):
+            func = load_python_hook(py_hook)
+            try:
+                with contextlib.redirect_stdout(sys.stderr):
+                    func(vars_dict, out_file)
+            except Exception as e:
+                raise ValueError(f"Hook {py_hook} failed: {e}") from e
+    elif sh_hook.exists():
+        with trace_span("hook", phase=phase, path=str(sh_hook)):
+            run_hook(sh_hook, env, timeout)
+
+    scripts = hook_scripts(directory, phase)
+    if scripts:
+        with trace_span("hook", phase=phase, path=str(directory / f"{phase}.d"), scripts=len(scripts)):
+            run_hook_scripts(scripts, env, timeout)
+
+def run_batch_hooks(results: list):
+    """Run post hooks once for a whole run, with a JSON manifest of its outputs.
+
+    Used with --hook-mode batch instead of one post hook per prompt. Core
+    post hooks see every successful result; a pack's own post hooks see
+    that pack's. Scripts get HOOK_MODE=batch, MANIFEST_FILE and OUT_COUNT
+    (OUT_FILE is the manifest too); Python hooks are called as
+    hook({"hook_mode": "batch", "out_count": "N"}, manifest_path).
+    Returns the manifest paths written.
+    """
+    outputs = [{k: v for k, v in result.items() if k != "prompt"}
+               for result in results if result["status"] == "ok"]
+    if not outputs:
+        return []
+    groups = [(None, HOOKS_DIR, outputs)]
+    for pack in sorted({output["pack"] for output in outputs if output["pack"]}):
+        groups.append((pack, PACKS_DIR / pack / "hooks", [o for o in outputs if o["pack"] == pack]))
+
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    timeout = hook_timeout()
+    manifests = []
+    for pack, directory, group in groups:
+        if not ((directory / "post.py").exists() or (directory / "post.sh").exists()
+                or hook_scripts(directory, "post")):
+            continue
+        manifest = OUT_DIR / f"{timestamp}_batch{'_' + pack if pack else ''}_{os.getpid()}.manifest.json"
+        manifest.parent.mkdir(parents=True, exist_ok=True)
+        manifest.write_text(json.dumps({"count": len(group), "outputs": group}, indent=2), encoding="utf-8")
+        manifests.append(manifest)
+
+        env = os.environ.copy()
+        env.update(HOOK_MODE="batch", MANIFEST_FILE=str(manifest), OUT_FILE=str(manifest),
+                   OUT_COUNT=str(len(group)))
+        if pack:
+            env["PB_PACK"] = pack
+        vars_dict = {"hook_mode": "batch", "out_count": str(len(group))}
+        run_hook_directory(directory, "post", env, vars_dict, manifest, timeout)
+    return manifests
+
+def render(template: str, vars_dict: dict) -> str:
+    """Substitute {{variables}} in template with values from vars_dict."""
+    return compile_template(template).render(vars_dict)
+
+# ============================================================================
+# TEMPLATE COMPILATION AND CACHING
+# ============================================================================
+
+class Template:
+    """Playbook template compiled into literal text and placeholder segments."""
+
+    __slots__ = ("source", "head", "segments")
+
+    def __init__(self, source: str, head: str = None, segments: tuple = None):
+        self.source = source
+        if head is None:
+            # split() with one group alternates literal, key, literal, ...
+            parts = VAR_PATTERN.split(source)
+            head, keys, literals = parts[0], parts[1::2], parts[2::2]
+            segments = tuple(zip(keys, literals))
+        self.head = head
+        # (key, placeholder text, literal that follows it)
+        self.segments = tuple((key, f"{{{{{key}}}}}", literal) for key, literal in segments)
+
+    @property
+    def keys(self) -> tuple:
+        """Placeholder names in order of appearance."""
+        return tuple(key for key, _, _ in self.segments)
+
+    def render_to(self, out, vars_dict: dict) -> int:
+        """Write the rendered template to binary stream out without joining it.
+
+        Values may be str or any bytes-like object (e.g. an mmap); bytes-like
+        values are copied in STREAM_CHUNK slices. Returns bytes written.
+        """
+        written = _write_value(out, self.head)
+        for key, placeholder, literal in self.segments:
+            written += _write_value(out, vars_dict.get(key, placeholder))
+            written += _write_value(out, literal)
+        return written
+
+    def render(self, vars_dict: dict) -> str:
+        """Join the precomputed segments with values from vars_dict."""
+        get = vars_dict.get
+        parts = [self.head]
+        for key, placeholder, literal in self.segments:
+            parts.append(get(key, placeholder))
+            parts.append(literal)
+        return "".join(parts)
+
+def _write_value(out, value) -> int:
+    """Write one str or bytes-like render value to a binary stream."""
+    if isinstance(value, str):
+        data = value.encode("utf-8")
+        out.write(data)
+        return len(data)
+    with memoryview(value) as view:
+        for start in range(0, len(view), STREAM_CHUNK):
+            out.write(view[start:start + STREAM_CHUNK])
+        return len(view)
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def compile_template(source: str) -> Template:
+    """Compile template text once; repeated calls hit an LRU."""
+    return Template(source)
+
+# partial file -> ((mtime_ns, size), text)
+_partial_files = {}
+
+def partial_dirs(key, playbooks_dir: Path = None) -> list:
+    """Return where {{> name}} is looked up for the template at key, in order.
+
+    key is a template path or a (bundle, member) pair. The template's own
+    partials/ directory comes first (inside the bundle for bundled packs),
+    then the core one, so a pack can override a shared partial.
+    """
+    core = (playbooks_dir or PLAYBOOKS_DIR) / PARTIALS_DIR
+    if isinstance(key, tuple):
+        bundle, member = key
+        return [(bundle, f"{member.rpartition('/')[0]}/{PARTIALS_DIR}".lstrip("/")), core]
+    own = key.parent / PARTIALS_DIR
+    return [own] if own == core else [own, core]
+
+def _read_partial(name: str, dirs: list, deps: dict) -> str:
+    """Return partial text from the first of dirs holding it, recording every file looked at.
+
+    deps maps each candidate file to its stamp, or None if it was missing,
+    so a partial added later in front of the one used also counts as a change.
+    """
+    for location in dirs:
+        if isinstance(location, tuple):
+            bundle, folder = location
+            deps[bundle] = file_stamp(bundle)
+            try:
+                text = read_bundle_member(bundle, f"{folder}/{name}.md").decode("utf-8")
+            except FileNotFoundError:
+                continue
+        else:
+            path = location / f"{name}.md"
+            stamp = deps[path] = file_stamp(path)
+            if stamp is None:
+                continue
+            cached = _partial_files.get(path)
+            if cached is not None and cached[0] == stamp:
+                text = cached[1]
+            else:
+                text = path.read_text(encoding="utf-8")
+                _partial_files[path] = (stamp, text)
+        # A partial on a line of its own should not add a blank line
+        return text[:-1] if text.endswith("\n") else text
+
+    looked = [f"{loc[0]}!{loc[1]}" if isinstance(loc, tuple) else str(loc) for loc in dirs]
+    raise FileNotFoundError(f"Partial not found: {name} (looked in {', '.join(looked)})")
+
+def expand_partials(source: str, dirs: list, deps: dict = None, stack: tuple = ()) -> str:
+    """Flatten {{> name}} includes in source, recursively.
+
+    Files read (and missing candidates) are added to deps. An include cycle
+    raises ValueError naming the chain, so it fails when the template is
+    compiled rather than when it is rendered.
+    """
+    if "{{>" not in source:
+        return source
+    deps = {} if deps is None else deps
+
+    def include(match):
+        name = match.group(1)
+        if name in stack:
+            raise ValueError(f"Partial include cycle: {' -> '.join(stack + (name,))}")
+        return expand_partials(_read_partial(name, dirs, deps), dirs, deps, stack + (name,))
+
+    return PARTIAL_PATTERN.sub(include, source)
+
+def partials_current(deps) -> bool:
+    """Return True if no partial in deps ((path, stamp) pairs) changed; None never is."""
+    if deps is None:
+        return False
+    for path, stamp in deps:
+        if file_stamp(Path(path)) != (tuple(stamp) if stamp is not None else None):
+            return False
+    return True
+
+def compile_source(source: str, key, playbooks_dir: Path = None):
+    """Compile template text read from key, flattening partials.
+
+    Returns (Template, deps) where deps is a tuple of (partial path, stamp)
+    pairs: the edges from this template to every partial it includes,
+    directly or not. Templates without includes have no edges and are never
+    rechecked.
+    """
+    deps = {}
+    template = compile_template(expand_partials(source, partial_dirs(key, playbooks_dir), deps))
+    return template, tuple(sorted(deps.items(), key=lambda item: str(item[0])))
+
+# path or (bundle, member) -> ((mtime_ns, size), Template, partial deps), most recently used last
+_template_files = OrderedDict()
+
+def disk_cache_enabled() -> bool:
+    """Return True if the on-disk template cache is switched on."""
+    return os.environ.get(DISK_CACHE_ENV, "") not in ("", "0")
+
+def _disk_cache_path(path: Path) -> Path:
+    import hashlib
+    digest = hashlib.sha1(str(path).encode("utf-8")).hexdigest()
+    return CACHE_DIR / "templates" / f"{digest}.json"
+
+def _disk_cache_load(path: Path, stamp: tuple):
+    """Return (Template, deps) cached for path, or None if missing or stale."""
+    import hashlib
+    try:
+        entry = json.loads(_disk_cache_path(path).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    if entry.get("path") != str(path) or "deps" not in entry:
+        return None
+    deps = tuple((Path(dep), tuple(dep_stamp) if dep_stamp else None) for dep, dep_stamp in entry.get("deps", []))
+    if not partials_current(deps):
+        return None
+    segments = entry["segments"]
+    source = entry["head"] + "".join(f"{{{{{key}}}}}{literal}" for key, literal in segments)
+    template = Template(source, entry["head"], segments)
+    if (entry.get("mtime_ns"), entry.get("size")) != stamp:
+        # Touched but maybe unchanged: fall back to comparing content hashes
+        raw = path.read_text(encoding="utf-8")
+        if hashlib.sha256(raw.encode("utf-8")).hexdigest() != entry.get("sha256"):
+            return None
+        _disk_cache_store(path, stamp, raw, template, deps)
+    return template, deps
+
+def _disk_cache_store(path: Path, stamp: tuple, raw: str, template: Template, deps: tuple = ()):
+    """Write template to the on-disk cache; failures are not fatal.
+
+    raw is the file's own text, hashed to spot touched-but-unchanged files;
+    the compiled segments already have any partials flattened in.
+    """
+    import hashlib
+    entry = {
+        "path": str(path),
+        "mtime_ns": stamp[0],
+        "size": stamp[1],
+        "sha256": hashlib.sha256(raw.encode("utf-8")).hexdigest(),
+        "head": template.head,
+        "segments": [[key, literal] for key, _, literal in template.segments],
+        "deps": [[str(dep), dep_stamp] for dep, dep_stamp in deps],
+    }
+    cache_file = _disk_cache_path(path)
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cache_file.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(entry), encoding="utf-8")
+        os.replace(str(tmp), str(cache_file))
+    except OSError:
+        pass
+
+def _cached_template(key, stamp: tuple):
+    """Return the LRU's Template for key if neither it nor its partials changed."""
+    cached = _template_files.get(key)
+    if cached is not None and cached[0] == stamp and (not cached[2] or partials_current(cached[2])):
+        _template_files.move_to_end(key)
+        return cached[1]
+    return None
+
+def load_template_file(path: Path) -> Template:
+    """Load and compile a template file, reusing it until it or a partial it includes changes."""
+    st = path.stat()
+    stamp = (st.st_mtime_ns, st.st_size)
+    template = _cached_template(path, stamp)
+    if template is not None:
+        return template
+
+    loaded = _disk_cache_load(path, stamp) if disk_cache_enabled() else None
+    if loaded is None:
+        raw = path.read_text(encoding="utf-8")
+        loaded = compile_source(raw, path)
+        if disk_cache_enabled():
+            _disk_cache_store(path, stamp, raw, *loaded)
+
+    _remember_template(path, stamp, *loaded)
+    return loaded[0]
+
+def load_bundle_template(bundle: Path, member: str) -> Template:
+    """Load and compile a template stored inside a pack bundle."""
+    st = bundle.stat()
+    stamp = (st.st_mtime_ns, st.st_size)
+    key = (bundle, member)
+    template = _cached_template(key, stamp)
+    if template is not None:
+        return template
+
+    loaded = compile_source(read_bundle_member(bundle, member).decode("utf-8"), key)
+    _remember_template(key, stamp, *loaded)
+    return loaded[0]
+
+def template_partials(key) -> list:
+    """Return the partial files the cached template at key depends on."""
+    cached = _template_files.get(key)
+    return [dep for dep, _ in cached[2]] if cached is not None else []
+
+def _remember_template(key, stamp: tuple, template: Template, deps: tuple = ()):
+    """Store a compiled template in the file LRU, evicting the oldest."""
+    _template_files[key] = (stamp, template, deps)
+    _template_files.move_to_end(key)
+    while len(_template_files) > TEMPLATE_CACHE_SIZE:
+        _template_files.popitem(last=False)
+
+# ============================================================================
+# PACK MANAGEMENT
+# ============================================================================
+
+def load_manifest(pack_name: str) -> dict:
+    """Load and parse pack manifest.json."""
+    manifest_path = PACKS_DIR / pack_name / "meta" / "manifest.json"
+    source = manifest_path
+    if not manifest_path.exists():
+        bundle = bundle_path(pack_name)
+        if not bundle.is_file():
+            raise FileNotFoundError(
+                f"Pack '{pack_name}' not found.\n"
+                f"Expected manifest at: {manifest_path}\n"
+                f"Available packs: {', '.join(discover_packs()) or 'none'}"
+            )
+        source = bundle
+
+    mtime = source.stat().st_mtime_ns
+    cached = _manifests.get(source)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    try:
+        if source is manifest_path:
+            manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+        else:
+            manifest = json.loads(read_bundle_member(source, "meta/manifest.json").decode("utf-8"))
+            manifest_path = f"{source}!meta/manifest.json"
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Invalid JSON in {manifest_path}: {e}")
+    _manifests[source] = (mtime, manifest)
+    return manifest
+
+# manifest path or bundle path -> (mtime_ns, parsed manifest)
+_manifests = {}
+
+def validate_manifest(manifest: dict, pack_name: str, warn: bool = True):
+    """Validate pack manifest structure (warn: print a name mismatch warning)."""
+    required_fields = ["name", "version", "playbooks"]
+    for field in required_fields:
+        if field not in manifest:
+            raise ValueError(
+                f"Pack '{pack_name}' manifest missing required field: {field}\n"
+                f"Required fields: {', '.join(required_fields)}"
+            )
+
+    if not isinstance(manifest["playbooks"], list):
+        raise ValueError(
+            f"Pack '{pack_name}' manifest field 'playbooks' must be an array"
+        )
+
+    if not isinstance(manifest.get("filters", []), (list, dict)):
+        raise ValueError(
+            f"Pack '{pack_name}' manifest field 'filters' must be an array or an object"
+        )
+
+    if warn and manifest["name"] != pack_name:
+        print(
+            f"Warning: Pack directory name '{pack_name}' "
+            f"doesn't match manifest name '{manifest['name']}'",
+            file=sys.stderr
+        )
+
+class LicenseError(ValueError):
+    """Raised when a pack requires a license key that is not set."""
+
+def require_license(manifest: dict, pack_name: str, environ: dict = None):
+    """Raise LicenseError if pack requires a license that is not set in environ."""
+    if not manifest.get("requires_license", False):
+        return
+
+    license_env = manifest.get("license_env", "PLAYBOOK_LICENSE_KEY")
+    if not (os.environ if environ is None else environ).get(license_env):
+        license_url = manifest.get("license_url", "")
+        lines = [
+            f"Pack '{pack_name}' requires a license.",
+            f"Set environment variable: {license_env}",
+        ]
+        if license_url:
+            lines.append(f"Get a license at: {license_url}")
+        lines.append(f"\nExample: export {license_env}=\"your-license-key\"")
+        raise LicenseError("\n".join(lines))
+
+def check_license(manifest: dict, pack_name: str):
+    """Check if pack requires license and validate."""
+    try:
+        require_license(manifest, pack_name)
+    except LicenseError as e:
+        print(f"\nError: {e}", file=sys.stderr)
+        sys.exit(1)
+
+def discover_packs() -> list:
+    """Return list of available pack names."""
+    return sorted(refresh_pack_index())
+
+# ============================================================================
+# PACK INDEX
+# ============================================================================
+
+# packs dir -> index loaded from disk, kept for the life of the process
+_pack_indexes = {}
+
+def pack_index_path() -> Path:
+    """Return the index file for the current PACKS_DIR."""
+    import hashlib
+    digest = hashlib.sha1(str(PACKS_DIR).encode("utf-8")).hexdigest()[:12]
+    return CACHE_DIR / f"packs-{digest}.json"
+
+def _load_pack_index() -> dict:
+    key = str(PACKS_DIR)
+    if key not in _pack_indexes:
+        try:
+            index = json.loads(pack_index_path().read_text(encoding="utf-8"))
+            if index.get("version") != PACK_INDEX_VERSION or index.get("packs_dir") != key:
+                raise ValueError("stale index")
+        except (OSError, ValueError):
+            index = {"version": PACK_INDEX_VERSION, "packs_dir": key, "packs": {}}
+        _pack_indexes[key] = index
+    return _pack_indexes[key]
+
+def _save_index(path: Path, index: dict):
+    _write_cache_file(path, json.dumps(index))
+
+def _write_cache_file(path: Path, text: str):
+    """Write a cache file atomically; a read-only cache dir is not fatal."""
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_text(text, encoding="utf-8")
+        os.replace(str(tmp), str(path))
+    except OSError:
+        pass
+
+def _pack_stamp(pack_dir: Path):
+    """Return the stat fingerprint of a pack, or None if it has no manifest."""
+    try:
+        st = (pack_dir / "meta" / "manifest.json").stat()
+    except OSError:
+        try:
+            st = bundle_path(pack_dir.name).stat()
+        except OSError:
+            return None
+        return [st.st_mtime_ns, st.st_size, -1]
+    try:
+        playbooks_mtime = (pack_dir / "playbooks").stat().st_mtime_ns
+    except OSError:
+        playbooks_mtime = 0
+    return [st.st_mtime_ns, st.st_size, playbooks_mtime]
+
+def _index_pack(pack_name: str, stamp: list) -> dict:
+    """Parse, validate and hash one pack into an index entry."""
+    import hashlib
+    entry = {"stamp": stamp}
+    if stamp[2] == -1:
+        entry["bundle"] = bundle_path(pack_name).name
+    try:
+        manifest = load_manifest(pack_name)
+        validate_manifest(manifest, pack_name)
+        manifest_bytes = read_pack_file(pack_name, "meta/manifest.json")
+    except (OSError, ValueError) as e:
+        entry["error"] = str(e)
+        return entry
+
+    files = {}
+    for name in manifest["playbooks"]:
+        try:
+            data = read_pack_file(pack_name, f"playbooks/{name}.md")
+        except OSError:
+            continue
+        if "bundle" in entry:
+            mtime = stamp[0]  # bundled playbooks share the bundle's mtime
+            key = (bundle_path(pack_name), f"playbooks/{name}.md")
+            path = key[0]
+        else:
+            path = key = PACKS_DIR / pack_name / "playbooks" / f"{name}.md"
+            mtime = path.stat().st_mtime_ns
+        files[name] = _vars_entry(path, [mtime, len(data)], key)
+        files[name].update(mtime_ns=mtime, size=len(data), sha256=hashlib.sha256(data).hexdigest())
+
+    entry.update(
+        name=manifest["name"],
+        version=manifest["version"],
+        playbooks=manifest["playbooks"],
+        sha256=hashlib.sha256(manifest_bytes).hexdigest(),
+        files=files,
+        manifest=manifest,
+    )
+    return entry
+
+def _pack_files_stale(pack_name: str, entry: dict) -> bool:
+    """Return True if a pack playbook was edited in place or a partial it includes changed.
+
+    Editing a file does not touch its directory's mtime, so each listed
+    playbook's own mtime and size are compared with the index (bundled
+    playbooks are covered by the bundle's stamp).
+    """
+    files = entry.get("files", {})
+    if "bundle" not in entry:
+        playbooks = PACKS_DIR / pack_name / "playbooks"
+        for name, info in files.items():
+            if file_stamp(playbooks / f"{name}.md") != (info["mtime_ns"], info["size"]):
+                return True
+    return any(map(_partials_stale, files.values()))
+
+def refresh_pack_index(pack: str = None) -> dict:
+    """Bring the pack index up to date and return {pack name: entry}.
+
+    Only packs whose manifest, playbooks directory or playbook files changed
+    since they were indexed are parsed again; the rest cost a stat call per
+    file.
+    With pack set, only that pack is checked.
+    """
+    index = _load_pack_index()
+    packs = index["packs"]
+    changed = False
+
+    if pack is None:
+        names = set()
+        if PACKS_DIR.exists():
+            for e in os.scandir(str(PACKS_DIR)):
+                if e.is_dir():
+                    names.add(e.name)
+                elif e.name.endswith(BUNDLE_SUFFIX):
+                    names.add(e.name[:-len(BUNDLE_SUFFIX)])
+        for gone in set(packs) - set(names):
+            del packs[gone]
+            changed = True
+    else:
+        names = [pack]
+
+    for name in names:
+        stamp = _pack_stamp(PACKS_DIR / name)
+        if stamp is None:
+            if packs.pop(name, None) is not None:
+                changed = True
+            continue
+        entry = packs.get(name)
+        if entry is None or entry.get("stamp") != stamp or _pack_files_stale(name, entry):
+            packs[name] = _index_pack(name, stamp)
+            changed = True
+
+    if changed:
+        _save_index(pack_index_path(), index)
+    return packs
+
+def pack_entry(pack: str) -> dict:
+    """Return the validated index entry for pack."""
+    entry = refresh_pack_index(pack).get(pack)
+    if entry is None:
+        load_manifest(pack)  # raises FileNotFoundError listing available packs
+    if "error" in entry:
+        raise ValueError(entry["error"])
+    return entry
+
+# ============================================================================
+# PACK BUNDLES
+# ============================================================================
+
+# bundle path -> ((mtime_ns, size), ZipFile over an mmap of the bundle)
+_bundles = {}
+
+class _MappedFile:
+    """Read-only file interface over an mmap (older mmaps lack seekable())."""
+
+    def __init__(self, mapped):
+        self.mapped = mapped
+
+    def __getattr__(self, name):
+        return getattr(self.mapped, name)
+
+    def seekable(self) -> bool:
+        return True
+
+def bundle_path(pack_name: str) -> Path:
+    """Return where a single-file bundle for pack_name would live."""
+    return PACKS_DIR / f"{pack_name}{BUNDLE_SUFFIX}"
+
+def open_bundle(path: Path):
+    """Open a pack bundle once and keep its central directory in memory."""
+    import mmap
+    import zipfile
+    st = path.stat()
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = _bundles.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    with path.open("rb") as fh:
+        try:
+            mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise ValueError(f"Invalid pack bundle (empty file): {path}")
+    try:
+        bundle = zipfile.ZipFile(_MappedFile(mapped))
+    except zipfile.BadZipFile as e:
+        mapped.close()
+        raise ValueError(f"Invalid pack bundle {path}: {e}")
+    _bundles[path] = (stamp, bundle)
+    return bundle
+
+def read_bundle_member(path: Path, member: str) -> bytes:
+    """Read one file from a pack bundle by its path inside the pack."""
+    try:
+        return open_bundle(path).read(member)
+    except KeyError:
+        raise FileNotFoundError(f"Playbook not found: {path}!{member}")
+
+def read_pack_file(pack_name: str, member: str) -> bytes:
+    """Read a file from a pack directory or, failing that, its bundle."""
+    path = PACKS_DIR / pack_name / member
+    if path.exists():
+        return path.read_bytes()
+    return read_bundle_member(bundle_path(pack_name), member)
+
+def build_bundle(pack_name: str, out_path: Path) -> Path:
+    """Write pack_name's manifest, playbooks and partials into one bundle file.
+
+    Members are stored uncompressed with fixed timestamps, so a bundle can be
+    read in place through an mmap and rebuilding an unchanged pack gives the
+    same bytes.
+    """
+    import zipfile
+    pack_dir = PACKS_DIR / pack_name
+    manifest = load_manifest(pack_name)
+    validate_manifest(manifest, pack_name)
+
+    members = ["meta/manifest.json"]
+    for name in manifest["playbooks"]:
+        member = f"playbooks/{name}.md"
+        if not (pack_dir / member).exists():
+            raise FileNotFoundError(f"Playbook not found: {pack_dir / member}")
+        members.append(member)
+    partials = pack_dir / "playbooks" / PARTIALS_DIR
+    if partials.is_dir():
+        members += sorted(f"playbooks/{PARTIALS_DIR}/{p.name}" for p in partials.glob("*.md"))
+
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = out_path.with_name(f".{out_path.name}.{os.getpid()}.tmp")
+    with zipfile.ZipFile(str(tmp), "w", compression=zipfile.ZIP_STORED) as bundle:
+        for member in members:
+            info = zipfile.ZipInfo(member, date_time=(1980, 1, 1, 0, 0, 0))
+            info.external_attr = 0o644 << 16
+            bundle.writestr(info, (pack_dir / member).read_bytes())
+    os.replace(str(tmp), str(out_path))
+    return out_path
+
+# ============================================================================
+# PLAYBOOK LOADING
+# ============================================================================
+
+def playbook_path(name: str, pack: str = None, environ: dict = None) -> Path:
+    """Resolve the template path for a core or pack playbook.
+
+    For a bundled pack this is the bundle file holding the playbook.
+    Pack license keys are looked up in environ (default: os.environ).
+    """
+    if pack:
+        # Load from pack (manifest already validated by the pack index)
+        entry = pack_entry(pack)
+        manifest = entry["manifest"]
+        require_license(manifest, pack, environ)
+
+        # Check if playbook is in manifest whitelist
+        if name not in manifest["playbooks"]:
+            raise FileNotFoundError(
+                f"Playbook '{name}' not available in pack '{pack}'.\n"
+                f"Available playbooks: {', '.join(manifest['playbooks'])}"
+            )
+
+        if "bundle" in entry:
+            return PACKS_DIR / entry["bundle"]
+        pb_path = PACKS_DIR / pack / "playbooks" / f"{name}.md"
+    else:
+        # Load from core
+        pb_path = PLAYBOOKS_DIR / f"{name}.md"
+
+    if not pb_path.exists():
+        raise FileNotFoundError(f"Playbook not found: {pb_path}")
+
+    return pb_path
+
+def load_template(name: str, pack: str = None, environ: dict = None) -> Template:
+    """Load the compiled template for a core or pack playbook."""
+    path = playbook_path(name, pack=pack, environ=environ)
+    if path.suffix == BUNDLE_SUFFIX:
+        return load_bundle_template(path, f"playbooks/{name}.md")
+    return load_template_file(path)
+
+def load_playbook(name: str, pack: str = None) -> str:
+    """Load playbook template from core or pack."""
+    return load_template(name, pack=pack).source
+
+def discover_playbooks(pack: str = None) -> list:
+    """Discover available playbooks from core or pack."""
+    if pack:
+        # List playbooks from the pack index
+        return pack_entry(pack)["playbooks"]
+    else:
+        # List core playbooks
+        if not PLAYBOOKS_DIR.exists():
+            return []
+        return sorted([
+            p.stem for p in PLAYBOOKS_DIR.glob("*.md")
+        ])
+
+# ============================================================================
+# VARIABLE INDEX
+# ============================================================================
+
+# Filled in by playbook itself: {{date}}/{{time_utc}} always, {{chunk}}/{{chunks}} with --max-tokens
+BUILTIN_VARS = ("date", "time_utc", "chunk", "chunks")
+
+# playbooks dir -> core variable index loaded from disk
+_vars_indexes = {}
+
+def template_vars(template: Template) -> list:
+    """Return a template's placeholder names, once each, in order of appearance."""
+    return list(OrderedDict.fromkeys(template.keys))
+
+def required_vars(keys: list) -> list:
+    """Return the placeholders a caller must supply (everything but BUILTIN_VARS)."""
+    return [key for key in keys if key not in BUILTIN_VARS]
+
+def vars_index_path() -> Path:
+    """Return the core variable index file for the current PLAYBOOKS_DIR."""
+    import hashlib
+    digest = hashlib.sha1(str(PLAYBOOKS_DIR).encode("utf-8")).hexdigest()[:12]
+    return CACHE_DIR / f"vars-{digest}.json"
+
+def _load_vars_index() -> dict:
+    key = str(PLAYBOOKS_DIR)
+    if key not in _vars_indexes:
+        try:
+            index = json.loads(vars_index_path().read_text(encoding="utf-8"))
+            if index.get("version") != VARS_INDEX_VERSION or index.get("playbooks_dir") != key:
+                raise ValueError("stale index")
+        except (OSError, ValueError):
+            index = {"version": VARS_INDEX_VERSION, "playbooks_dir": key, "playbooks": {}}
+        _vars_indexes[key] = index
+    return _vars_indexes[key]
+
+def refresh_vars_index(name: str = None) -> dict:
+    """Bring the core variable index up to date and return {playbook: entry}.
+
+    Each entry holds the file's [mtime_ns, size] stamp and its placeholder
+    names. Only files whose stamp changed are read and compiled again.
+    With name set, only that playbook is checked.
+    """
+    index = _load_vars_index()
+    entries = index["playbooks"]
+    changed = False
+
+    if name is None:
+        stats = {}
+        if PLAYBOOKS_DIR.is_dir():
+            for e in os.scandir(str(PLAYBOOKS_DIR)):
+                if e.name.endswith(".md") and e.is_file():
+                    stats[e.name[:-3]] = e.stat()
+        for gone in set(entries) - set(stats):
+            del entries[gone]
+            changed = True
+    else:
+        try:
+            stats = {name: (PLAYBOOKS_DIR / f"{name}.md").stat()}
+        except OSError:
+            stats = {}
+            changed = entries.pop(name, None) is not None
+
+    for pb_name, st in stats.items():
+        stamp = [st.st_mtime_ns, st.st_size]
+        entry = entries.get(pb_name)
+        if entry is None or entry["stamp"] != stamp or _partials_stale(entry):
+            entries[pb_name] = _vars_entry(PLAYBOOKS_DIR / f"{pb_name}.md", stamp)
+            changed = True
+
+    if changed:
+        _save_index(vars_index_path(), index)
+    return entries
+
+def _vars_entry(path: Path, stamp: list, key=None) -> dict:
+    """Index entry for one template: its placeholders and the partials it includes.
+
+    A broken include is recorded as an error with no partials, so the entry
+    is retried on every refresh until it compiles.
+    """
+    key = path if key is None else key
+    try:
+        template = load_template_file(path) if key is path else load_bundle_template(*key)
+    except (FileNotFoundError, ValueError) as e:
+        return {"stamp": stamp, "vars": [], "partials": None, "error": str(e)}
+    deps = [[str(dep), list(dep_stamp) if dep_stamp else None] for dep, dep_stamp in _template_files[key][2]]
+    return {"stamp": stamp, "vars": template_vars(template), "partials": deps}
+
+def _partials_stale(entry: dict) -> bool:
+    """Return True if an index entry's template must be compiled again for its partials."""
+    partials = entry.get("partials")
+    return partials != [] and not partials_current(partials)
+
+def playbook_vars(name: str, pack: str = None) -> list:
+    """Return every placeholder of a core or pack playbook from the indexes."""
+    if pack:
+        files = pack_entry(pack)["files"]
+        if name not in files:
+            playbook_path(name, pack=pack)  # raises the usual not-found error
+            raise FileNotFoundError(f"Playbook not found: {pack}/{name}")
+        return files[name]["vars"]
+    entry = refresh_vars_index(name).get(name)
+    if entry is None:
+        raise FileNotFoundError(f"Playbook not found: {PLAYBOOKS_DIR / f'{name}.md'}")
+    return entry["vars"]
+
+def missing_vars(name: str, pack: str, vars_dict: dict, has_input: bool = False) -> list:
+    """Return required placeholders of a playbook that vars_dict does not set.
+
+    {{input}} counts as set when has_input (--input or --stdin was given).
+    """
+    provided = set(vars_dict) | ({"input"} if has_input else set())
+    return [key for key in required_vars(playbook_vars(name, pack)) if key not in provided]
+
+# ============================================================================
+# LIBRARY API
+# ============================================================================
+
+class PlaybookRegistry:
+    """Core and pack playbooks for use as a library.
+
+    Nothing is printed and nothing exits: problems raise FileNotFoundError,
+    ValueError or LicenseError. Compiled templates are kept per registry;
+    with auto_reload a lookup costs a stat or two (plus one per included
+    partial) and a file is recompiled only after it or a partial changes.
+    One registry can be shared by many threads.
+
+        registry = PlaybookRegistry()
+        prompt = registry.render("review_pr", {"repo": "api", "input": diff})
+    """
+
+    def __init__(self, playbooks_dir: Path = None, packs_dir: Path = None, environ: dict = None,
+                 auto_reload: bool = True):
+        import threading
+        self.playbooks_dir = Path(playbooks_dir) if playbooks_dir else PLAYBOOKS_DIR
+        self.packs_dir = Path(packs_dir) if packs_dir else PACKS_DIR
+        self.environ = os.environ if environ is None else environ
+        self.auto_reload = auto_reload
+        self._lock = threading.Lock()  # bundles share one ZipFile
+        self._templates = {}  # (name, pack) -> ((path, stamp), Template, partial deps)
+        self._manifests = {}  # pack -> ((source, stamp), manifest)
+
+    def packs(self) -> list:
+        """Return the names of available packs, from directories and bundles."""
+        if not self.packs_dir.is_dir():
+            return []
+        names = set()
+        for e in os.scandir(str(self.packs_dir)):
+            if e.is_dir() and os.path.isfile(os.path.join(e.path, "meta", "manifest.json")):
+                names.add(e.name)
+            elif e.name.endswith(BUNDLE_SUFFIX) and e.is_file():
+                names.add(e.name[:-len(BUNDLE_SUFFIX)])
+        return sorted(names)
+
+    def playbooks(self, pack: str = None) -> list:
+        """Return the playbook names in pack, or the core playbooks."""
+        if pack:
+            return list(self.manifest(pack)["playbooks"])
+        if not self.playbooks_dir.is_dir():
+            return []
+        return sorted(p.stem for p in self.playbooks_dir.glob("*.md"))
+
+    def _pack_source(self, pack: str) -> Path:
+        """Return the manifest file or bundle that defines pack."""
+        manifest_path = self.packs_dir / pack / "meta" / "manifest.json"
+        if manifest_path.is_file():
+            return manifest_path
+        bundle = self.packs_dir / f"{pack}{BUNDLE_SUFFIX}"
+        if bundle.is_file():
+            return bundle
+        raise FileNotFoundError(
+            f"Pack '{pack}' not found.\n"
+            f"Available packs: {', '.join(self.packs()) or 'none'}"
+        )
+
+    def _read(self, path: Path, member: str = None) -> bytes:
+        if member is None:
+            return path.read_bytes()
+        with self._lock:
+            return read_bundle_member(path, member)
+
+    def manifest(self, pack: str) -> dict:
+        """Return pack's parsed and validated manifest."""
+        source = self._pack_source(pack)
+        key = (source, file_stamp(source))
+        cached = self._manifests.get(pack)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        member = "meta/manifest.json" if source.suffix == BUNDLE_SUFFIX else None
+        try:
+            manifest = json.loads(self._read(source, member).decode("utf-8"))
+        except ValueError as e:
+            raise ValueError(f"Invalid JSON in {source}: {e}")
+        if not isinstance(manifest, dict):
+            raise ValueError(f"Invalid manifest in {source}: expected an object")
+        validate_manifest(manifest, pack, warn=False)
+        self._manifests[pack] = (key, manifest)
+        return manifest
+
+    def template(self, name: str, pack: str = None) -> Template:
+        """Return the compiled Template for a core or pack playbook."""
+        key = (name, pack)
+        cached = self._templates.get(key)
+        if cached is not None and not self.auto_reload:
+            return cached[1]
+
+        member = None
+        if pack:
+            manifest = self.manifest(pack)
+            require_license(manifest, pack, self.environ)
+            if name not in manifest["playbooks"]:
+                raise FileNotFoundError(
+                    f"Playbook '{name}' not available in pack '{pack}'.\n"
+                    f"Available playbooks: {', '.join(manifest['playbooks'])}"
+                )
+            path = self.packs_dir / pack / "playbooks" / f"{name}.md"
+            if not path.is_file() and self._pack_source(pack).suffix == BUNDLE_SUFFIX:
+                path, member = self._pack_source(pack), f"playbooks/{name}.md"
+        else:
+            path = self.playbooks_dir / f"{name}.md"
+
+        stamp = file_stamp(path)
+        if stamp is None:
+            raise FileNotFoundError(f"Playbook not found: {path}")
+        if cached is not None and cached[0] == (path, stamp) and (not cached[2] or partials_current(cached[2])):
+            return cached[1]
+        source = self._read(path, member).decode("utf-8")
+        with self._lock if member else contextlib.nullcontext():
+            template, deps = compile_source(source, (path, member) if member else path, self.playbooks_dir)
+        self._templates[key] = ((path, stamp), template, deps)
+        return template
+
+    def render(self, name: str, vars_dict: dict = None, pack: str = None) -> str:
+        """Render a playbook with vars_dict plus the built-in {{date}}/{{time_utc}}."""
+        vars_dict = dict(vars_dict or {})
+        add_standard_vars(vars_dict)
+        return self.template(name, pack).render(vars_dict)
+
+    def render_to(self, out, name: str, vars_dict: dict = None, pack: str = None) -> int:
+        """Write a rendered playbook to binary file object out; returns bytes written.
+
+        Values may be str or bytes-like (e.g. an mmap of a large input).
+        """
+        vars_dict = dict(vars_dict or {})
+        add_standard_vars(vars_dict)
+        return self.template(name, pack).render_to(out, vars_dict)
+
+# ============================================================================
+# INPUT/OUTPUT UTILITIES
+# ============================================================================
+
+def read_stdin() -> str:
+    """Read content from stdin if available."""
+    if not sys.stdin.isatty():
+        return sys.stdin.read()
+    return ""
+
+# Clipboard commands tried in order: pbcopy (macOS), xclip and xsel (Linux)
+CLIPBOARD_COMMANDS = [
+    ["pbcopy"],
+    ["xclip", "-selection", "clipboard"],
+    ["xsel", "--clipboard", "--input"],
+]
+
+def copy_to_clipboard(content) -> bool:
+    """Copy content (a string, or a Path whose bytes are streamed) to system clipboard."""
+    import subprocess
+    for command in CLIPBOARD_COMMANDS:
+        try:
+            if isinstance(content, Path):
+                with content.open("rb") as fh:
+                    subprocess.run(
+                        command,
+                        stdin=fh,
+                        check=True,
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL
+                    )
+            else:
+                subprocess.run(
+                    command,
+                    input=content.encode("utf-8"),
+                    check=True,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL
+                )
+            return True
+        except (FileNotFoundError, subprocess.CalledProcessError):
+            pass
+
+    print(
+        "Warning: Could not copy to clipboard. "
+        "Install pbcopy (macOS), xclip, or xsel (Linux).",
+        file=sys.stderr
+    )
+    return False
+
+def map_input(path: Path):
+    """Memory-map an input file read-only (empty files map to b"")."""
+    import mmap
+    with path.open("rb") as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+def should_stream(input_file: str) -> bool:
+    """Return True if an --input file is large enough to stream by default."""
+    try:
+        return Path(input_file).expanduser().stat().st_size >= STREAM_THRESHOLD
+    except OSError:
+        return False
+
+def has_glob(value: str) -> bool:
+    """Return True if value contains glob wildcards."""
+    return any(c in value for c in "*?[")
+
+def is_input_pattern(value: str) -> bool:
+    """Return True if an --input value is a glob pattern or a directory.
+
+    An existing file is never a pattern, even if its name contains *, ? or [.
+    """
+    path = Path(value).expanduser()
+    return path.is_dir() or (has_glob(value) and not path.is_file())
+
+def input_base(value: str) -> Path:
+    """Return the directory an --input glob or directory is relative to."""
+    pattern = os.path.expanduser(value)
+    if os.path.isdir(pattern):
+        return Path(pattern)
+    parts = Path(pattern).parts
+    magic = next(i for i, part in enumerate(parts) if has_glob(part))
+    return Path(*parts[:magic]) if magic else Path(".")
+
+def expand_inputs(value: str, recursive: bool = False, include: list = None, exclude: list = None) -> list:
+    """Expand an --input glob or directory into sorted (path, tag) pairs.
+
+    Directories list their files (all descendants with recursive); globs
+    support ** and always recurse through it. Hidden files and directories
+    are skipped. include/exclude are fnmatch patterns matched against the
+    path relative to the directory (or the glob's fixed leading part).
+    The tag, used to name each output, is that relative path with "/"
+    turned into "__".
+    """
+    import fnmatch
+    import glob
+    pattern = os.path.expanduser(value)
+    base = input_base(value)
+    if os.path.isdir(pattern):
+        candidates = base.rglob("*") if recursive else base.iterdir()
+    else:
+        candidates = (Path(match) for match in glob.iglob(pattern, recursive=True))
+
+    matches = []
+    for path in candidates:
+        relative = path.relative_to(base).as_posix()
+        if any(part.startswith(".") for part in relative.split("/")) or not path.is_file():
+            continue
+        if include and not any(fnmatch.fnmatch(relative, p) for p in include):
+            continue
+        if exclude and any(fnmatch.fnmatch(relative, p) for p in exclude):
+            continue
+        matches.append((path.resolve(), re.sub(r"[^A-Za-z0-9._-]", "_", relative.replace("/", "__"))))
+    if not matches:
+        raise FileNotFoundError(f"No input files match: {value}")
+    return sorted(matches)
+
+def read_inputs(paths, workers: int = INPUT_READERS):
+    """Yield (path, text, error) in order while threads read the next files.
+
+    At most 2 * workers files are held in memory at once. error is the
+    OSError/ValueError (e.g. a non-UTF-8 file) that stopped a read.
+    """
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    def read(path):
+        return path.read_text(encoding="utf-8")
+
+    paths = iter(paths)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append((path, pool.submit(read, path)))
+            if len(pending) >= 2 * workers:
+                break
+        while pending:
+            path, future = pending.popleft()
+            upcoming = next(paths, None)
+            if upcoming is not None:
+                pending.append((upcoming, pool.submit(read, upcoming)))
+            try:
+                yield path, future.result(), None
+            except (OSError, ValueError) as e:
+                yield path, None, e
+
+class Tee:
+    """Binary file-like object that writes every chunk to several streams."""
+
+    def __init__(self, *streams):
+        self.streams = [s for s in streams if s is not None]
+
+    def write(self, data) -> int:
+        for stream in self.streams:
+            stream.write(data)
+        return len(data)
+
+# ============================================================================
+# GIT DIFF INPUT
+# ============================================================================
+
+def _git(*args) -> str:
+    """Run a local git command in the current directory and return its stdout."""
+    import subprocess
+    try:
+        proc = subprocess.run(["git", *args], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True)
+    except FileNotFoundError:
+        raise ValueError("--git-diff needs git on PATH")
+    if proc.returncode != 0:
+        raise ValueError(f"git {args[0]} failed: {proc.stderr.strip()}")
+    return proc.stdout
+
+def git_range_trees(rng: str):
+    """Resolve a --git-diff range to the (old, new) tree hashes it compares.
+
+    "A..B" compares A with B and "A...B" the merge base of A and B with B;
+    a missing side means HEAD, as in git. Returns None for a single revision,
+    which is compared with the working tree and has no tree hash.
+    """
+    dots = "..." if "..." in rng else ".." if ".." in rng else None
+    if dots is None:
+        return None
+    left, _, right = rng.partition(dots)
+    left, right = left or "HEAD", right or "HEAD"
+    if left.startswith("-") or right.startswith("-"):
+        raise ValueError(f"Invalid --git-diff range: {rng!r}")
+    if dots == "...":
+        left = _git("merge-base", left, right).strip()
+    old, new = _git("rev-parse", f"{left}^{{tree}}", f"{right}^{{tree}}").split()
+    return old, new
+
+def git_diff_command(revs: list, paths: list = None, stat: bool = False) -> list:
+    """Build a `git diff` command line whose output depends only on the repository."""
+    command = ["git", "diff", "--no-color", "--no-ext-diff", "--no-textconv"]
+    if stat:
+        command.append("--stat")
+    return command + list(revs) + ["--"] + list(paths or [])
+
+def _stream_git_diff(command: list, path: Path):
+    """Copy git's output into path as it arrives, replacing path only on success."""
+    import subprocess
+    import tempfile
+    env = dict(os.environ, GIT_NO_LAZY_FETCH="1", GIT_TERMINAL_PROMPT="0")  # local objects only
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=str(path.parent), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as out, tempfile.TemporaryFile() as err:
+            try:
+                proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=err, env=env)
+            except FileNotFoundError:
+                raise ValueError("--git-diff needs git on PATH")
+            with proc.stdout:
+                for block in iter(functools.partial(proc.stdout.read, STREAM_CHUNK), b""):
+                    out.write(block)
+            if proc.wait() != 0:
+                err.seek(0)
+                raise ValueError(f"git diff failed: {err.read().decode('utf-8', 'replace').strip()}")
+        os.replace(tmp, str(path))
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def _prune_git_diffs(directory: Path, keep: int = GIT_DIFF_CACHE_ENTRIES):
+    """Remove all but the keep most recently used cached diffs."""
+    entries = sorted((e for e in os.scandir(str(directory))
+                      if e.name.endswith(".diff") and not e.name.startswith("worktree-")),
+                     key=lambda e: e.stat().st_mtime_ns, reverse=True)
+    for entry in entries[keep:]:
+        with contextlib.suppress(OSError):
+            os.unlink(entry.path)
+
+@contextlib.contextmanager
+def git_diff_input(rng: str, paths: list = None, stat: bool = False, reuse: bool = True):
+    """Yield a file holding `git diff <range>` output for the current repository.
+
+    git's output is streamed into the file rather than collected in memory,
+    so the job can read it like any --input file (or mmap it for --stream).
+    Committed ranges are cached under CACHE_DIR/git-diff by the tree hashes
+    they compare, the paths and the --stat flag: rerunning a range, even
+    after a rebase that kept the trees, reuses the diff without running git
+    diff. Working-tree diffs are written to a scratch file removed on exit.
+    """
+    import hashlib
+    if not rng or rng.startswith("-"):
+        raise ValueError(f"Invalid --git-diff range: {rng!r}")
+    directory = CACHE_DIR / "git-diff"
+    with trace_span("git-diff", range=rng) as span:
+        trees = git_range_trees(rng)
+        if trees is None:
+            path = directory / f"worktree-{os.getpid()}.diff"
+            hit = False
+            _stream_git_diff(git_diff_command([rng], paths, stat), path)
+        else:
+            # Pathspecs are relative to the current directory inside the repository
+            prefix = _git("rev-parse", "--show-prefix").strip() if paths else ""
+            key = json.dumps([trees, prefix, sorted(paths or []), stat])
+            path = directory / f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}.diff"
+            hit = reuse and path.is_file()
+            if hit:
+                os.utime(str(path))  # most recently used
+            else:
+                _stream_git_diff(git_diff_command(trees, paths, stat), path)
+                _prune_git_diffs(directory)
+        if span is not None:
+            span["cached"] = hit
+    if trees is not None:
+        yield path
+        return
+    try:
+        yield path
+    finally:
+        with contextlib.suppress(OSError):
+            path.unlink()
+
+# ============================================================================
+# INPUT FILTERS
+# ============================================================================
+
+# Lockfiles, vendored and generated files dropped by the drop-generated filter
+GENERATED_PATTERNS = [
+    "package-lock.json", "yarn.lock", "pnpm-lock.yaml", "Cargo.lock", "poetry.lock",
+    "Pipfile.lock", "composer.lock", "Gemfile.lock", "go.sum", "*.min.js", "*.min.css",
+    "*.map", "*.pb.go", "*_pb2.py", "*.generated.*", "vendor/*", "node_modules/*", "dist/*",
+]
+# Core playbooks declare default filters here: {"*": [...], "<playbook>": [...]}
+FILTERS_FILE = "filters.json"
+
+def _diff_path(minus: str, plus: str) -> str:
+    """Return the file path named by a "--- "/"+++ " header pair."""
+    path = plus[4:].split("\t")[0].strip()
+    if path == "/dev/null":
+        path = minus[4:].split("\t")[0].strip()
+    return path[2:] if path[:2] in ("a/", "b/") else path
+
+def _diff_events(lines):
+    """Yield (kind, path, line) for a diff streamed line by line.
+
+    kind is "file" for the first line of a file section (path is that
+    file), "hunk" for an @@ header and None otherwise. Plain unified diffs
+    start a file at "--- " when "+++ " follows, so one line is held back.
+    """
+    git = False
+    held = None
+    for line in lines:
+        if held is not None:
+            if line.startswith("+++ "):
+                yield "file", _diff_path(held, line), held
+            else:
+                yield None, None, held
+            held = None
+        if line.startswith("diff --git "):
+            git = True
+            yield "file", line.rstrip("\n").rpartition(" b/")[2], line
+        elif not git and line.startswith("--- "):
+            held = line
+        elif line.startswith("@@"):
+            yield "hunk", None, line
+        else:
+            yield None, None, line
+    if held is not None:
+        yield None, None, held
+
+def _path_matches(path: str, patterns: list) -> bool:
+    import fnmatch
+    name = path.rpartition("/")[2]
+    return any(fnmatch.fnmatch(path, p) or fnmatch.fnmatch(name, p)
+               or fnmatch.fnmatch(path, "*/" + p) for p in patterns)
+
+def filter_drop_paths(lines, arg: str = None):
+    """Drop diff file sections whose path matches a comma-separated glob list."""
+    if not arg:
+        raise ValueError("Filter 'drop-paths' needs patterns, e.g. drop-paths:*.lock,docs/*")
+    patterns = [p for p in arg.split(",") if p]
+    dropping = False
+    for kind, path, line in _diff_events(lines):
+        if kind == "file":
+            dropping = _path_matches(path, patterns)
+        if not dropping:
+            yield line
+
+def filter_drop_generated(lines, arg: str = None):
+    """Drop diff sections for lockfiles, vendored and generated files."""
+    return filter_drop_paths(lines, ",".join(GENERATED_PATTERNS + ([arg] if arg else [])))
+
+def filter_drop_binary(lines, arg: str = None):
+    """Drop diff file sections that only say a binary file changed."""
+    header = None  # lines of the current file section before its first hunk
+    dropping = False
+    for kind, _, line in _diff_events(lines):
+        if kind == "file":
+            if header:
+                yield from header
+            header, dropping = [line], False
+        elif dropping:
+            continue
+        elif header is None:
+            yield line
+        elif kind == "hunk":
+            yield from header
+            header = None
+            yield line
+        elif line.startswith(("Binary files ", "GIT binary patch")):
+            header, dropping = None, True
+        else:
+            header.append(line)
+    if header:
+        yield from header
+
+def filter_collapse_whitespace(lines, arg: str = None):
+    """Strip trailing whitespace and squeeze runs of blank lines into one."""
+    blank = False
+    for line in lines:
+        stripped = line.rstrip()
+        if not stripped:
+            if blank:
+                continue
+            blank = True
+        else:
+            blank = False
+        yield stripped + "\n" if line.endswith("\n") else stripped
+
+def filter_max_hunk_lines(lines, arg: str = None):
+    """Keep the first N lines of every diff hunk and note how many were cut."""
+    try:
+        limit = int(arg)
+    except (TypeError, ValueError):
+        raise ValueError("Filter 'max-hunk-lines' needs a line count, e.g. max-hunk-lines:200")
+    count = skipped = 0
+    in_hunk = False
+    for kind, _, line in _diff_events(lines):
+        if kind is not None:
+            if skipped:
+                yield f"... [{skipped} more lines truncated]\n"
+            count = skipped = 0
+            in_hunk = kind == "hunk"
+            yield line
+        elif not in_hunk or count < limit:
+            count += 1
+            yield line
+        else:
+            skipped += 1
+    if skipped:
+        yield f"... [{skipped} more lines truncated]\n"
+
+def filter_dedupe(lines, arg: str = None):
+    """Drop lines that repeat the line before them (like uniq)."""
+    previous = None
+    for line in lines:
+        if line != previous:
+            yield line
+        previous = line
+
+# filter name -> generator function(lines, arg); specs are "name" or "name:arg"
+INPUT_FILTERS = OrderedDict([
+    ("drop-paths", filter_drop_paths),
+    ("drop-generated", filter_drop_generated),
+    ("drop-binary", filter_drop_binary),
+    ("collapse-whitespace", filter_collapse_whitespace),
+    ("max-hunk-lines", filter_max_hunk_lines),
+    ("dedupe", filter_dedupe),
+])
+
+def parse_filters(specs: list) -> list:
+    """Turn filter specs ("name" or "name:arg") into stage functions of lines."""
+    if not isinstance(specs, list) or not all(isinstance(spec, str) for spec in specs):
+        raise ValueError("Filters must be a list of strings like \"name\" or \"name:arg\"")
+    stages = []
+    for spec in specs:
+        name, _, arg = spec.partition(":")
+        if name not in INPUT_FILTERS:
+            raise ValueError(f"Unknown filter: {name}\nAvailable filters: {', '.join(INPUT_FILTERS)}")
+        stage = functools.partial(INPUT_FILTERS[name], arg=arg or None)
+        next(iter(stage(iter(()))), None)  # check the argument now, not mid-render
+        stages.append(stage)
+    return stages
+
+def select_filters(config, name: str, source: str) -> list:
+    """Pick a playbook's specs from a filter config: a list, or {"*"/name: list}."""
+    if config is None:
+        return []
+    if isinstance(config, dict):
+        config = config.get(name, config.get("*", []))
+    if not isinstance(config, list):
+        raise ValueError(f"{source}: 'filters' must be a list or an object of lists")
+    return config
+
+# filters.json path -> (mtime_ns, parsed config)
+_filter_configs = {}
+
+def default_filters(name: str, pack: str = None) -> list:
+    """Return the filter specs a playbook or pack declares for its input."""
+    if pack:
+        return select_filters(pack_entry(pack)["manifest"].get("filters"), name, f"Pack '{pack}' manifest")
+    path = PLAYBOOKS_DIR / FILTERS_FILE
+    try:
+        mtime = path.stat().st_mtime_ns
+    except OSError:
+        return []
+    cached = _filter_configs.get(path)
+    if cached is None or cached[0] != mtime:
+        try:
+            cached = (mtime, json.loads(path.read_text(encoding="utf-8")))
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid JSON in {path}: {e}")
+        _filter_configs[path] = cached
+    return select_filters(cached[1], name, str(path))
+
+def job_filters(job: dict) -> list:
+    """Return the filter stages for a job: its own specs, else the playbook's defaults."""
+    specs = job.get("filters")
+    if specs is None:
+        specs = default_filters(job["name"], job["pack"])
+    return parse_filters(specs) if specs else []
+
+def apply_filters(lines, stages: list):
+    """Chain filter stages over an iterable of lines; nothing is buffered whole."""
+    for stage in stages:
+        lines = stage(lines)
+    return lines
+
+def filter_text(text: str, stages: list) -> str:
+    """Run text through filter stages."""
+    if not stages:
+        return text
+    return "".join(apply_filters(iter(text.splitlines(keepends=True)), stages))
+
+def filter_file(path: Path, stages: list) -> str:
+    """Read a text file line by line through filter stages."""
+    with path.open(encoding="utf-8") as fh:
+        return "".join(apply_filters(fh, stages))
+
+def filter_to_map(path: Path, stages: list):
+    """Filter a file into an anonymous temporary file and memory-map it.
+
+    Used by --stream so that filtering a huge input never holds it in memory.
+    """
+    import mmap
+    import tempfile
+    with tempfile.TemporaryFile() as tmp, path.open(encoding="utf-8") as fh:
+        for line in apply_filters(fh, stages):
+            tmp.write(line.encode("utf-8"))
+        tmp.flush()
+        if tmp.tell() == 0:
+            return b""
+        return mmap.mmap(tmp.fileno(), 0, access=mmap.ACCESS_READ)
+
+# ============================================================================
+# INPUT CHUNKING
+# ============================================================================
+
+DIFF_FILE_START = re.compile(r"^diff --git ", re.M)
+SOL_CONTRACT = re.compile(r"^(abstract\s+)?(contract|library|interface)\s+\w+")
+SOL_MEMBER = re.compile(r"^\s+(function|modifier|constructor|fallback|receive)\b")
+SOL_COMMENT = re.compile(r"^\s*(//|/\*|\*)")
+
+def estimate_tokens(text: str) -> int:
+    """Rough, local token estimate: CHARS_PER_TOKEN characters per token."""
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+def input_kind(text: str, path: str = None) -> str:
+    """Guess how to split an input: "diff", "solidity" or "text"."""
+    suffix = Path(path).suffix.lower() if path else ""
+    if suffix in (".diff", ".patch") or DIFF_FILE_START.search(text) or text.startswith("--- "):
+        return "diff"
+    if suffix == ".sol" or any(SOL_CONTRACT.match(line) for line in text.splitlines()):
+        return "solidity"
+    return "text"
+
+def _split_at(text: str, is_start, keep_comments: bool = False) -> tuple:
+    """Split text into units that each begin at a line where is_start(line) is true.
+
+    Returns ("", units). Lines before the first start form their own unit.
+    With keep_comments, comment lines directly above a start move with it.
+    """
+    units, current = [], []
+    for line in text.splitlines(keepends=True):
+        if is_start(line) and current:
+            carried = []
+            while keep_comments and current and SOL_COMMENT.match(current[-1]):
+                carried.insert(0, current.pop())
+            if current:
+                units.append("".join(current))
+            current = carried
+        current.append(line)
+    if current:
+        units.append("".join(current))
+    return "", units
+
+def _split_diff_files(text: str) -> tuple:
+    lines = text.splitlines(keepends=True)
+    if DIFF_FILE_START.search(text):
+        return _split_at(text, lambda line: line.startswith("diff --git "))
+    # Plain unified diff: a file starts at "--- " directly followed by "+++ "
+    starts = {i for i in range(len(lines) - 1)
+              if lines[i].startswith("--- ") and lines[i + 1].startswith("+++ ")}
+    units, current = [], []
+    for i, line in enumerate(lines):
+        if i in starts and current:
+            units.append("".join(current))
+            current = []
+        current.append(line)
+    if current:
+        units.append("".join(current))
+    return "", units
+
+def _split_diff_hunks(text: str) -> tuple:
+    """Split one file's diff into hunks; its header is repeated in every chunk."""
+    _, units = _split_at(text, lambda line: line.startswith("@@"))
+    if len(units) > 1 and not units[0].startswith("@@"):
+        return units[0], units[1:]
+    return "", units
+
+def _split_sol_contracts(text: str) -> tuple:
+    """Split Solidity source per contract; pragmas and imports head every chunk."""
+    _, units = _split_at(text, SOL_CONTRACT.match, keep_comments=True)
+    if len(units) > 1 and not any(SOL_CONTRACT.match(line) for line in units[0].splitlines()):
+        return units[0], units[1:]
+    return "", units
+
+def _split_sol_members(text: str) -> tuple:
+    """Split one contract per function/modifier; its declaration heads every chunk."""
+    _, units = _split_at(text, SOL_MEMBER.match, keep_comments=True)
+    if len(units) > 1 and not any(SOL_MEMBER.match(line) for line in units[0].splitlines()):
+        return units[0], units[1:]
+    return "", units
+
+def _split_paragraphs(text: str) -> tuple:
+    units = re.split(r"(?<=\n\n)(?=[^\n])", text)
+    return "", [unit for unit in units if unit]
+
+def _split_lines(text: str) -> tuple:
+    return "", text.splitlines(keepends=True)
+
+CHUNK_SPLITTERS = {
+    "diff": [_split_diff_files, _split_diff_hunks, _split_lines],
+    "solidity": [_split_sol_contracts, _split_sol_members, _split_lines],
+    "text": [_split_paragraphs, _split_lines],
+}
+
+def chunk_text(text: str, budget: int, kind: str = "text") -> list:
+    """Split text into pieces of at most budget tokens on structural boundaries.
+
+    Units from the kind's coarsest splitter (files, contracts, paragraphs)
+    are packed greedily; a unit that is too big on its own is split again
+    by the next, finer splitter, down to lines and finally raw characters.
+    Context a splitter returns as a header (a diff's file header, a
+    contract's declaration) is repeated at the top of each of its chunks.
+    """
+    if budget <= 0:
+        raise ValueError("No room left for {{input}} within --max-tokens")
+    return _pack(text, budget, CHUNK_SPLITTERS[kind])
+
+def _pack(text: str, budget: int, splitters: list) -> list:
+    if estimate_tokens(text) <= budget:
+        return [text]
+    if not splitters:
+        size = budget * CHARS_PER_TOKEN
+        return [text[i:i + size] for i in range(0, len(text), size)]
+
+    header, units = splitters[0](text)
+    room = budget - estimate_tokens(header)
+    if room <= 0 or (not header and len(units) <= 1):
+        return _pack(text, budget, splitters[1:])
+
+    chunks, current, current_len = [], [], 0
+    limit = room * CHARS_PER_TOKEN
+    for unit in units:
+        if len(unit) > limit:
+            if current:
+                chunks.append(header + "".join(current))
+                current, current_len = [], 0
+            chunks.extend(header + piece for piece in _pack(unit, room, splitters[1:]))
+            continue
+        if current and current_len + len(unit) > limit:
+            chunks.append(header + "".join(current))
+            current, current_len = [], 0
+        current.append(unit)
+        current_len += len(unit)
+    if current:
+        chunks.append(header + "".join(current))
+    return chunks
+
+# ============================================================================
+# OUTPUT STORES
+# ============================================================================
+
+class StoreWriter:
+    """Binary writer to a temp file that its store moves into place on close.
+
+    Use as a context manager; after a clean exit, path is the final file.
+    """
+
+    def __init__(self, store, meta: dict):
+        self.store = store
+        self.meta = meta
+        import tempfile
+        store.root.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=str(store.root), prefix=".tmp-", suffix=".prompt.txt")
+        self.tmp = Path(tmp)
+        self.file = os.fdopen(fd, "wb")
+        if store.hashes:
+            import hashlib
+            self.digest = hashlib.sha256()
+        else:
+            self.digest = None
+        self.size = 0
+        self.path = None
+
+    def write(self, data) -> int:
+        self.file.write(data)
+        if self.digest is not None:
+            self.digest.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.file.close()
+        if exc_type is not None:
+            self.tmp.unlink()
+            return False
+        self.path = self.store.commit(self)
+        return False
+
+class OutputStore:
+    """Base class for places rendered prompts are saved."""
+
+    hashes = False
+
+    def __init__(self, root: Path = None):
+        self.root = root or OUT_DIR
+
+    def writer(self, name: str, pack: str = None, tag: str = None, vars_dict: dict = None) -> StoreWriter:
+        """Open a writer for one prompt; the file appears atomically on close."""
+        meta = {"name": name, "pack": pack, "tag": tag, "vars": vars_dict or {}}
+        return StoreWriter(self, meta)
+
+    def save(self, text: str, name: str, pack: str = None, tag: str = None, vars_dict: dict = None) -> Path:
+        """Save a rendered prompt and return its path."""
+        with self.writer(name, pack, tag, vars_dict) as w:
+            w.write(text.encode("utf-8"))
+        return w.path
+
+    def commit(self, writer: StoreWriter) -> Path:
+        raise NotImplementedError
+
+    def flush(self):
+        """Make every saved prompt visible to readers (no-op for file stores)."""
+
+    def close(self):
+        self.flush()
+
+class FlatStore(OutputStore):
+    """Timestamped files directly in out/ (the default layout).
+
+    Names that already exist get a _2, _3, ... suffix instead of being
+    overwritten; the final name is claimed with a hard link, so concurrent
+    writers cannot both take it.
+    """
+
+    def commit(self, writer: StoreWriter) -> Path:
+        meta = writer.meta
+        base = output_path(meta["name"], meta["pack"], meta["tag"]).name[:-len(".prompt.txt")]
+        base_path = self.root / base
+        attempt = 1
+        while True:
+            suffix = f"_{attempt}" if attempt > 1 else ""
+            final = base_path.with_name(f"{base}{suffix}.prompt.txt")
+            try:
+                os.link(str(writer.tmp), str(final))
+            except FileExistsError:
+                attempt += 1
+                continue
+            except OSError:
+                # Filesystem without hard links: best effort
+                if final.exists():
+                    attempt += 1
+                    continue
+                os.replace(str(writer.tmp), str(final))
+                return final
+            writer.tmp.unlink()
+            return final
+
+class FixedStore(OutputStore):
+    """One stable file per playbook, pack and tag, atomically replaced on each save.
+
+    Used by `playbook watch`, so editors and tail -f keep pointing at the
+    same file.
+    """
+
+    def commit(self, writer: StoreWriter) -> Path:
+        meta = writer.meta
+        pack_suffix = f"_{meta['pack']}" if meta["pack"] else ""
+        tag_suffix = f"_{meta['tag']}" if meta["tag"] else ""
+        final = self.root / f"{meta['name']}{pack_suffix}{tag_suffix}.prompt.txt"
+        os.replace(str(writer.tmp), str(final))
+        return final
+
+class ContentStore(OutputStore):
+    """Content-addressed blobs sharded by hash prefix, plus a run index.
+
+    Each prompt is stored once at objects/ab/cd/<sha256>.prompt.txt and every
+    run appends one JSON line (time, playbook, pack, vars, hash) to
+    index.jsonl. `playbook gc` prunes old runs and unreferenced blobs.
+    """
+
+    hashes = True
+
+    @property
+    def index_path(self) -> Path:
+        return self.root / "index.jsonl"
+
+    def blob_path(self, digest: str) -> Path:
+        return self.root / "objects" / digest[:2] / digest[2:4] / f"{digest}.prompt.txt"
+
+    def commit(self, writer: StoreWriter) -> Path:
+        digest = writer.digest.hexdigest()
+        final = self.blob_path(digest)
+        if final.exists():
+            writer.tmp.unlink()  # identical prompt already stored
+        else:
+            final.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(str(writer.tmp), str(final))
+
+        record = run_record(writer.meta, digest, writer.size)
+        record["path"] = str(final.relative_to(self.root))
+        line = (json.dumps(record) + "\n").encode("utf-8")
+        # One O_APPEND write per record keeps lines whole across processes
+        fd = os.open(str(self.index_path), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+        return final
+
+    def gc(self, keep_days: float = None, keep_last: int = None, dry_run: bool = False) -> tuple:
+        """Drop old index records and unreferenced blobs; return (runs, blobs) removed."""
+        records = []
+        if self.index_path.exists():
+            with self.index_path.open(encoding="utf-8") as fh:
+                records = [json.loads(line) for line in fh if line.strip()]
+
+        kept = records
+        if keep_days is not None:
+            cutoff = time.time() - keep_days * 86400
+            kept = [r for r in kept if _record_timestamp(r) >= cutoff]
+        if keep_last is not None:
+            kept = kept[-keep_last:] if keep_last > 0 else []
+
+        referenced = {r["path"] for r in kept}
+        doomed = []
+        objects = self.root / "objects"
+        if objects.exists():
+            for blob in objects.glob("*/*/*.prompt.txt"):
+                if str(blob.relative_to(self.root)) not in referenced:
+                    doomed.append(blob)
+
+        if not dry_run:
+            tmp = self.index_path.with_suffix(f".{os.getpid()}.tmp")
+            tmp.write_text("".join(json.dumps(r) + "\n" for r in kept), encoding="utf-8")
+            os.replace(str(tmp), str(self.index_path))
+            for blob in doomed:
+                blob.unlink()
+        return len(records) - len(kept), len(doomed)
+
+def run_record(meta: dict, digest: str, size: int) -> dict:
+    """Metadata recorded for one saved prompt (vars minus the input itself)."""
+    return {
+        "time": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "name": meta["name"],
+        "pack": meta["pack"],
+        "tag": meta["tag"],
+        "vars": {k: v for k, v in meta["vars"].items() if k != "input" and isinstance(v, str)},
+        "sha256": digest,
+        "size": size,
+    }
+
+def _record_timestamp(record: dict) -> float:
+    from datetime import timezone
+    when = datetime.strptime(record["time"], "%Y-%m-%dT%H:%M:%SZ")
+    return when.replace(tzinfo=timezone.utc).timestamp()
+
+OUTPUT_STORES = {"flat": FlatStore, "cas": ContentStore}
+
+def open_store(kind: str = None) -> OutputStore:
+    """Return the output store named by kind or $PLAYBOOK_STORE (default flat)."""
+    kind = kind or os.environ.get(STORE_ENV) or "flat"
+    if kind not in OUTPUT_STORES:
+        raise ValueError(f"Unknown output store: {kind}. Use one of: {', '.join(OUTPUT_STORES)}")
+    return OUTPUT_STORES[kind]()
+
+# ============================================================================
+# OUTPUT SINKS
+# ============================================================================
+
+class PromptSink(OutputStore):
+    """Output store that appends every prompt to one file as a record.
+
+    Records are buffered and committed in groups of SINK_GROUP_RECORDS
+    prompts or SINK_GROUP_BYTES of text, and on flush()/close(). save()
+    returns the sink path, which post hooks see as OUT_FILE.
+    """
+
+    suffix = None
+
+    def __init__(self, path: Path = None):
+        super().__init__()
+        self.path = Path(path) if path else self.root / f"prompts{self.suffix}"
+        self.pending = []
+        self.pending_bytes = 0
+
+    def writer(self, name: str, pack: str = None, tag: str = None, vars_dict: dict = None):
+        raise ValueError(f"--stream writes files; it cannot be combined with a {self.suffix[1:]} sink")
+
+    def save(self, text: str, name: str, pack: str = None, tag: str = None, vars_dict: dict = None) -> Path:
+        import hashlib
+        data = text.encode("utf-8")
+        meta = {"name": name, "pack": pack, "tag": tag, "vars": vars_dict or {}}
+        record = run_record(meta, hashlib.sha256(data).hexdigest(), len(data))
+        record["prompt"] = text
+        self.pending.append(record)
+        self.pending_bytes += len(data)
+        if len(self.pending) >= SINK_GROUP_RECORDS or self.pending_bytes >= SINK_GROUP_BYTES:
+            self.flush()
+        return self.path
+
+    def flush(self):
+        if not self.pending:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with trace_span("sink", path=str(self.path), records=len(self.pending), bytes=self.pending_bytes):
+            self.write_records(self.pending)
+        self.pending = []
+        self.pending_bytes = 0
+
+    def write_records(self, records: list):
+        raise NotImplementedError
+
+    def __getstate__(self):
+        # Worker processes get an empty buffer and open their own handles
+        state = dict(self.__dict__)
+        state.update(pending=[], pending_bytes=0)
+        state.pop("_db", None)
+        return state
+
+class JsonlSink(PromptSink):
+    """One JSON object per line, appended with a single write per group."""
+
+    suffix = ".jsonl"
+
+    def write_records(self, records: list):
+        data = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records).encode("utf-8")
+        # O_APPEND keeps each group contiguous when several processes share the file
+        fd = os.open(str(self.path), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+class SqliteSink(PromptSink):
+    """A `prompts` table in an SQLite database, one transaction per group."""
+
+    suffix = ".sqlite"
+    _db = None
+
+    def write_records(self, records: list):
+        import sqlite3
+        if self._db is None:
+            db = sqlite3.connect(str(self.path), timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS prompts ("
+                "id INTEGER PRIMARY KEY, time TEXT NOT NULL, name TEXT NOT NULL, pack TEXT, "
+                "tag TEXT, vars TEXT NOT NULL, sha256 TEXT NOT NULL, size INTEGER NOT NULL, "
+                "prompt TEXT NOT NULL)"
+            )
+            self._db = db
+        rows = [
+            (r["time"], r["name"], r["pack"], r["tag"], json.dumps(r["vars"], ensure_ascii=False),
+             r["sha256"], r["size"], r["prompt"])
+            for r in records
+        ]
+        with self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            self._db.executemany(
+                "INSERT INTO prompts (time, name, pack, tag, vars, sha256, size, prompt) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def close(self):
+        super().close()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+OUTPUT_SINKS = {"jsonl": JsonlSink, "sqlite": SqliteSink}
+
+def open_output(out_format: str = None, store: str = None, path: str = None) -> OutputStore:
+    """Return the sink for out_format ("file" means the store named by store)."""
+    if not out_format or out_format == "file":
+        if path:
+            raise ValueError("--sink needs --out-format jsonl or sqlite")
+        return open_store(store)
+    if out_format not in OUTPUT_SINKS:
+        raise ValueError(f"Unknown output format: {out_format}. Use file or one of: {', '.join(OUTPUT_SINKS)}")
+    if store:
+        raise ValueError(f"--store applies to --out-format file, not {out_format}")
+    return OUTPUT_SINKS[out_format](Path(path).expanduser().resolve() if path else None)
+
+def iter_sink(path: Path):
+    """Yield the records of a .jsonl or .sqlite sink in the order they were written."""
+    path = Path(path)
+    if path.suffix == SqliteSink.suffix:
+        import sqlite3
+        db = sqlite3.connect(str(path))
+        try:
+            columns = ("time", "name", "pack", "tag", "vars", "sha256", "size", "prompt")
+            for row in db.execute(f"SELECT {', '.join(columns)} FROM prompts ORDER BY id"):
+                record = dict(zip(columns, row))
+                record["vars"] = json.loads(record["vars"])
+                yield record
+        finally:
+            db.close()
+        return
+    with path.open(encoding="utf-8") as fh:
+        for line in fh:
+            if line.strip():
+                yield json.loads(line)
+
+# ============================================================================
+# RENDER CACHE
+# ============================================================================
+
+def render_key(template: Template, name: str, pack: str, vars_dict: dict) -> str:
+    """Content address of a render: template text plus the vars it uses.
+
+    Only variables the template references are hashed. The key is taken
+    after {{date}} is filled in, so a cached prompt is reused the same UTC
+    day only; run_job does not cache templates that use {{time_utc}}.
+    """
+    import hashlib
+    used = set(template.keys)
+    digest = hashlib.sha256()
+    digest.update(json.dumps([name, pack]).encode("utf-8"))
+    digest.update(hashlib.sha256(template.source.encode("utf-8")).digest())
+    canonical = {k: v for k, v in vars_dict.items() if k in used}
+    digest.update(json.dumps(canonical, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    return digest.hexdigest()
+
+def cache_limit(env_name: str, default: int) -> int:
+    """Read a numeric render cache limit from the environment."""
+    raw = os.environ.get(env_name)
+    if not raw:
+        return default
+    try:
+        return int(raw)
+    except ValueError:
+        raise ValueError(f"Invalid {env_name}: {raw}. Use a whole number")
+
+class RenderCache:
+    """Content-addressed store of rendered prompts with LRU eviction.
+
+    Entries live in one SQLite file under CACHE_DIR. last_used is a logical
+    clock bumped on every hit, and entries are evicted, least recently used
+    first, once the cache holds more than max_entries prompts
+    or max_bytes of prompt text. Cache failures never fail a run.
+    """
+
+    def __init__(self, path: Path = None, max_entries: int = None, max_bytes: int = None):
+        self.path = path or CACHE_DIR / "renders.sqlite"
+        self.max_entries = cache_limit(RENDER_CACHE_ENTRIES_ENV, RENDER_CACHE_ENTRIES) \
+            if max_entries is None else max_entries
+        self.max_bytes = cache_limit(RENDER_CACHE_BYTES_ENV, RENDER_CACHE_BYTES) \
+            if max_bytes is None else max_bytes
+        self._db = None
+
+    def _connect(self):
+        if self._db is None:
+            import sqlite3
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(str(self.path), timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS renders ("
+                "key TEXT PRIMARY KEY, prompt TEXT NOT NULL, size INTEGER NOT NULL, "
+                "out_file TEXT, last_used INTEGER NOT NULL)"
+            )
+            self._db = db
+        return self._db
+
+    def get(self, key: str):
+        """Return (prompt, out_file or None) for key, or None on a miss."""
+        import sqlite3
+        try:
+            db = self._connect()
+            row = db.execute("SELECT prompt, out_file FROM renders WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE renders SET last_used = (SELECT MAX(last_used) + 1 FROM renders) WHERE key = ?",
+                (key,),
+            )
+        except (OSError, sqlite3.Error):
+            return None
+        return row[0], Path(row[1]) if row[1] else None
+
+    def put(self, key: str, prompt: str, out_file: Path = None):
+        """Remember a rendered prompt, then evict down to the size limits."""
+        import sqlite3
+        size = len(prompt.encode("utf-8"))
+        if size > self.max_bytes or self.max_entries <= 0:
+            return
+        try:
+            db = self._connect()
+            db.execute(
+                "INSERT OR REPLACE INTO renders (key, prompt, size, out_file, last_used) "
+                "VALUES (?, ?, ?, ?, (SELECT COALESCE(MAX(last_used), 0) + 1 FROM renders))",
+                (key, prompt, size, str(out_file) if out_file else None),
+            )
+            self.evict()
+        except (OSError, sqlite3.Error):
+            pass
+
+    def evict(self):
+        """Drop least recently used entries beyond max_entries/max_bytes."""
+        db = self._connect()
+        count, total = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM renders").fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        doomed = []
+        for key, size in db.execute("SELECT key, size FROM renders ORDER BY last_used"):
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            doomed.append((key,))
+            count -= 1
+            total -= size
+        db.executemany("DELETE FROM renders WHERE key = ?", doomed)
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+def open_render_cache(disabled: bool = False):
+    """Return a RenderCache unless disabled by flag or PLAYBOOK_NO_CACHE."""
+    if disabled or os.environ.get(NO_CACHE_ENV, "") not in ("", "0"):
+        return None
+    return RenderCache()
+
+# ============================================================================
+# RUN PIPELINE
+# ============================================================================
+
+def batch_errors() -> tuple:
+    """Errors reported per job by `playbook batch` instead of aborting the batch."""
+    import subprocess
+    return (OSError, ValueError, subprocess.CalledProcessError)
+
+def make_job(name: str, pack: str = None, vars_dict: dict = None, input_path: str = None,
+             filters: list = None) -> dict:
+    """Build a normalized job description for run_job.
+
+    filters is a list of input filter specs; None uses the playbook's defaults.
+    """
+    return {
+        "name": name,
+        "pack": pack or None,
+        "vars": dict(vars_dict or {}),
+        "input": input_path or None,
+        "filters": filters,
+    }
+
+def parse_job(line: str) -> dict:
+    """Parse one line of a batch job file into a job description."""
+    try:
+        data = json.loads(line)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Invalid JSON in job: {e}")
+    if not isinstance(data, dict):
+        raise ValueError("Job must be a JSON object")
+
+    name = data.get("name")
+    if not isinstance(name, str) or not name:
+        raise ValueError("Job missing required field: name")
+
+    raw_vars = data.get("vars", {})
+    if isinstance(raw_vars, list):
+        vars_dict = parse_vars(raw_vars)
+    elif isinstance(raw_vars, dict):
+        vars_dict = {str(k): str(v) for k, v in raw_vars.items()}
+    else:
+        raise ValueError("Job field 'vars' must be an object or a list of key=value strings")
+
+    filters = data.get("filters")
+    if filters is not None:
+        parse_filters(filters)
+
+    return make_job(name, pack=data.get("pack"), vars_dict=vars_dict, input_path=data.get("input"),
+                    filters=filters)
+
+def job_error_message(error: BaseException) -> str:
+    """Describe a per-job failure for the batch report."""
+    import subprocess
+    if isinstance(error, subprocess.CalledProcessError):
+        return f"Hook failed with exit code {error.returncode}: {error.cmd}"
+    return str(error)
+
+def add_standard_vars(vars_dict: dict):
+    """Fill in the built-in {{date}} and {{time_utc}} variables."""
+    vars_dict.setdefault("date", datetime.utcnow().strftime("%Y-%m-%d"))
+    vars_dict.setdefault("time_utc", datetime.utcnow().strftime("%H:%M:%S"))
+
+def hook_env_limit() -> int:
+    """Return the largest variable (in bytes) passed to hooks by value."""
+    raw = os.environ.get(HOOK_ENV_MAX_ENV)
+    if not raw:
+        return HOOK_ENV_MAX
+    try:
+        return int(raw)
+    except ValueError:
+        raise ValueError(f"Invalid {HOOK_ENV_MAX_ENV}: {raw}. Use a size in bytes")
+
+@contextlib.contextmanager
+def hook_env(name: str, pack: str, vars_dict: dict, files: dict = None):
+    """Yield the environment passed to hook scripts.
+
+    Variables larger than hook_env_limit() are not copied into the
+    environment. Hooks get PB_<VAR>_FILE and PB_<VAR>_SIZE instead, pointing
+    at the file the value came from (files maps var -> Path) or at a private
+    temp file that is removed when the context exits. Streamed inputs
+    (memory maps or bytes) are passed the same way.
+    """
+    import mmap
+    env = os.environ.copy()
+    env["PLAYBOOK_NAME"] = name
+    if pack:
+        env["PB_PACK"] = pack
+
+    limit = hook_env_limit()
+    spill_dir = None
+    try:
+        for k, v in vars_dict.items():
+            env_key = f"PB_{k.upper()}"
+            if isinstance(v, str) and len(v) <= limit and len(v.encode("utf-8")) <= limit:
+                env[env_key] = v
+                continue
+            mapped = isinstance(v, (bytes, mmap.mmap))
+            if mapped and len(v) <= limit:
+                env[env_key] = bytes(v).decode("utf-8", errors="replace")
+                continue
+
+            source = (files or {}).get(k)
+            if source is not None:
+                size = source.stat().st_size
+            elif isinstance(v, str) or mapped:
+                if spill_dir is None:
+                    import tempfile
+                    spill_dir = tempfile.mkdtemp(prefix="playbook-hook-")
+                source = Path(spill_dir) / k
+                data = v.encode("utf-8") if isinstance(v, str) else v
+                source.write_bytes(data)
+                size = len(data)
+            else:
+                continue
+            env[f"{env_key}_FILE"] = str(source)
+            env[f"{env_key}_SIZE"] = str(size)
+
+        yield env
+    finally:
+        if spill_dir is not None:
+            import shutil
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+def output_path(name: str, pack: str = None, tag: str = None) -> Path:
+    """Return the timestamped output path for a rendered prompt."""
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    pack_suffix = f"_{pack}" if pack else ""
+    tag_suffix = f"_{tag}" if tag else ""
+    return OUT_DIR / f"{timestamp}_{name}{pack_suffix}{tag_suffix}.prompt.txt"
+
+class TemplateLoader:
+    """Memoizing wrapper around load_template for multi-job runs."""
+
+    def __init__(self):
+        self.templates = {}
+
+    def __call__(self, name: str, pack: str = None) -> Template:
+        key = (name, pack)
+        if key not in self.templates:
+            self.templates[key] = load_template(name, pack=pack)
+        return self.templates[key]
+
+def run_job(job: dict, load=load_template, print_only: bool = False, hooks: bool = True,
+            tag: str = None, stream=None, cache=None, store: OutputStore = None):
+    """Render one job exactly like `playbook run` and return (rendered, out_file).
+
+    If stream is a binary file object, --input is memory-mapped and the prompt
+    is written to stream and the output file in a single pass; rendered is
+    then None because the full prompt is never built in memory.
+
+    With a RenderCache, a job seen before returns the cached prompt without
+    rendering; the flat store also reuses the earlier output file, other
+    stores save the prompt again. Prompts are
+    saved to store (default: a FlatStore in OUT_DIR). hooks="pre" runs only
+    the pre hooks, for --hook-mode batch.
+    """
+    name, pack = job["name"], job["pack"]
+    store = store or FlatStore()
+    vars_dict = dict(job["vars"])
+    files = {}
+
+    with contextlib.ExitStack() as cleanup:
+        stages = job_filters(job)
+        if job["input"] and "input" not in vars_dict:
+            input_path = Path(job["input"]).expanduser().resolve()
+            with trace_span("input", path=str(input_path), mapped=stream is not None,
+                            filters=len(stages)) as span:
+                if stream is not None:
+                    input_map = filter_to_map(input_path, stages) if stages else map_input(input_path)
+                    if not isinstance(input_map, bytes):
+                        cleanup.callback(input_map.close)
+                    vars_dict["input"] = input_map
+                elif job.get("input_text") is not None:
+                    # read ahead by read_inputs
+                    vars_dict["input"] = filter_text(job["input_text"], stages)
+                elif stages:
+                    vars_dict["input"] = filter_file(input_path, stages)
+                else:
+                    vars_dict["input"] = input_path.read_text(encoding="utf-8")
+                if span is not None:
+                    span["bytes"] = input_path.stat().st_size
+            if not stages:
+                # Hooks read a large input from its file; filtered text is spilled by hook_env
+                files["input"] = input_path
+        elif stages and isinstance(vars_dict.get("input"), str):
+            with trace_span("filter", filters=len(stages)):
+                vars_dict["input"] = filter_text(vars_dict["input"], stages)
+
+        # Add standard vars ({{date}} is part of the render cache key)
+        fixed_time = "time_utc" in vars_dict
+        add_standard_vars(vars_dict)
+
+        pre_hooks = bool(hooks) and has_hooks("pre", pack)
+        post_hooks = bool(hooks) and hooks != "pre" and has_hooks("post", pack)
+
+        # Serve repeated jobs from the render cache. A hit skips hooks, so jobs
+        # with hooks always render, as do templates stamped with {{time_utc}}
+        template = cache_key = None
+        if cache is not None and stream is None and not (pre_hooks or post_hooks):
+            with trace_span("load", playbook=name, pack=pack):
+                template = load(name, pack=pack)
+            if isinstance(template, Template) and (fixed_time or "time_utc" not in template.keys):
+                with trace_span("cache", playbook=name, pack=pack) as span:
+                    cache_key = render_key(template, name, pack, vars_dict)
+                    hit = cache.get(cache_key)
+                    if span is not None:
+                        span["hit"] = hit is not None
+                if hit is not None:
+                    rendered, out_file = hit
+                    # Content stores and sinks record every run, cached or not;
+                    # only the flat layout reuses the earlier file
+                    flat = isinstance(store, FlatStore)
+                    if not print_only and (not flat or out_file is None or not out_file.exists()):
+                        with trace_span("write", store=type(store).__name__):
+                            out_file = store.save(rendered, name, pack, tag, job["vars"])
+                        if flat:
+                            cache.put(cache_key, rendered, out_file)
+                    return rendered, out_file or output_path(name, pack, tag)
+
+        # Prepare env for hooks (large values are passed by file), only if one will run
+        env = None
+        if pre_hooks or post_hooks:
+            env = cleanup.enter_context(hook_env(name, pack, vars_dict, files))
+
+        # Run pre hooks
+        if pre_hooks:
+            run_hooks("pre", pack, env, vars_dict)
+
+        # Load and render template, saving output unless print-only
+        if template is None:
+            with trace_span("load", playbook=name, pack=pack):
+                template = load(name, pack=pack)
+        out_file = output_path(name, pack, tag)
+        if stream is None:
+            with trace_span("render", playbook=name, pack=pack) as span:
+                rendered = template.render(vars_dict)
+                if span is not None:
+                    span["bytes"] = len(rendered.encode("utf-8"))
+            if not print_only:
+                with trace_span("write", store=type(store).__name__):
+                    out_file = store.save(rendered, name, pack, tag, vars_dict)
+        else:
+            rendered = None
+            with trace_span("render", playbook=name, pack=pack, streamed=True) as span:
+                if print_only:
+                    written = template.render_to(stream, vars_dict)
+                else:
+                    with store.writer(name, pack, tag, vars_dict) as writer:
+                        written = template.render_to(Tee(writer, stream), vars_dict)
+                    out_file = writer.path
+                if span is not None:
+                    span["bytes"] = written
+
+        # Run post hooks (can read OUT_FILE); hooks="pre" leaves them to run_batch_hooks
+        if post_hooks:
+            store.flush()
+            env["OUT_FILE"] = str(out_file)
+            run_hooks("post", pack, env, vars_dict, out_file)
+
+        if cache_key is not None:
+            cache.put(cache_key, rendered, None if print_only else out_file)
+
+    return rendered, out_file
+
+# ============================================================================
+# PARALLEL EXECUTION
+# ============================================================================
+
+def resolve_workers(jobs) -> int:
+    """Translate a --jobs value into a worker count (0 means all cores)."""
+    if jobs is None:
+        return 1
+    if jobs < 0:
+        raise ValueError(f"Invalid --jobs value: {jobs}. Use 0 for all cores")
+    return jobs or os.cpu_count() or 1
+
+def run_batch_item(item, load, print_only: bool = False, hooks: bool = True, cache=None,
+                   store: OutputStore = None) -> dict:
+    """Run one (line_no, line) batch item and return its result record."""
+    line_no, line = item
+    result = {"line": line_no}
+    try:
+        with trace_span("job", line=line_no):
+            job = parse_job(line)
+            result.update(name=job["name"], pack=job["pack"])
+            rendered, out_file = run_job(job, load=load, print_only=print_only, hooks=hooks,
+                                         tag=str(line_no), cache=cache, store=store)
+    except batch_errors() as e:
+        result.update(status="error", error=job_error_message(e))
+    else:
+        result.update(status="ok", out_file=None if print_only else str(out_file))
+        if print_only:
+            result["prompt"] = rendered
+    return result
+
+def iter_fanout_results(job: dict, inputs: list, print_only: bool = False, hooks: bool = True,
+                        cache=None, store: OutputStore = None, max_tokens: int = None,
+                        chunk_by: str = "auto"):
+    """Run job once per (path, tag) input in this process and yield result records.
+
+    Files are read ahead on threads by read_inputs; each output is tagged
+    with the input's tag so its name follows the input path. With
+    max_tokens, each file is chunked and yields one record per chunk.
+    """
+    loader = TemplateLoader()
+    tags = dict(inputs)
+    for path, text, error in read_inputs(path for path, _ in inputs):
+        result = {"input": str(path), "name": job["name"], "pack": job["pack"]}
+        file_job = dict(job, input=str(path), input_text=text)
+        if max_tokens and error is None:
+            for chunk_result in iter_chunk_results(file_job, max_tokens, chunk_by, load=loader,
+                                                   print_only=print_only, hooks=hooks, cache=cache,
+                                                   store=store, tag=tags[path]):
+                yield dict(result, **chunk_result)
+            continue
+        try:
+            with trace_span("job", input=str(path)):
+                if error is not None:
+                    raise error
+                rendered, out_file = run_job(file_job, load=loader, print_only=print_only, hooks=hooks,
+                                             tag=tags[path], cache=cache, store=store)
+        except batch_errors() as e:
+            result.update(status="error", error=job_error_message(e))
+        else:
+            result.update(status="ok", out_file=None if print_only else str(out_file))
+            if print_only:
+                result["prompt"] = rendered
+        yield result
+
+def plan_chunks(job: dict, template: Template, max_tokens: int, chunk_by: str = "auto") -> list:
+    """Split job's {{input}} so that every rendered prompt fits max_tokens.
+
+    The template is rendered with an empty {{input}} to measure its
+    overhead; the rest of the budget goes to the input. Returns one job per
+    chunk, each with {{input}}, {{chunk}} and {{chunks}} set.
+    """
+    text, path = job["vars"].get("input"), None
+    if text is None and job["input"]:
+        path = job["input"]
+        text = job.get("input_text")
+        if text is None:
+            text = Path(path).expanduser().read_text(encoding="utf-8")
+    text = filter_text(text or "", job_filters(job))
+    kind = input_kind(text, path) if chunk_by == "auto" else chunk_by
+
+    # {{chunk}}/{{chunks}} grow with the chunk count, so probe with that many
+    # digits and split again if the count needs more of them
+    width = 1
+    while True:
+        probe = dict(job["vars"], input="", chunk="9" * width, chunks="9" * width)
+        add_standard_vars(probe)
+        overhead = estimate_tokens(template.render(probe))
+        try:
+            pieces = chunk_text(text, max_tokens - overhead, kind)
+        except ValueError:
+            raise ValueError(f"Playbook '{job['name']}' needs ~{overhead} tokens before {{{{input}}}}; "
+                             f"--max-tokens {max_tokens} leaves no room for input")
+        if len(str(len(pieces))) <= width:
+            break
+        width = len(str(len(pieces)))
+
+    total = str(len(pieces))
+    return [dict(job, input=None, input_text=None, filters=[],
+                 vars=dict(job["vars"], input=piece, chunk=str(i), chunks=total))
+            for i, piece in enumerate(pieces, 1)]
+
+def iter_chunk_results(job: dict, max_tokens: int, chunk_by: str = "auto", load=load_template,
+                       print_only: bool = False, hooks: bool = True, cache=None,
+                       store: OutputStore = None, tag: str = None):
+    """Run job once per chunk of its {{input}} and yield result records.
+
+    Each chunk's output is tagged partIofN (after tag, if given). If the
+    input cannot be chunked, a single error record is yielded.
+    """
+    try:
+        with trace_span("chunk", playbook=job["name"], max_tokens=max_tokens) as span:
+            chunk_jobs = plan_chunks(job, load(job["name"], pack=job["pack"]), max_tokens, chunk_by)
+            if span is not None:
+                span["chunks"] = len(chunk_jobs)
+    except batch_errors() as e:
+        yield {"name": job["name"], "pack": job["pack"], "status": "error", "error": job_error_message(e)}
+        return
+
+    for chunk_job in chunk_jobs:
+        chunk, chunks = chunk_job["vars"]["chunk"], chunk_job["vars"]["chunks"]
+        part = f"part{chunk}of{chunks}"
+        result = {"name": job["name"], "pack": job["pack"], "chunk": int(chunk), "chunks": int(chunks)}
+        try:
+            with trace_span("job", chunk=int(chunk)):
+                rendered, out_file = run_job(chunk_job, load=load, print_only=print_only, hooks=hooks,
+                                             tag=f"{tag}_{part}" if tag else part, cache=cache, store=store)
+        except batch_errors() as e:
+            result.update(status="error", error=job_error_message(e))
+        else:
+            result.update(status="ok", tokens=estimate_tokens(rendered),
+                          out_file=None if print_only else str(out_file))
+            if print_only:
+                result["prompt"] = rendered
+        yield result
+
+class PreloadedTemplates:
+    """Template lookup for worker processes, filled once by the parent."""
+
+    def __init__(self, templates: dict, errors: dict):
+        self.templates = templates
+        self.errors = errors
+
+    def __call__(self, name: str, pack: str = None) -> Template:
+        key = (name, pack)
+        if key in self.errors:
+            raise ValueError(self.errors[key])
+        if key not in self.templates:
+            return load_template(name, pack=pack)
+        return self.templates[key]
+
+def preload_templates(items) -> PreloadedTemplates:
+    """Load every distinct template referenced by the batch items once."""
+    loader = TemplateLoader()
+    errors = {}
+    for _, line in items:
+        try:
+            job = parse_job(line)
+        except ValueError:
+            continue  # reported by the worker
+        key = (job["name"], job["pack"])
+        if key in errors:
+            continue
+        try:
+            loader(*key)
+        except batch_errors() as e:
+            errors[key] = job_error_message(e)
+    return PreloadedTemplates(loader.templates, errors)
+
+# Per-process state installed by _init_worker.
+_worker_state = {}
+
+def _init_worker(paths: dict, templates: PreloadedTemplates, print_only: bool, hooks: bool, cache: bool,
+                 store: OutputStore, tracing: tuple = None):
+    """Process pool initializer: receive directories and templates once."""
+    globals().update(paths)
+    _worker_state.update(load=templates, print_only=print_only, hooks=hooks,
+                         cache=open_render_cache(not cache), store=store)
+    # Commit a sink's last partial group (and trace spans) when the worker exits
+    from multiprocessing.util import Finalize
+    Finalize(store, store.close, exitpriority=10)
+    global _tracer
+    if tracing is not None:
+        _tracer = Tracer(*tracing)
+        Finalize(_tracer, _tracer.flush, exitpriority=10)
+
+def _worker_run(item) -> dict:
+    """Process pool task: run one batch item with the worker's templates."""
+    return run_batch_item(item, **_worker_state)
+
+def iter_batch_results(items: list, workers: int = 1, print_only: bool = False, hooks: bool = True,
+                       cache: bool = False, store: OutputStore = None):
+    """Yield batch result records in input order, optionally in parallel."""
+    store = store or FlatStore()
+    if workers <= 1 or len(items) <= 1:
+        loader = TemplateLoader()
+        render_cache = open_render_cache(not cache)
+        try:
+            for item in items:
+                yield run_batch_item(item, load=loader, print_only=print_only, hooks=hooks,
+                                     cache=render_cache, store=store)
+        finally:
+            store.flush()
+            if render_cache:
+                render_cache.close()
         return
-    subprocess.run([str(path)], check=True, env=env)
 
-def render(template: str, vars_dict: dict) -> str:
-    """Substitute {{variables}} in template with values from vars_dict."""
-    def repl(m):
-        key = m.group(1)
-        return vars_dict.get(key, m.group(0))
-    return VAR_PATTERN.sub(repl, template)
+    from concurrent.futures import ProcessPoolExecutor
+
+    paths = {
+        "CACHE_DIR": CACHE_DIR,
+        "PLAYBOOKS_DIR": PLAYBOOKS_DIR,
+        "PACKS_DIR": PACKS_DIR,
+        "HOOKS_DIR": HOOKS_DIR,
+        "OUT_DIR": OUT_DIR,
+    }
+    templates = preload_templates(items)
+    workers = min(workers, len(items))
+    chunksize = max(1, min(64, len(items) // (workers * 4)))
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(paths, templates, print_only, hooks, cache, store,
+                  (_tracer.out, False, _tracer.origin) if _tracer is not None else None),
+    ) as pool:
+        # map() yields in submission order, so output stays deterministic
+        for result in pool.map(_worker_run, items, chunksize=chunksize):
+            yield result
 
 # ============================================================================
-# PACK MANAGEMENT
+# RENDER DAEMON
 # ============================================================================
 
-def load_manifest(pack_name: str) -> dict:
-    """Load and parse pack manifest.json."""
-    manifest_path = PACKS_DIR / pack_name / "meta" / "manifest.json"
-    if not manifest_path.exists():
-        raise FileNotFoundError(
-            f"Pack '{pack_name}' not found.\n"
-            f"Expected manifest at: {manifest_path}\n"
-            f"Available packs: {', '.join(discover_packs()) or 'none'}"
-        )
+def daemon_socket_path() -> Path:
+    """Return the Unix socket used by `playbook serve`."""
+    if os.environ.get(SOCKET_ENV):
+        return Path(os.environ[SOCKET_ENV]).expanduser()
+    return CACHE_DIR / "serve.sock"
 
+def daemon_request_env(pack: str = None) -> dict:
+    """Environment forwarded to the daemon for pack's license check."""
+    if not pack:
+        return {}
     try:
-        return json.loads(manifest_path.read_text(encoding="utf-8"))
-    except json.JSONDecodeError as e:
-        raise ValueError(f"Invalid JSON in {manifest_path}: {e}")
+        manifest = pack_entry(pack)["manifest"]
+    except (OSError, ValueError):
+        return {}  # the daemon reports the same error
+    license_env = manifest.get("license_env", "PLAYBOOK_LICENSE_KEY")
+    return {license_env: os.environ[license_env]} if license_env in os.environ else {}
 
-def validate_manifest(manifest: dict, pack_name: str):
-    """Validate pack manifest structure."""
-    required_fields = ["name", "version", "playbooks"]
-    for field in required_fields:
-        if field not in manifest:
-            raise ValueError(
-                f"Pack '{pack_name}' manifest missing required field: {field}\n"
-                f"Required fields: {', '.join(required_fields)}"
-            )
+def serve_request(request: dict) -> dict:
+    """Handle one render request and return the response message."""
+    try:
+        if request.get("root", str(ROOT)) != str(ROOT):
+            return {"ok": False, "local": True, "error": f"Daemon serves {ROOT}"}
+        name = request.get("name")
+        if not isinstance(name, str) or not name:
+            raise ValueError("Request missing required field: name")
 
-    if not isinstance(manifest["playbooks"], list):
-        raise ValueError(
-            f"Pack '{pack_name}' manifest field 'playbooks' must be an array"
-        )
+        template = load_template(name, pack=request.get("pack"), environ=request.get("env", {}))
+        vars_dict = dict(request.get("vars") or {})
+        if "input" not in vars_dict and request.get("input_path"):
+            vars_dict["input"] = Path(request["input_path"]).read_text(encoding="utf-8")
+        return {"ok": True, "prompt": template.render(vars_dict)}
+    except LicenseError as e:
+        # The client's own environment decides, so let it render locally
+        return {"ok": False, "local": True, "error": str(e)}
+    except batch_errors() as e:
+        return {"ok": False, "error": str(e), "not_found": isinstance(e, FileNotFoundError)}
 
-    if manifest["name"] != pack_name:
-        print(
-            f"Warning: Pack directory name '{pack_name}' "
-            f"doesn't match manifest name '{manifest['name']}'",
-            file=sys.stderr
-        )
+@functools.lru_cache(maxsize=None)
+def daemon_server_classes() -> tuple:
+    """Return (RenderServer, RenderHandler), importing socketserver on first use."""
+    import socketserver
 
-def check_license(manifest: dict, pack_name: str):
-    """Check if pack requires license and validate."""
-    if not manifest.get("requires_license", False):
-        return
+    class RenderHandler(socketserver.StreamRequestHandler):
+        """Answer newline-delimited JSON render requests on one connection."""
 
-    license_env = manifest.get("license_env", "PLAYBOOK_LICENSE_KEY")
-    if not os.environ.get(license_env):
-        license_url = manifest.get("license_url", "")
-        print(f"\nError: Pack '{pack_name}' requires a license.", file=sys.stderr)
-        print(f"Set environment variable: {license_env}", file=sys.stderr)
-        if license_url:
-            print(f"Get a license at: {license_url}", file=sys.stderr)
-        print(f"\nExample: export {license_env}=\"your-license-key\"", file=sys.stderr)
-        sys.exit(1)
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("Request must be a JSON object")
+                except ValueError as e:
+                    response = {"ok": False, "error": f"Invalid request: {e}"}
+                else:
+                    response = serve_request(request)
+                self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+                self.wfile.flush()
 
-def discover_packs() -> list:
-    """Return list of available pack names."""
-    if not PACKS_DIR.exists():
-        return []
-    return [p.name for p in PACKS_DIR.iterdir() if p.is_dir() and (p / "meta" / "manifest.json").exists()]
+    class RenderServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        """Threaded Unix socket server sharing this process's template caches."""
+        daemon_threads = True
+
+    return RenderServer, RenderHandler
+
+def warm_caches():
+    """Load every core and pack template so the first requests are hot."""
+    for name in discover_playbooks():
+        try:
+            load_template(name)
+        except batch_errors():
+            pass
+    for pack, entry in refresh_pack_index().items():
+        for name in entry.get("files", {}):
+            try:
+                if "bundle" in entry:
+                    load_bundle_template(PACKS_DIR / entry["bundle"], f"playbooks/{name}.md")
+                else:
+                    load_template_file(PACKS_DIR / pack / "playbooks" / f"{name}.md")
+            except batch_errors():
+                pass
+
+class DaemonClient:
+    """Connection to a running `playbook serve`, used by `playbook run`."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = sock.makefile("rb")
+
+    @classmethod
+    def connect(cls, path: Path = None):
+        """Return a client for a running daemon, or None if there is none."""
+        if path is None:
+            if os.environ.get(NO_DAEMON_ENV):
+                return None
+            path = daemon_socket_path()
+        if not path.exists():
+            return None
+        import socket
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(DAEMON_TIMEOUT)
+        try:
+            sock.connect(str(path))
+        except OSError:
+            sock.close()
+            return None
+        return cls(sock)
+
+    def request(self, message: dict) -> dict:
+        """Send one request and wait for its response."""
+        self.sock.sendall(json.dumps(message).encode("utf-8") + b"\n")
+        line = self.reader.readline()
+        if not line:
+            raise OSError("Daemon closed the connection")
+        return json.loads(line)
+
+    def load(self, name: str, pack: str = None):
+        """Template loader for run_job that renders through the daemon."""
+        return DaemonTemplate(self, name, pack)
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+class DaemonTemplate:
+    """Stand-in for Template whose render() is answered by the daemon."""
+
+    def __init__(self, client: DaemonClient, name: str, pack: str = None):
+        self.client = client
+        self.name = name
+        self.pack = pack
+
+    def render(self, vars_dict: dict) -> str:
+        try:
+            response = self.client.request({
+                "root": str(ROOT),
+                "name": self.name,
+                "pack": self.pack,
+                "vars": vars_dict,
+                "env": daemon_request_env(self.pack),
+            })
+        except (OSError, ValueError):
+            response = {"ok": False, "local": True}
+        if response.get("ok"):
+            return response["prompt"]
+        if response.get("local"):
+            # Daemon unusable for this request: render in this process instead
+            return load_template(self.name, pack=self.pack).render(vars_dict)
+        if response.get("not_found"):
+            raise FileNotFoundError(response["error"])
+        raise ValueError(response["error"])
 
 # ============================================================================
-# PLAYBOOK LOADING
+# WATCH MODE
 # ============================================================================
 
-def load_playbook(name: str, pack: str = None) -> str:
-    """Load playbook template from core or pack."""
-    if pack:
-        # Load from pack
-        manifest = load_manifest(pack)
-        validate_manifest(manifest, pack)
-        check_license(manifest, pack)
+def file_stamp(path: Path):
+    """Return (mtime_ns, size) for path, or None if it does not exist."""
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
 
-        # Check if playbook is in manifest whitelist
-        if name not in manifest["playbooks"]:
-            raise FileNotFoundError(
-                f"Playbook '{name}' not available in pack '{pack}'.\n"
-                f"Available playbooks: {', '.join(manifest['playbooks'])}"
-            )
+class PollWatcher:
+    """Wakes up every interval; the session compares file stamps itself."""
 
-        pb_path = PACKS_DIR / pack / "playbooks" / f"{name}.md"
-    else:
-        # Load from core
-        pb_path = PLAYBOOKS_DIR / f"{name}.md"
+    def __init__(self, interval: float = WATCH_POLL_INTERVAL):
+        self.interval = interval
 
-    if not pb_path.exists():
-        raise FileNotFoundError(f"Playbook not found: {pb_path}")
+    def watch(self, paths):
+        pass
 
-    return pb_path.read_text(encoding="utf-8")
+    def wait(self):
+        time.sleep(self.interval)
 
-def discover_playbooks(pack: str = None) -> list:
-    """Discover available playbooks from core or pack."""
-    if pack:
-        # List playbooks from pack manifest
-        manifest = load_manifest(pack)
-        validate_manifest(manifest, pack)
-        return manifest["playbooks"]
-    else:
-        # List core playbooks
-        if not PLAYBOOKS_DIR.exists():
+    def close(self):
+        pass
+
+class InotifyWatcher:
+    """Sleeps until something changes in the directories of the watched files.
+
+    Directories are watched rather than files so that editors that save by
+    renaming a temp file over the original are seen too. Wakes up at least
+    every rescan seconds in case a watched directory was replaced.
+    """
+
+    # IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    MASK = 0x002 | 0x004 | 0x008 | 0x040 | 0x080 | 0x100 | 0x200
+
+    def __init__(self, rescan: float = 5.0):
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.libc = libc
+        self.fd = fd
+        self.rescan = rescan
+        self.dirs = set()
+
+    def watch(self, paths):
+        for directory in {p if p.is_dir() else p.parent for p in map(Path, paths)}:
+            if directory in self.dirs or not directory.is_dir():
+                continue
+            if self.libc.inotify_add_watch(self.fd, os.fsencode(str(directory)), self.MASK) >= 0:
+                self.dirs.add(directory)
+
+    def wait(self):
+        import select
+        ready, _, _ = select.select([self.fd], [], [], self.rescan)
+        if ready:
+            try:
+                while os.read(self.fd, 64 * 1024):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        os.close(self.fd)
+
+def open_watcher(poll: bool = False, interval: float = WATCH_POLL_INTERVAL):
+    """Return an InotifyWatcher, or a PollWatcher where inotify is unavailable."""
+    if not poll and not os.environ.get(WATCH_POLL_ENV) and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher()
+        except (OSError, AttributeError):
+            pass
+    return PollWatcher(interval)
+
+class WatchSession:
+    """Re-renders a `playbook watch` job whenever its files change.
+
+    The template (or pack bundle), the partials it includes, pack manifest,
+    filters.json and input files are stamped by mtime and size. After a change, poll() waits for
+    the stamps to settle for debounce seconds and then renders: every input
+    if a config file changed, otherwise only the inputs that did. Templates
+    come from load_template, which recompiles only files whose mtime changed.
+    """
+
+    def __init__(self, job: dict, store: OutputStore, hooks: bool = True, recursive: bool = False,
+                 include: list = None, exclude: list = None, debounce: float = WATCH_DEBOUNCE):
+        self.job = job
+        self.store = store
+        self.hooks = hooks
+        self.pattern = job["input"] if job["input"] and is_input_pattern(job["input"]) else None
+        self.expand = functools.partial(expand_inputs, recursive=recursive, include=include, exclude=exclude)
+        self.debounce = debounce
+        self.rendered = {}
+
+    def config_paths(self) -> list:
+        name, pack = self.job["name"], self.job["pack"]
+        if not pack:
+            paths = [PLAYBOOKS_DIR / f"{name}.md", PLAYBOOKS_DIR / FILTERS_FILE]
+        else:
+            paths = [PACKS_DIR / pack / "playbooks" / f"{name}.md",
+                     PACKS_DIR / pack / "meta" / "manifest.json", bundle_path(pack)]
+        try:
+            load_template(name, pack=pack)
+        except batch_errors():
+            return paths  # reported when the job runs
+        key = paths[0] if paths[0].exists() or not pack else (paths[2], f"playbooks/{name}.md")
+        return paths + [dep for dep in template_partials(key) if dep not in paths]
+
+    def inputs(self) -> dict:
+        """Return {path: tag} for the input files; outputs are never inputs."""
+        if not self.pattern:
+            return {Path(self.job["input"]).expanduser().resolve(): None} if self.job["input"] else {}
+        try:
+            matches = self.expand(self.pattern)
+        except FileNotFoundError:
+            return {}
+        root = self.store.root.resolve()
+        return {path: tag for path, tag in matches if root not in path.parents}
+
+    def watched(self) -> list:
+        """Every file to watch, plus the glob's base directory."""
+        paths = self.config_paths() + list(self.inputs())
+        if self.pattern:
+            paths.append(input_base(self.pattern).resolve())
+        return paths
+
+    def snapshot(self) -> tuple:
+        inputs = self.inputs()
+        stamps = {path: file_stamp(path) for path in self.config_paths() + list(inputs)}
+        return inputs, stamps
+
+    def poll(self) -> list:
+        """Render whatever changed since the last call and return result records."""
+        inputs, stamps = self.snapshot()
+        if stamps == self.rendered:
             return []
-        return sorted([
-            p.stem for p in PLAYBOOKS_DIR.glob("*.md")
-        ])
+        while self.debounce:
+            time.sleep(self.debounce)
+            settled = self.snapshot()
+            if settled[1] == stamps:
+                break
+            inputs, stamps = settled
+
+        configs = self.config_paths()
+        if any(stamps.get(path) != self.rendered.get(path) for path in configs):
+            todo = list(inputs) or [None]
+        else:
+            todo = [path for path in inputs if stamps[path] != self.rendered.get(path)]
+        self.rendered = stamps
+
+        results = []
+        for path in todo:
+            result = {"input": str(path) if path else None, "name": self.job["name"], "pack": self.job["pack"]}
+            if path is not None and stamps[path] is None:
+                result.update(status="error", error=f"Input file not found: {path}")
+                results.append(result)
+                continue
+            started = time.perf_counter()
+            try:
+                job = dict(self.job, input=str(path)) if path else self.job
+                _, out_file = run_job(job, hooks=self.hooks, tag=inputs.get(path), store=self.store)
+            except batch_errors() as e:
+                result.update(status="error", error=job_error_message(e))
+            else:
+                result.update(status="ok", out_file=str(out_file),
+                              ms=round((time.perf_counter() - started) * 1000, 1))
+            results.append(result)
+        return results
 
 # ============================================================================
-# INPUT/OUTPUT UTILITIES
+# BENCHMARKS
 # ============================================================================
 
-def read_stdin() -> str:
-    """Read content from stdin if available."""
-    if not sys.stdin.isatty():
-        return sys.stdin.read()
-    return ""
+BENCH_BASELINE = ROOT / "bench_baseline.json"
+BENCH_VERSION = 1
+BENCH_DIFF_BYTES = 8 * 1024 * 1024
+
+def _bench_template(placeholders: int, filler: str) -> str:
+    """Template text with the given number of {{var_N}} placeholders."""
+    return "".join(f"{filler}{{{{var_{i}}}}}\n" for i in range(placeholders))
+
+def _bench_diff(root: Path) -> Path:
+    """Write a synthetic unified diff of about BENCH_DIFF_BYTES."""
+    path = root / "large.diff"
+    hunk = "".join(f"+    value_{i} = compute(value_{i - 1}, {i})\n" for i in range(1, 200))
+    hunk = "@@ -1,200 +1,200 @@\n" + hunk
+    with path.open("w", encoding="utf-8") as fh:
+        for _ in range(BENCH_DIFF_BYTES // len(hunk) + 1):
+            fh.write(hunk)
+    return path
+
+def _bench_startup(root: Path):
+    import subprocess
+    # The same module import the install.sh launcher does, so bytecode is cached
+    launcher = "import sys; sys.path[0] = sys.argv.pop(1); import playbook; playbook.main()"
+    command = [sys.executable, "-c", launcher, os.path.dirname(os.path.abspath(__file__)), "--help"]
+    return lambda: subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+
+def _bench_render_small(root: Path):
+    template = compile_template("Review {{repo}} ({{title}}) on {{date}} at {{time_utc}}:\n\n{{input}}\n")
+    vars_dict = {"repo": "my-app", "title": "Add auth", "date": "2024-01-01",
+                 "time_utc": "00:00:00", "input": "+ one line\n" * 20}
+    return lambda: template.render(vars_dict)
+
+def _bench_render_huge(root: Path):
+    template = compile_template(_bench_template(2000, "x" * 1000))
+    vars_dict = {f"var_{i}": "value" for i in range(2000)}
+    return lambda: template.render(vars_dict)
+
+def _bench_compile_huge(root: Path):
+    source = _bench_template(2000, "x" * 1000)
+    return lambda: compile_template.__wrapped__(source)
+
+def _bench_many_vars(root: Path):
+    template = compile_template(_bench_template(1000, "- "))
+    vars_dict = {f"var_{i}": f"value {i}" for i in range(1000)}
+    return lambda: template.render(vars_dict)
+
+def _bench_large_diff(root: Path):
+    (PLAYBOOKS_DIR / "review.md").write_text("Review {{repo}}:\n\n{{input}}\n", encoding="utf-8")
+    job = make_job("review", vars_dict={"repo": "my-app"}, input_path=str(_bench_diff(root)))
+    return lambda: run_job(job, print_only=True, hooks=False)
+
+def _bench_stream_diff(root: Path):
+    (PLAYBOOKS_DIR / "review.md").write_text("Review {{repo}}:\n\n{{input}}\n", encoding="utf-8")
+    job = make_job("review", vars_dict={"repo": "my-app"}, input_path=str(_bench_diff(root)))
+
+    def op():
+        with open(os.devnull, "wb") as sink:
+            run_job(job, print_only=True, hooks=False, stream=sink)
+    return op
+
+def _bench_many_packs(root: Path):
+    for i in range(200):
+        pack = PACKS_DIR / f"pack_{i}"
+        (pack / "meta").mkdir(parents=True)
+        (pack / "playbooks").mkdir()
+        (pack / "playbooks" / "hello.md").write_text("Hello {{name}}\n", encoding="utf-8")
+        manifest = {"name": f"pack_{i}", "version": "1.0.0", "playbooks": ["hello"]}
+        (pack / "meta" / "manifest.json").write_text(json.dumps(manifest), encoding="utf-8")
+    discover_packs()  # build the on-disk index once
+
+    def op():
+        # What a fresh process sees: a warm index on disk, nothing in memory
+        _pack_indexes.clear()
+        discover_packs()
+    return op
+
+def _bench_hook(kind: str):
+    def setup(root: Path):
+        HOOKS_DIR.mkdir(parents=True, exist_ok=True)
+        if kind == "sh":
+            hook = HOOKS_DIR / "pre.sh"
+            hook.write_text("#!/bin/sh\nexit 0\n", encoding="utf-8")
+            hook.chmod(0o755)
+        else:
+            (HOOKS_DIR / "pre.py").write_text("def hook(vars, out_file):\n    vars['seen'] = '1'\n",
+                                              encoding="utf-8")
+        env = dict(os.environ)
+        return lambda: run_hooks("pre", None, env, {"repo": "my-app"})
+    return setup
+
+def _bench_batch(root: Path):
+    (PLAYBOOKS_DIR / "review.md").write_text("Review {{repo}} ({{title}}):\n\n{{notes}}\n",
+                                             encoding="utf-8")
+    items = [
+        (i, json.dumps({"name": "review", "vars": {"repo": f"repo-{i}", "title": "t", "notes": "n" * 2000}}))
+        for i in range(1, 101)
+    ]
+    store = FlatStore()
+    return lambda: list(iter_batch_results(items, hooks=False, store=store))
+
+# name -> (description, setup(root) returning the operation to time)
+BENCH_WORKLOADS = OrderedDict([
+    ("startup", ("interpreter start, import and `--help`", _bench_startup)),
+    ("render_small", ("5-variable template", _bench_render_small)),
+    ("render_huge", ("2 MB template, 2000 placeholders", _bench_render_huge)),
+    ("compile_huge", ("compile a 2 MB template", _bench_compile_huge)),
+    ("many_vars", ("1000 distinct variables", _bench_many_vars)),
+    ("large_diff", ("run_job with an 8 MB --input", _bench_large_diff)),
+    ("stream_diff", ("streamed run_job with an 8 MB --input", _bench_stream_diff)),
+    ("many_packs", ("discover 200 packs from a warm index", _bench_many_packs)),
+    ("hook_shell", ("one pre.sh hook", _bench_hook("sh"))),
+    ("hook_python", ("one pre.py hook", _bench_hook("py"))),
+    ("batch", ("100-job batch, one process, no hooks", _bench_batch)),
+])
+
+def percentile(samples: list, pct: float) -> float:
+    """Nearest-rank percentile of samples."""
+    ordered = sorted(samples)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
 
-def copy_to_clipboard(content: str) -> bool:
-    """Copy content to system clipboard."""
-    # Try pbcopy (macOS)
+def peak_rss_kb(children: bool = False) -> int:
+    """Peak resident set size of this process (or its children) in KB."""
+    import resource
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    peak = resource.getrusage(who).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak  # bytes on macOS
+
+def bench_workload(name: str, seconds: float = 1.0, min_runs: int = 5) -> dict:
+    """Time one workload in a scratch tree and return its statistics.
+
+    The operation runs until `seconds` have passed and at least min_runs
+    times, after one untimed warm-up run.
+    """
+    import shutil
+    import tempfile
+    global PLAYBOOKS_DIR, PACKS_DIR, HOOKS_DIR, OUT_DIR, CACHE_DIR
+    saved = (PLAYBOOKS_DIR, PACKS_DIR, HOOKS_DIR, OUT_DIR, CACHE_DIR)
+    root = Path(tempfile.mkdtemp(prefix="playbook-bench-"))
     try:
-        subprocess.run(
-            ["pbcopy"],
-            input=content.encode("utf-8"),
-            check=True,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL
-        )
-        return True
-    except (FileNotFoundError, subprocess.CalledProcessError):
-        pass
+        PLAYBOOKS_DIR, PACKS_DIR, HOOKS_DIR = root / "playbooks", root / "packs", root / "hooks"
+        OUT_DIR, CACHE_DIR = root / "out", root / "cache"
+        for directory in (PLAYBOOKS_DIR, PACKS_DIR, OUT_DIR):
+            directory.mkdir()
+        op = BENCH_WORKLOADS[name][1](root)
+        op()
+
+        samples = []
+        started = time.perf_counter()
+        while len(samples) < min_runs or time.perf_counter() - started < seconds:
+            t0 = time.perf_counter()
+            op()
+            samples.append(time.perf_counter() - t0)
+        total = time.perf_counter() - started
+    finally:
+        PLAYBOOKS_DIR, PACKS_DIR, HOOKS_DIR, OUT_DIR, CACHE_DIR = saved
+        _pack_indexes.pop(str(root / "packs"), None)
+        shutil.rmtree(root, ignore_errors=True)
+
+    return {
+        "runs": len(samples),
+        "ops_per_sec": round(len(samples) / total, 2),
+        "p50_ms": round(percentile(samples, 50) * 1000, 4),
+        "p90_ms": round(percentile(samples, 90) * 1000, 4),
+        "p99_ms": round(percentile(samples, 99) * 1000, 4),
+        "peak_rss_kb": peak_rss_kb(children=name == "startup"),
+    }
+
+def run_bench(names: list, seconds: float = 1.0) -> dict:
+    """Run workloads, each in a fresh process so peak RSS is its own."""
+    from concurrent.futures import ProcessPoolExecutor
+    results = OrderedDict()
+    for name in names:
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            results[name] = pool.submit(bench_workload, name, seconds).result()
+    return {"version": BENCH_VERSION, "python": sys.version.split()[0], "workloads": results}
+
+def compare_bench(results: dict, baseline: dict, tolerance: float) -> list:
+    """Return a message for every workload slower or bigger than baseline allows."""
+    regressions = []
+    for name, current in results["workloads"].items():
+        base = baseline.get("workloads", {}).get(name)
+        if not base:
+            continue
+        for metric, label in (("p50_ms", "median latency"), ("p90_ms", "p90 latency"),
+                              ("peak_rss_kb", "peak RSS")):
+            if base.get(metric) and current[metric] > base[metric] * (1 + tolerance):
+                change = (current[metric] / base[metric] - 1) * 100
+                regressions.append(
+                    f"{name}: {label} {current[metric]:.4g} vs baseline {base[metric]:.4g} (+{change:.0f}%)"
+                )
+    return regressions
+
+# ============================================================================
+# SHELL COMPLETION
+# ============================================================================
 
-    # Try xclip (Linux)
+# Completion scripts answer from a tab-separated index with one candidate per line:
+#   subcommand <name> | pack <name> | playbook <pack or empty> <name> | option run <--flag> <takes value 0/1>
+# This awk program is the shell-side twin of complete(); keep them in step.
+COMPLETION_AWK = """\
+function out(word) { if (index(word, cur) == 1) print word }
+BEGIN { FS = "\\t" }
+$1 == "subcommand" { subs[++ns] = $2 }
+$1 == "pack" { packs[++np] = $2 }
+$1 == "playbook" && $2 == pack { books[++nb] = $3 }
+$1 == "option" && $2 == cmd { opts[++no] = $3; if ($3 == prev && $4 == "1") valued = 1 }
+END {
+    if (pos == 1) { for (i = 1; i <= ns; i++) out(subs[i]) }
+    else if (prev == "--pack") { for (i = 1; i <= np; i++) out(packs[i]) }
+    else if (valued) print "__files__"
+    else if (substr(cur, 1, 1) == "-") { for (i = 1; i <= no; i++) out(opts[i]) }
+    else if (cmd == "run" || cmd == "watch") { for (i = 1; i <= nb; i++) out(books[i]) }
+    else print "__files__"
+}"""
+
+COMPLETION_BASH = """\
+# bash completion for playbook (generated by `playbook completion bash`)
+_playbook() {
+    local index=%(index)s cur=${COMP_WORDS[COMP_CWORD]} prev= pack= words i f fresh=
+    ((COMP_CWORD > 1)) && prev=${COMP_WORDS[COMP_CWORD-1]}
+    for ((i = 1; i < COMP_CWORD - 1; i++)); do
+        [[ ${COMP_WORDS[i]} == --pack ]] && pack=${COMP_WORDS[i+1]}
+    done
+    if [[ -f $index ]]; then
+        fresh=1
+        for f in %(playbooks)s %(packs)s %(packs)s/*/meta/manifest.json %(packs)s/*%(bundle)s; do
+            [[ $f -nt $index ]] && { fresh=; break; }
+        done
+    fi
+    if [[ $fresh ]]; then
+        words=$(awk -v cmd="${COMP_WORDS[1]}" -v prev="$prev" -v cur="$cur" -v pack="$pack" \\
+            -v pos="$COMP_CWORD" '%(awk)s' "$index")
+    else
+        words=$(%(command)s __complete "${COMP_WORDS[@]:1:COMP_CWORD}" 2>/dev/null)
+    fi
+    if [[ $words == __files__ ]]; then
+        COMPREPLY=($(compgen -f -- "$cur"))
+    else
+        COMPREPLY=($words)
+    fi
+}
+complete -o default -F _playbook playbook
+"""
+
+COMPLETION_FISH = """\
+# fish completion for playbook (generated by `playbook completion fish`)
+function __playbook_complete
+    set -l index %(index)s
+    set -l words (commandline -opc)
+    set -e words[1]
+    set -l cur (commandline -ct)
+    set -l cmd $cur
+    set -l prev ""
+    set -l pack ""
+    if set -q words[1]
+        set cmd $words[1]
+        set prev $words[-1]
+    end
+    set -l i 1
+    while test $i -lt (count $words)
+        if test "$words[$i]" = --pack
+            set pack $words[(math $i + 1)]
+        end
+        set i (math $i + 1)
+    end
+    set -l pos (math (count $words) + 1)
+    set -l fresh (test -f $index; and echo 1)
+    for f in %(playbooks)s %(packs)s %(packs)s/*/meta/manifest.json %(packs)s/*%(bundle)s
+        if test -n "$fresh"; and command test $f -nt $index
+            set fresh ""
+        end
+    end
+    if test -n "$fresh"
+        set result (awk -v cmd="$cmd" -v prev="$prev" -v cur="$cur" -v pack="$pack" -v pos=$pos '%(awk)s' $index)
+    else
+        set result (%(command)s __complete $words $cur 2>/dev/null)
+    end
+    if test "$result" = __files__
+        __fish_complete_path $cur
+    else
+        printf "%%s\\n" $result
+    end
+end
+complete -c playbook -f -a "(__playbook_complete)"
+"""
+
+def completion_index_path() -> Path:
+    """Return the completion index file for the current playbook and pack dirs."""
+    import hashlib
+    digest = hashlib.sha1(f"{PLAYBOOKS_DIR}\0{PACKS_DIR}".encode("utf-8")).hexdigest()[:12]
+    return CACHE_DIR / f"completion-{digest}.tsv"
+
+def completion_sources() -> list:
+    """Files whose changes the completion index must follow.
+
+    The playbook and pack dirs change when a playbook or pack is added or
+    removed; a pack's playbook list lives in its manifest or bundle.
+    """
+    sources = [PLAYBOOKS_DIR, PACKS_DIR]
+    if PACKS_DIR.is_dir():
+        for e in os.scandir(str(PACKS_DIR)):
+            if e.name.endswith(BUNDLE_SUFFIX):
+                sources.append(Path(e.path))
+            elif e.is_dir():
+                sources.append(Path(e.path) / "meta" / "manifest.json")
+    return sources
+
+def completion_index_stale(path: Path) -> bool:
+    """Return True if the index is missing or older than any of completion_sources()."""
     try:
-        subprocess.run(
-            ["xclip", "-selection", "clipboard"],
-            input=content.encode("utf-8"),
-            check=True,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL
-        )
+        built = path.stat().st_mtime_ns
+    except OSError:
         return True
-    except (FileNotFoundError, subprocess.CalledProcessError):
-        pass
+    for source in completion_sources():
+        stamp = file_stamp(source)
+        if stamp is not None and stamp[0] > built:
+            return True
+    return False
+
+def write_completion_index() -> Path:
+    """Rebuild the completion index from the pack and variable indexes."""
+    rows = [("subcommand", name) for name in SUBCOMMANDS]
+    for name, entry in sorted(refresh_pack_index().items()):
+        if "error" not in entry:
+            rows.append(("pack", name))
+            rows.extend(("playbook", name, book) for book in entry["playbooks"])
+    rows.extend(("playbook", "", book) for book in sorted(refresh_vars_index()))
+    rows.extend(("option", "run", flag, "0") for flag in RUN_FLAGS)
+    rows.extend(("option", "run", option, "1") for option in RUN_OPTIONS)
+    path = completion_index_path()
+    _write_cache_file(path, "".join("\t".join(row) + "\n" for row in rows))
+    return path
 
-    # Try xsel (Linux)
+def complete(words: list) -> list:
+    """Return completion candidates for the words after `playbook`.
+
+    The last word is the one being completed. Returns ["__files__"] where
+    the shell should complete file names. This is the fallback behind the
+    generated scripts, and it refreshes their index when it is stale.
+    """
+    path = completion_index_path()
+    if completion_index_stale(path):
+        write_completion_index()
     try:
-        subprocess.run(
-            ["xsel", "--clipboard", "--input"],
-            input=content.encode("utf-8"),
-            check=True,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL
-        )
-        return True
-    except (FileNotFoundError, subprocess.CalledProcessError):
-        pass
+        rows = [line.split("\t") for line in path.read_text(encoding="utf-8").splitlines()]
+    except OSError:
+        rows = []  # unwritable cache dir: nothing better than files
 
-    print(
-        "Warning: Could not copy to clipboard. "
-        "Install pbcopy (macOS), xclip, or xsel (Linux).",
-        file=sys.stderr
-    )
-    return False
+    cur = words[-1] if words else ""
+    pos = max(len(words), 1)
+    cmd = words[0] if words else ""
+    prev = words[-2] if len(words) > 1 else ""
+    pack = ""
+    for i, word in enumerate(words[:-2]):
+        if word == "--pack":
+            pack = words[i + 1]
+
+    def pick(kind, key=None):
+        return [row[-1] if kind != "option" else row[2] for row in rows
+                if row[0] == kind and (key is None or row[1] == key)]
+
+    if pos == 1:
+        candidates = pick("subcommand")
+    elif prev == "--pack":
+        candidates = pick("pack")
+    elif any(row[0] == "option" and row[1] == cmd and row[2] == prev and row[3] == "1" for row in rows):
+        return ["__files__"]
+    elif cur.startswith("-"):
+        candidates = pick("option", cmd)
+    elif cmd in ("run", "watch"):
+        candidates = pick("playbook", pack)
+    else:
+        return ["__files__"]
+    return [word for word in candidates if word.startswith(cur)]
+
+def completion_script(shell: str) -> str:
+    """Return the completion script for shell, with this install's paths baked in."""
+    import shlex
+    values = {
+        "index": shlex.quote(str(completion_index_path())),
+        "playbooks": shlex.quote(str(PLAYBOOKS_DIR)),
+        "packs": shlex.quote(str(PACKS_DIR)),
+        "bundle": BUNDLE_SUFFIX,
+        "command": " ".join(shlex.quote(part) for part in (sys.executable, str(Path(__file__).resolve()))),
+        "awk": COMPLETION_AWK,
+    }
+    if shell == "fish":
+        return COMPLETION_FISH % values
+    script = COMPLETION_BASH % values
+    if shell == "zsh":
+        script = script.replace("# bash completion", "# zsh completion", 1).replace(
+            "completion bash`)", "completion zsh`)", 1)
+        script = script.replace("\n", "\nautoload -U +X bashcompinit && bashcompinit\n", 1)
+    return script
 
 # ============================================================================
 # SUBCOMMAND IMPLEMENTATIONS
@@ -234,6 +3675,22 @@ def cmd_run(args):
 
     # Parse variables
     vars_dict = parse_vars(args.vars)
+    if args.git_diff and (args.input or args.stdin):
+        raise ValueError("--git-diff cannot be combined with --input or --stdin")
+    if (args.git_path or args.git_stat) and not args.git_diff:
+        raise ValueError("--git-path and --git-stat need --git-diff")
+
+    # Fail before hooks run or a large input is read; a Python pre hook may fill vars in
+    pre_py = any((directory / "pre.py").exists() for directory in hook_dirs(args.pack))
+    if not args.allow_missing and not pre_py:
+        has_input = bool(args.input or args.stdin or args.git_diff)
+        missing = missing_vars(args.name, args.pack, vars_dict, has_input=has_input)
+        if missing:
+            raise ValueError(
+                f"Missing required vars for '{args.name}': {', '.join(missing)}\n"
+                f"Set them with --vars key=value ({{{{input}}}} with --input, --stdin or --git-diff), "
+                f"or pass --allow-missing"
+            )
 
     # Handle input (stdin takes precedence over file)
     if args.stdin:
@@ -243,53 +3700,265 @@ def cmd_run(args):
         elif not args.input:
             print("Warning: --stdin specified but no input on stdin", file=sys.stderr)
 
-    if args.input and "input" not in vars_dict:
-        input_path = Path(args.input).expanduser().resolve()
-        vars_dict["input"] = input_path.read_text(encoding="utf-8")
-
-    # Add standard vars
-    vars_dict.setdefault("date", datetime.utcnow().strftime("%Y-%m-%d"))
-    vars_dict.setdefault("time_utc", datetime.utcnow().strftime("%H:%M:%S"))
-
-    # Prepare env for hooks
-    env = os.environ.copy()
-    env["PLAYBOOK_NAME"] = args.name
-    if args.pack:
-        env["PB_PACK"] = args.pack
-    for k, v in vars_dict.items():
-        env[f"PB_{k.upper()}"] = v
-
-    # Run pre hook
-    run_hook(HOOKS_DIR / "pre.sh", env)
+    filters = [] if args.no_filters else (args.filter or None)
+    with contextlib.ExitStack() as stack:
+        input_path = args.input
+        if args.git_diff:
+            # The diff goes to a (cached) file as git writes it, then renders like --input
+            input_path = str(stack.enter_context(
+                git_diff_input(args.git_diff, args.git_path, args.git_stat, reuse=not args.no_cache)))
+        job = make_job(args.name, pack=args.pack, vars_dict=vars_dict, input_path=input_path, filters=filters)
+        store = stack.enter_context(contextlib.closing(open_output(args.out_format, args.store, args.sink)))
+        run_with_store(args, job, store)
 
-    # Load and render template
-    template = load_playbook(args.name, pack=args.pack)
-    rendered = render(template, vars_dict)
+def run_with_store(args, job: dict, store: OutputStore):
+    """Render the `playbook run` job, saving to store, and print the result."""
+    # Globs and directories render one prompt per matching file
+    if job["input"] and "input" not in job["vars"] and is_input_pattern(job["input"]):
+        run_fanout(args, job, store)
+        return
 
-    # Create timestamped output filename
-    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
-    pack_suffix = f"_{args.pack}" if args.pack else ""
-    out_file = OUT_DIR / f"{timestamp}_{args.name}{pack_suffix}.prompt.txt"
+    # Oversized inputs are split into several prompts within --max-tokens
+    if args.max_tokens:
+        run_chunked(args, job, store)
+        return
 
-    # Save output (unless --print-only)
-    if not args.print_only:
-        out_file.write_text(rendered, encoding="utf-8")
+    # Large inputs are streamed straight to the output file and stdout
+    if job["input"] and "input" not in job["vars"] and (
+            args.stream or (not isinstance(store, PromptSink) and should_stream(job["input"]))):
+        sys.stdout.flush()
+        _, out_file = run_job(job, print_only=args.print_only, stream=sys.stdout.buffer, store=store)
+        sys.stdout.buffer.write(b"\n")
+        sys.stdout.buffer.flush()
+        if args.copy:
+            if args.print_only:
+                print("Warning: --copy needs a saved prompt when streaming", file=sys.stderr)
+            else:
+                with trace_span("clipboard"):
+                    copied = copy_to_clipboard(out_file)
+                if copied:
+                    print("[Copied to clipboard]", file=sys.stderr)
+        return
 
-    # Run post hook (can read OUT_FILE)
-    env["OUT_FILE"] = str(out_file)
-    run_hook(HOOKS_DIR / "post.sh", env)
+    # Render through `playbook serve` when it is running
+    with trace_span("daemon") as span:
+        daemon = DaemonClient.connect()
+        if span is not None:
+            span["connected"] = daemon is not None
+    cache = open_render_cache(args.no_cache)
+    try:
+        load = daemon.load if daemon else load_template
+        rendered, _ = run_job(job, load=load, print_only=args.print_only, cache=cache, store=store)
+    finally:
+        if daemon:
+            daemon.close()
+        if cache:
+            cache.close()
 
     # Copy to clipboard if requested
     if args.copy:
-        if copy_to_clipboard(rendered):
+        with trace_span("clipboard"):
+            copied = copy_to_clipboard(rendered)
+        if copied:
             print("[Copied to clipboard]", file=sys.stderr)
 
     # Print to stdout
-    print(rendered)
+    with trace_span("print"):
+        print(rendered)
+
+def run_fanout(args, job: dict, store: OutputStore):
+    """Run one job per file matched by --input and print one JSON result per file."""
+    if args.copy or args.stream:
+        raise ValueError("--copy and --stream need a single --input file")
+    inputs = expand_inputs(args.input, recursive=args.recursive, include=args.include, exclude=args.exclude)
+    cache = open_render_cache(args.no_cache)
+    batch_hooks = args.hook_mode == "batch"
+    ok = failed = 0
+    done = []
+    try:
+        for result in iter_fanout_results(job, inputs, print_only=args.print_only, cache=cache, store=store,
+                                          hooks="pre" if batch_hooks else True,
+                                          max_tokens=args.max_tokens, chunk_by=args.chunk_by):
+            if result["status"] == "ok":
+                ok += 1
+            else:
+                failed += 1
+            print(json.dumps(result), flush=True)
+            if batch_hooks:
+                result.pop("prompt", None)
+                done.append(result)
+    finally:
+        if cache:
+            cache.close()
+
+    if batch_hooks:
+        store.flush()
+        if not finish_batch_hooks(done):
+            failed += 1
+
+    if args.max_tokens:
+        print(f"Rendered {ok} chunks from {len(inputs)} input files ({failed} failed)", file=sys.stderr)
+    else:
+        print(f"Rendered {ok} of {len(inputs)} input files ({failed} failed)", file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+def run_chunked(args, job: dict, store: OutputStore):
+    """Split the job's {{input}} to fit --max-tokens and print one JSON result per chunk."""
+    if args.copy or args.stream:
+        raise ValueError("--copy and --stream cannot be combined with --max-tokens")
+    cache = open_render_cache(args.no_cache)
+    batch_hooks = args.hook_mode == "batch"
+    ok = failed = 0
+    done = []
+    try:
+        for result in iter_chunk_results(job, args.max_tokens, args.chunk_by, print_only=args.print_only,
+                                         hooks="pre" if batch_hooks else True, cache=cache, store=store):
+            if result["status"] == "ok":
+                ok += 1
+            else:
+                failed += 1
+            print(json.dumps(result), flush=True)
+            if batch_hooks:
+                result.pop("prompt", None)
+                done.append(result)
+    finally:
+        if cache:
+            cache.close()
+
+    if batch_hooks:
+        store.flush()
+        if not finish_batch_hooks(done):
+            failed += 1
+
+    print(f"Rendered {ok} chunks within {args.max_tokens} tokens ({failed} failed)", file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+def finish_batch_hooks(results: list) -> bool:
+    """Run --hook-mode batch post hooks; report a failure and return False."""
+    try:
+        run_batch_hooks(results)
+    except batch_errors() as e:
+        print(f"Error: batch post hook failed: {job_error_message(e)}", file=sys.stderr)
+        return False
+    return True
+
+def cmd_batch(args):
+    """Execute every job in a JSONL job file inside this process."""
+    OUT_DIR.mkdir(parents=True, exist_ok=True)
+
+    if args.jobs_file == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        jobs_path = Path(args.jobs_file).expanduser().resolve()
+        if not jobs_path.exists():
+            raise FileNotFoundError(f"Job file not found: {jobs_path}")
+        lines = jobs_path.read_text(encoding="utf-8").splitlines()
+
+    items = [(line_no, line) for line_no, line in enumerate(lines, 1) if line.strip()]
+    store = open_output(args.out_format, args.store, args.sink)
+    batch_hooks = not args.no_hooks and args.hook_mode == "batch"
+    results = iter_batch_results(
+        items,
+        workers=resolve_workers(args.jobs),
+        print_only=args.print_only,
+        hooks="pre" if batch_hooks else not args.no_hooks,
+        cache=not args.no_cache,
+        store=store,
+    )
+
+    ok = failed = 0
+    done = []
+    with contextlib.closing(store):
+        for result in results:
+            if result["status"] == "ok":
+                ok += 1
+            else:
+                failed += 1
+            print(json.dumps(result), flush=True)
+            if batch_hooks:
+                result.pop("prompt", None)
+                done.append(result)
+
+    if batch_hooks and not finish_batch_hooks(done):
+        failed += 1
+    print(f"Batch finished: {ok} ok, {failed} failed", file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+def cmd_bench(args):
+    """Run the benchmark workloads and compare them against a baseline."""
+    names = args.workload or list(BENCH_WORKLOADS)
+    results = run_bench(names, seconds=args.seconds)
+
+    baseline_path = Path(args.baseline).expanduser() if args.baseline else BENCH_BASELINE
+    baseline = None
+    if baseline_path.exists():
+        baseline = json.loads(baseline_path.read_text(encoding="utf-8"))
+    elif args.baseline:
+        raise FileNotFoundError(f"Baseline not found: {baseline_path}")
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'workload':<14} {'ops/s':>10} {'p50 ms':>10} {'p90 ms':>10} {'p99 ms':>10} {'peak RSS':>10}  vs baseline")
+        for name, stats in results["workloads"].items():
+            base = (baseline or {}).get("workloads", {}).get(name)
+            delta = f"{(stats['p50_ms'] / base['p50_ms'] - 1) * 100:+.0f}%" if base and base.get("p50_ms") else "-"
+            print(f"{name:<14} {stats['ops_per_sec']:>10.1f} {stats['p50_ms']:>10.3f} {stats['p90_ms']:>10.3f} "
+                  f"{stats['p99_ms']:>10.3f} {stats['peak_rss_kb'] // 1024:>7} MB  {delta}")
+
+    if args.save_baseline:
+        save_path = baseline_path if args.save_baseline == "-" else Path(args.save_baseline).expanduser()
+        save_path.write_text(json.dumps(results, indent=2) + "\n", encoding="utf-8")
+        print(f"Saved baseline: {save_path}", file=sys.stderr)
+        return
+
+    if baseline is None:
+        print(f"No baseline at {baseline_path}; save one with --save-baseline", file=sys.stderr)
+        return
+    regressions = compare_bench(results, baseline, args.tolerance)
+    for message in regressions:
+        print(f"REGRESSION {message}", file=sys.stderr)
+    if regressions:
+        print(f"{len(regressions)} regression(s) beyond {args.tolerance:.0%} of {baseline_path}", file=sys.stderr)
+        sys.exit(1)
+
+def cmd_serve(args):
+    """Serve render requests over a Unix socket until interrupted."""
+    socket_path = Path(args.socket).expanduser() if args.socket else daemon_socket_path()
+    if socket_path.exists():
+        client = DaemonClient.connect(socket_path)
+        if client:
+            client.close()
+            print(f"Error: A daemon is already serving on {socket_path}", file=sys.stderr)
+            sys.exit(1)
+        socket_path.unlink()  # stale socket from a previous run
+
+    socket_path.parent.mkdir(parents=True, exist_ok=True)
+    warm_caches()
+    RenderServer, RenderHandler = daemon_server_classes()
+    server = RenderServer(str(socket_path), RenderHandler)
+    os.chmod(str(socket_path), 0o600)
+    # Exit through the finally block below so the socket is removed
+    import signal
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"Serving playbooks on {socket_path}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if socket_path.exists():
+            socket_path.unlink()
 
 def cmd_list(args):
     """List available playbooks."""
     try:
+        if args.vars:
+            list_vars(args.pack)
+            return
+
         if args.pack:
             playbooks = discover_playbooks(pack=args.pack)
             print(f"Playbooks in pack '{args.pack}':")
@@ -314,6 +3983,83 @@ def cmd_list(args):
         print(f"Error: {e}", file=sys.stderr)
         sys.exit(1)
 
+def list_vars(pack: str = None):
+    """Print the variables each playbook needs, straight from the indexes."""
+    if pack:
+        sections = [(f"Playbooks in pack '{pack}':", pack, pack_entry(pack))]
+    else:
+        sections = [("Core playbooks:", None, {"files": refresh_vars_index()})]
+        sections += [(f"\nPack '{name}':", name, entry) for name, entry in sorted(refresh_pack_index().items())]
+
+    for title, pack_name, entry in sections:
+        print(title)
+        if "error" in entry:
+            print(f"  (error: {entry['error'].splitlines()[0]})")
+            continue
+        files = entry["files"]
+        names = entry.get("playbooks", sorted(files))
+        if not names:
+            print("  (none)")
+        width = max((len(name) for name in names), default=0)
+        for name in names:
+            if name not in files:
+                print(f"  {name.ljust(width)}  (missing)")
+                continue
+            if "error" in files[name]:
+                print(f"  {name.ljust(width)}  (error: {files[name]['error']})")
+                continue
+            needed = required_vars(files[name]["vars"])
+            print(f"  {name.ljust(width)}  {', '.join(needed) or '(none)'}")
+
+def cmd_watch(args):
+    """Re-render a playbook into one stable output file whenever its files change."""
+    OUT_DIR.mkdir(parents=True, exist_ok=True)
+    filters = [] if args.no_filters else (args.filter or None)
+    job = make_job(args.name, pack=args.pack, vars_dict=parse_vars(args.vars), input_path=args.input,
+                   filters=filters)
+    store = FixedStore()
+    session = WatchSession(job, store, hooks=not args.no_hooks, recursive=args.recursive,
+                           include=args.include, exclude=args.exclude, debounce=args.debounce)
+    watcher = open_watcher(poll=args.poll, interval=args.interval)
+    print(f"Watching {args.name} ({type(watcher).__name__[:-len('Watcher')].lower()}); "
+          f"Ctrl-C to stop", file=sys.stderr)
+    try:
+        while True:
+            watcher.watch(session.watched())
+            for result in session.poll():
+                if result["status"] == "ok":
+                    print(f"[{datetime.now().strftime('%H:%M:%S')}] Rendered {result['out_file']} "
+                          f"({result['ms']} ms)", flush=True)
+                else:
+                    print(f"[{datetime.now().strftime('%H:%M:%S')}] Error: {result['error']}",
+                          file=sys.stderr, flush=True)
+            watcher.wait()
+    except KeyboardInterrupt:
+        print("\nStopped watching", file=sys.stderr)
+    finally:
+        watcher.close()
+
+def cmd_completion(args):
+    """Print a shell completion script and build the index it reads."""
+    write_completion_index()
+    sys.stdout.write(completion_script(args.shell))
+
+def cmd_gc(args):
+    """Prune the content-addressed output store."""
+    if args.keep_days is None and args.keep_last is None:
+        raise ValueError("Nothing to do: pass --keep-days and/or --keep-last")
+    runs, blobs = ContentStore().gc(args.keep_days, args.keep_last, dry_run=args.dry_run)
+    verb = "Would remove" if args.dry_run else "Removed"
+    print(f"{verb} {runs} run record(s) and {blobs} unreferenced prompt(s) from {OUT_DIR}")
+
+def cmd_pack(args):
+    """Execute pack management subcommands."""
+    if args.pack_command == "build":
+        out_path = Path(args.output or f"{args.pack}{BUNDLE_SUFFIX}").expanduser().resolve()
+        build_bundle(args.pack, out_path)
+        print(f"Built pack bundle: {out_path}")
+        print(f"Install by copying it into {PACKS_DIR}/")
+
 def cmd_init(args):
     """Initialize new playbook or pack."""
     target_path = Path(args.path).resolve()
@@ -430,8 +4176,9 @@ OUTPUT SCHEMA
 # ARGUMENT PARSER SETUP
 # ============================================================================
 
-def setup_parser() -> argparse.ArgumentParser:
+def setup_parser() -> "argparse.ArgumentParser":
     """Configure argument parser with subcommands."""
+    import argparse
     parser = argparse.ArgumentParser(
         prog="playbook",
         description="Turn messy inputs into consistent, reusable Claude prompts"
@@ -445,12 +4192,49 @@ def setup_parser() -> argparse.ArgumentParser:
         help="Execute a playbook"
     )
     run_parser.add_argument("name", help="Playbook name (without .md extension)")
-    run_parser.add_argument("--input", help="File to inject as {{input}}")
+    run_parser.add_argument("--input", help="File to inject as {{input}}; a glob or directory renders one prompt per file")
+    run_parser.add_argument("--recursive", "-r", action="store_true", help="Include files in subdirectories of an --input directory")
+    run_parser.add_argument("--include", action="append", default=[], metavar="PATTERN",
+                            help="Only render matched files whose relative path matches PATTERN (repeatable)")
+    run_parser.add_argument("--exclude", action="append", default=[], metavar="PATTERN",
+                            help="Skip matched files whose relative path matches PATTERN (repeatable)")
+    run_parser.add_argument("--filter", action="append", default=[], metavar="SPEC",
+                            help="Input filter stage, e.g. drop-generated or max-hunk-lines:200 "
+                                 "(repeatable; replaces the playbook's default filters)")
+    run_parser.add_argument("--no-filters", action="store_true", help="Skip the playbook's default input filters")
+    run_parser.add_argument("--hook-mode", choices=HOOK_MODES, default="each",
+                            help="With --input globs or --max-tokens: post hooks per prompt, or once with a manifest")
+    run_parser.add_argument("--max-tokens", type=int, metavar="N",
+                            help="Split {{input}} into several prompts of at most ~N tokens each")
+    run_parser.add_argument("--chunk-by", choices=CHUNK_KINDS, default="auto",
+                            help="How to split for --max-tokens: per diff file/hunk, Solidity contract/function, or paragraph")
     run_parser.add_argument("--stdin", action="store_true", help="Read from stdin as {{input}}")
+    run_parser.add_argument("--git-diff", metavar="RANGE",
+                            help="Use `git diff RANGE` of the current repository as {{input}} (e.g. main...HEAD)")
+    run_parser.add_argument("--git-path", action="append", default=[], metavar="PATH",
+                            help="Limit --git-diff to these paths (repeatable)")
+    run_parser.add_argument("--git-stat", action="store_true", help="Use the --stat summary instead of the full diff")
+    run_parser.add_argument("--allow-missing", action="store_true",
+                            help="Render even if required vars are not set (placeholders are left in)")
     run_parser.add_argument("--vars", action="append", default=[], help="Variables as key=value (repeatable)")
     run_parser.add_argument("--pack", help="Load playbook from pack")
     run_parser.add_argument("--print-only", action="store_true", help="Print only, don't save")
     run_parser.add_argument("--copy", action="store_true", help="Copy output to clipboard")
+    run_parser.add_argument("--no-cache", action="store_true", help="Always render, ignoring the render cache")
+    run_parser.add_argument("--store", choices=sorted(OUTPUT_STORES),
+                            help="Output layout: flat timestamped files or content-addressed 'cas' (default: $PLAYBOOK_STORE or flat)")
+    run_parser.add_argument("--out-format", choices=["file"] + sorted(OUTPUT_SINKS), default="file",
+                            help="Save prompts as files, or append them to one JSONL file or SQLite database")
+    run_parser.add_argument("--sink", metavar="PATH",
+                            help="Sink path for --out-format jsonl/sqlite (default: out/prompts.<format>)")
+    run_parser.add_argument("--stream", action="store_true",
+                            help="Stream --input through an mmap instead of loading it (automatic for large files)")
+    run_parser.add_argument("--trace", nargs="?", const="-", metavar="FILE",
+                            help="Write per-phase timings as JSON lines to stderr or FILE (default: $PLAYBOOK_TRACE)")
+    run_parser.add_argument("--trace-memory", action="store_true",
+                            help="Add tracemalloc peak and top allocations to the trace")
+    run_parser.add_argument("--profile", metavar="FILE",
+                            help="Save cProfile stats for this run to FILE (view with python -m pstats)")
 
     # playbook list
     list_parser = subparsers.add_parser(
@@ -458,6 +4242,112 @@ def setup_parser() -> argparse.ArgumentParser:
         help="List available playbooks"
     )
     list_parser.add_argument("--pack", help="List playbooks in specific pack")
+    list_parser.add_argument("--vars", action="store_true",
+                             help="Show the variables each core and pack playbook needs")
+
+    # playbook batch
+    batch_parser = subparsers.add_parser(
+        "batch",
+        help="Render many playbooks from a JSONL job file"
+    )
+    batch_parser.add_argument("jobs_file", help="JSONL file with one job per line ('-' for stdin)")
+    batch_parser.add_argument("--print-only", action="store_true", help="Include prompts in the report, don't save")
+    batch_parser.add_argument("--no-hooks", action="store_true", help="Skip pre/post hooks for every job")
+    batch_parser.add_argument("--hook-mode", choices=HOOK_MODES, default="each",
+                              help="Run post hooks per job, or once at the end with a manifest of all outputs")
+    batch_parser.add_argument("--no-cache", action="store_true", help="Always render, ignoring the render cache")
+    batch_parser.add_argument("--store", choices=sorted(OUTPUT_STORES),
+                              help="Output layout: flat timestamped files or content-addressed 'cas' (default: $PLAYBOOK_STORE or flat)")
+    batch_parser.add_argument("--out-format", choices=["file"] + sorted(OUTPUT_SINKS), default="file",
+                              help="Save prompts as files, or append them to one JSONL file or SQLite database")
+    batch_parser.add_argument("--sink", metavar="PATH",
+                              help="Sink path for --out-format jsonl/sqlite (default: out/prompts.<format>)")
+    batch_parser.add_argument("--jobs", "-j", type=int, default=1, metavar="N",
+                              help="Render with N worker processes (0 = one per core)")
+    batch_parser.add_argument("--trace", nargs="?", const="-", metavar="FILE",
+                              help="Write per-phase timings as JSON lines to stderr or FILE (default: $PLAYBOOK_TRACE)")
+    batch_parser.add_argument("--trace-memory", action="store_true",
+                              help="Add tracemalloc peak and top allocations to the trace")
+    batch_parser.add_argument("--profile", metavar="FILE",
+                              help="Save cProfile stats for this run to FILE (view with python -m pstats)")
+
+    # playbook bench
+    bench_parser = subparsers.add_parser(
+        "bench",
+        help="Benchmark render throughput, startup, hooks and memory"
+    )
+    bench_parser.add_argument("--workload", action="append", choices=list(BENCH_WORKLOADS), metavar="NAME",
+                              help=f"Run only this workload (repeatable): {', '.join(BENCH_WORKLOADS)}")
+    bench_parser.add_argument("--seconds", type=float, default=1.0, metavar="N",
+                              help="Time budget per workload (default: 1.0)")
+    bench_parser.add_argument("--baseline", metavar="FILE",
+                              help=f"Baseline to compare against (default: {BENCH_BASELINE.name} if present)")
+    bench_parser.add_argument("--save-baseline", nargs="?", const="-", metavar="FILE",
+                              help="Save these results as the baseline instead of comparing")
+    bench_parser.add_argument("--tolerance", type=float, default=0.25,
+                              help="Allowed slowdown before failing, as a fraction (default: 0.25)")
+    bench_parser.add_argument("--json", action="store_true", help="Print results as JSON")
+
+    # playbook serve
+    serve_parser = subparsers.add_parser(
+        "serve",
+        help="Keep templates hot and render requests over a Unix socket"
+    )
+    serve_parser.add_argument("--socket", help="Socket path (default: $PLAYBOOK_SOCKET or the cache dir)")
+
+    # playbook watch
+    watch_parser = subparsers.add_parser(
+        "watch",
+        help="Re-render a playbook whenever its template or input changes"
+    )
+    watch_parser.add_argument("name", help="Playbook name (without .md extension)")
+    watch_parser.add_argument("--input", help="File to inject as {{input}}; a glob or directory watches every file")
+    watch_parser.add_argument("--recursive", "-r", action="store_true", help="Include files in subdirectories of an --input directory")
+    watch_parser.add_argument("--include", action="append", default=[], metavar="PATTERN",
+                              help="Only watch matched files whose relative path matches PATTERN (repeatable)")
+    watch_parser.add_argument("--exclude", action="append", default=[], metavar="PATTERN",
+                              help="Skip matched files whose relative path matches PATTERN (repeatable)")
+    watch_parser.add_argument("--vars", action="append", default=[], help="Variables as key=value (repeatable)")
+    watch_parser.add_argument("--pack", help="Load playbook from pack")
+    watch_parser.add_argument("--filter", action="append", default=[], metavar="SPEC",
+                              help="Input filter stage (repeatable; replaces the playbook's default filters)")
+    watch_parser.add_argument("--no-filters", action="store_true", help="Skip the playbook's default input filters")
+    watch_parser.add_argument("--no-hooks", action="store_true", help="Skip pre/post hooks on every render")
+    watch_parser.add_argument("--poll", action="store_true", help="Poll file stamps instead of using inotify")
+    watch_parser.add_argument("--interval", type=float, default=WATCH_POLL_INTERVAL, metavar="SECONDS",
+                              help=f"Polling interval (default: {WATCH_POLL_INTERVAL})")
+    watch_parser.add_argument("--debounce", type=float, default=WATCH_DEBOUNCE, metavar="SECONDS",
+                              help=f"Wait for writes to settle this long before rendering (default: {WATCH_DEBOUNCE})")
+
+    # playbook completion
+    completion_parser = subparsers.add_parser(
+        "completion",
+        help="Print a bash, zsh or fish completion script"
+    )
+    completion_parser.add_argument("shell", choices=COMPLETION_SHELLS, help="Shell to complete for")
+
+    # playbook gc
+    gc_parser = subparsers.add_parser(
+        "gc",
+        help="Prune old runs from the content-addressed output store"
+    )
+    gc_parser.add_argument("--keep-days", type=float, metavar="N", help="Keep runs from the last N days")
+    gc_parser.add_argument("--keep-last", type=int, metavar="N", help="Keep the N most recent runs")
+    gc_parser.add_argument("--dry-run", action="store_true", help="Report what would be removed")
+
+    # playbook pack
+    pack_parser = subparsers.add_parser(
+        "pack",
+        help="Manage playbook packs"
+    )
+    pack_subparsers = pack_parser.add_subparsers(dest="pack_command", metavar="COMMAND")
+    pack_subparsers.required = True
+    build_parser = pack_subparsers.add_parser(
+        "build",
+        help="Bundle a pack into a single file"
+    )
+    build_parser.add_argument("pack", help="Pack name under packs/")
+    build_parser.add_argument("--output", "-o", help=f"Bundle path (default: ./<pack>{BUNDLE_SUFFIX})")
 
     # playbook init
     init_parser = subparsers.add_parser(
@@ -469,14 +4359,105 @@ def setup_parser() -> argparse.ArgumentParser:
 
     return parser
 
+# `playbook run` options understood by parse_run_args (keep in step with setup_parser)
+RUN_FLAGS = {
+    "--stdin": "stdin",
+    "--print-only": "print_only",
+    "--copy": "copy",
+    "--no-cache": "no_cache",
+    "--stream": "stream",
+    "--trace-memory": "trace_memory",
+    "--recursive": "recursive",
+    "--no-filters": "no_filters",
+    "--allow-missing": "allow_missing",
+    "--git-stat": "git_stat",
+}
+RUN_OPTIONS = {
+    "--input": "input",
+    "--vars": "vars",
+    "--pack": "pack",
+    "--store": "store",
+    "--out-format": "out_format",
+    "--sink": "sink",
+    "--profile": "profile",
+    "--include": "include",
+    "--exclude": "exclude",
+    "--max-tokens": "max_tokens",
+    "--chunk-by": "chunk_by",
+    "--filter": "filter",
+    "--hook-mode": "hook_mode",
+    "--git-diff": "git_diff",
+    "--git-path": "git_path",
+}
+RUN_APPEND = ("vars", "include", "exclude", "filter", "git_path")
+
+def parse_run_args(argv: list):
+    """Parse a plain `run` command line without argparse.
+
+    Returns None for anything else (other subcommands, --help, --trace,
+    abbreviations, invalid choices, ...), so that argparse handles it and
+    reports errors exactly as before.
+    """
+    if not argv or argv[0] != "run":
+        return None
+    import types
+    args = types.SimpleNamespace(
+        subcommand="run", name=None, out_format="file", chunk_by="auto", hook_mode="each", trace=None,
+        **{dest: [] for dest in RUN_APPEND},
+        **{dest: None for dest in RUN_OPTIONS.values()
+           if dest not in RUN_APPEND + ("out_format", "chunk_by", "hook_mode")},
+        **{dest: False for dest in RUN_FLAGS.values()}
+    )
+    tokens = iter(argv[1:])
+    for token in tokens:
+        if not token.startswith("-"):
+            if args.name is not None:
+                return None
+            args.name = token
+            continue
+        option, has_value, value = token.partition("=")
+        if option in RUN_FLAGS and not has_value:
+            setattr(args, RUN_FLAGS[option], True)
+            continue
+        if option not in RUN_OPTIONS:
+            return None
+        if not has_value:
+            value = next(tokens, None)
+            if value is None or value.startswith("-"):
+                return None
+        dest = RUN_OPTIONS[option]
+        if dest in RUN_APPEND:
+            getattr(args, dest).append(value)
+        else:
+            setattr(args, dest, value)
+    if args.name is None:
+        return None
+    if args.store not in (None, *OUTPUT_STORES) or args.out_format not in ("file", *OUTPUT_SINKS):
+        return None
+    if args.chunk_by not in CHUNK_KINDS or args.hook_mode not in HOOK_MODES:
+        return None
+    if args.max_tokens is not None:
+        if not args.max_tokens.isdigit():
+            return None
+        args.max_tokens = int(args.max_tokens)
+    return args
+
 # ============================================================================
 # MAIN ENTRY POINT
 # ============================================================================
 
 def main():
     """Main CLI entry point with legacy support."""
+    # Tab completion fallback: no parser, just the indexes
+    if len(sys.argv) > 1 and sys.argv[1] == "__complete":
+        try:
+            print("\n".join(complete(sys.argv[2:])))
+        except (OSError, ValueError):
+            pass
+        return
+
     # Check for legacy syntax (no subcommand)
-    if len(sys.argv) > 1 and sys.argv[1] not in ["run", "list", "init", "--help", "-h"]:
+    if len(sys.argv) > 1 and sys.argv[1] not in SUBCOMMANDS + ["--help", "-h"]:
         # Legacy syntax detected
         print(
             f"Warning: Legacy syntax deprecated. Use: playbook run {sys.argv[1]} [options]",
@@ -490,27 +4471,44 @@ def main():
         # Convert to new syntax
         sys.argv.insert(1, "run")
 
-    # Parse arguments
-    parser = setup_parser()
+    # Plain `playbook run` invocations skip building the full parser
+    args = parse_run_args(sys.argv[1:])
+    if args is None:
+        parser = setup_parser()
 
-    # Show help if no subcommand
-    if len(sys.argv) == 1:
-        parser.print_help()
-        sys.exit(0)
+        # Show help if no subcommand
+        if len(sys.argv) == 1:
+            parser.print_help()
+            sys.exit(0)
 
-    args = parser.parse_args()
+        args = parser.parse_args()
 
     # Route to subcommand
     try:
-        if args.subcommand == "run":
-            cmd_run(args)
-        elif args.subcommand == "list":
-            cmd_list(args)
-        elif args.subcommand == "init":
-            cmd_init(args)
-        else:
-            parser.print_help()
-            sys.exit(1)
+        with instrumented(args.subcommand, args):
+            if args.subcommand == "run":
+                cmd_run(args)
+            elif args.subcommand == "list":
+                cmd_list(args)
+            elif args.subcommand == "batch":
+                cmd_batch(args)
+            elif args.subcommand == "bench":
+                cmd_bench(args)
+            elif args.subcommand == "serve":
+                cmd_serve(args)
+            elif args.subcommand == "watch":
+                cmd_watch(args)
+            elif args.subcommand == "completion":
+                cmd_completion(args)
+            elif args.subcommand == "gc":
+                cmd_gc(args)
+            elif args.subcommand == "pack":
+                cmd_pack(args)
+            elif args.subcommand == "init":
+                cmd_init(args)
+            else:
+                setup_parser().print_help()
+                sys.exit(1)
 
     except (FileNotFoundError, ValueError) as e:
         print(f"Error: {e}", file=sys.stderr)
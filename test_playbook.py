@@ -9,7 +9,10 @@ import unittest
 import tempfile
 import os
 import json
+import hashlib
+import shutil
 import sys
+import time
 from pathlib import Path
 
 # Import playbook module
@@ -53,6 +56,158 @@ class TestVariableSubstitution(unittest.TestCase):
         result = playbook.render(template, {})
         self.assertEqual(result, "{{a}} {{b}} {{c}}")
 
+class TestTemplateCache(unittest.TestCase):
+    """Test compiled templates and the template caches."""
+
+    def setUp(self):
+        """Create a scratch template and cache directory."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.orig_cache_dir = playbook.CACHE_DIR
+        playbook.CACHE_DIR = Path(self.temp_dir) / "cache"
+        self.path = Path(self.temp_dir) / "t.md"
+        self.path.write_text("A {{x}} B {{y}} C {{x}}")
+
+    def tearDown(self):
+        """Restore cache settings and clean up."""
+        playbook.CACHE_DIR = self.orig_cache_dir
+        os.environ.pop(playbook.DISK_CACHE_ENV, None)
+        import shutil
+        shutil.rmtree(self.temp_dir)
+
+    def test_compiled_render_matches_regex(self):
+        """Segment join gives the same result as regex substitution."""
+        source = "{{a}}{{b}} x {{missing}} {{a}}\n{{ not_a_var }}"
+        values = {"a": "1", "b": "{{a}}"}
+        expected = playbook.VAR_PATTERN.sub(lambda m: values.get(m.group(1), m.group(0)), source)
+        self.assertEqual(playbook.Template(source).render(values), expected)
+        self.assertEqual(playbook.Template(source).keys, ("a", "b", "missing", "a"))
+
+    def test_compile_template_is_memoized(self):
+        """Compiling the same text twice returns the cached Template."""
+        source = "cache me {{x}}"
+        self.assertIs(playbook.compile_template(source), playbook.compile_template(source))
+
+    def test_file_cache_invalidated_by_mtime(self):
+        """Editing a template file is picked up on the next load."""
+        first = playbook.load_template_file(self.path)
+        self.assertIs(playbook.load_template_file(self.path), first)
+        self.path.write_text("changed {{z}}")
+        os.utime(self.path, ns=(0, 1))
+        self.assertEqual(playbook.load_template_file(self.path).render({"z": "!"}), "changed !")
+
+    def test_disk_cache_round_trip(self):
+        """The on-disk cache restores the template and survives a touch."""
+        os.environ[playbook.DISK_CACHE_ENV] = "1"
+        playbook.load_template_file(self.path)
+        playbook._template_files.clear()
+        os.utime(self.path, ns=(10**9, 10**9))
+        restored = playbook.load_template_file(self.path)
+        self.assertEqual(restored.source, self.path.read_text())
+        self.assertEqual(restored.render({"x": "1", "y": "2"}), "A 1 B 2 C 1")
+        self.assertEqual(len(list((playbook.CACHE_DIR / "templates").iterdir())), 1)
+
+class TestPartials(unittest.TestCase):
+    """Test {{> partial}} includes and their dependency tracking."""
+
+    def setUp(self):
+        """Create core and pack playbooks sharing partials."""
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.orig = (playbook.PLAYBOOKS_DIR, playbook.PACKS_DIR, playbook.CACHE_DIR)
+        playbook.PLAYBOOKS_DIR = self.temp_dir / "playbooks"
+        playbook.PACKS_DIR = self.temp_dir / "packs"
+        playbook.CACHE_DIR = self.temp_dir / "cache"
+        self.partials = playbook.PLAYBOOKS_DIR / "partials"
+        self.partials.mkdir(parents=True)
+        (self.partials / "rules.md").write_text("RULES for {{repo}}\n{{> footer}}\n")
+        (self.partials / "footer.md").write_text("-- end\n")
+        (playbook.PLAYBOOKS_DIR / "review.md").write_text("Review\n{{> rules}}\n{{input}}\n")
+        (playbook.PLAYBOOKS_DIR / "plain.md").write_text("plain {{x}}\n")
+        pack_dir = playbook.PACKS_DIR / "sec"
+        (pack_dir / "meta").mkdir(parents=True)
+        (pack_dir / "playbooks" / "partials").mkdir(parents=True)
+        (pack_dir / "meta" / "manifest.json").write_text(
+            json.dumps({"name": "sec", "version": "1.0.0", "playbooks": ["deep"]}))
+        (pack_dir / "playbooks" / "deep.md").write_text("Deep {{> rules}}")
+        (pack_dir / "playbooks" / "partials" / "footer.md").write_text("-- sec {{ticket}}\n")
+
+    def tearDown(self):
+        """Restore paths and clean up."""
+        playbook.PLAYBOOKS_DIR, playbook.PACKS_DIR, playbook.CACHE_DIR = self.orig
+        playbook._vars_indexes.clear()
+        playbook._pack_indexes.clear()
+        os.environ.pop(playbook.DISK_CACHE_ENV, None)
+        import shutil
+        shutil.rmtree(self.temp_dir)
+
+    def edit(self, path: Path, text: str):
+        """Rewrite path with a new mtime, as an editor would."""
+        stamp = path.stat().st_mtime_ns + 10 ** 9
+        path.write_text(text)
+        os.utime(str(path), ns=(stamp, stamp))
+
+    def test_flattened(self):
+        """Includes nest, drop one trailing newline and prefer the pack's partials."""
+        self.assertEqual(playbook.load_playbook("review"), "Review\nRULES for {{repo}}\n-- end\n{{input}}\n")
+        self.assertEqual(playbook.load_playbook("deep", pack="sec"), "Deep RULES for {{repo}}\n-- sec {{ticket}}")
+        self.assertEqual(playbook.playbook_vars("deep", pack="sec"), ["repo", "ticket"])
+
+    def test_partial_change_invalidates_dependents_only(self):
+        """Editing a partial recompiles the templates that include it and nothing else."""
+        review = playbook.load_template("review")
+        plain = playbook.load_template("plain")
+        self.assertEqual(playbook.playbook_vars("review"), ["repo", "input"])
+        self.assertEqual(playbook.template_partials(playbook.PLAYBOOKS_DIR / "plain.md"), [])
+
+        self.edit(self.partials / "footer.md", "-- {{who}}\n")
+        self.assertIs(playbook.load_template("plain"), plain)
+        self.assertIsNot(playbook.load_template("review"), review)
+        self.assertIn("-- {{who}}", playbook.load_playbook("review"))
+        self.assertEqual(playbook.playbook_vars("review"), ["repo", "who", "input"])
+
+    def test_cycle_detected_at_compile_time(self):
+        """An include cycle fails on load, naming the chain; the vars index records it."""
+        self.edit(self.partials / "footer.md", "{{> rules}}")
+        with self.assertRaises(ValueError) as ctx:
+            playbook.load_template("review")
+        self.assertIn("rules -> footer -> rules", str(ctx.exception))
+        self.assertIn("cycle", playbook.refresh_vars_index()["review"]["error"])
+
+        self.edit(self.partials / "footer.md", "fixed\n")
+        self.assertIn("fixed", playbook.load_playbook("review"))
+        self.assertNotIn("error", playbook.refresh_vars_index()["review"])
+
+    def test_missing_partial(self):
+        """An unknown include raises FileNotFoundError listing where it looked."""
+        (playbook.PLAYBOOKS_DIR / "broken.md").write_text("{{> nope}}")
+        with self.assertRaises(FileNotFoundError) as ctx:
+            playbook.load_template("broken")
+        self.assertIn("nope", str(ctx.exception))
+
+    def test_disk_cache_tracks_partials(self):
+        """A template restored from disk is still invalidated by its partials."""
+        os.environ[playbook.DISK_CACHE_ENV] = "1"
+        playbook.load_template("review")
+        playbook._template_files.clear()
+        self.assertIn("-- end", playbook.load_playbook("review"))
+        playbook._template_files.clear()
+        self.edit(self.partials / "footer.md", "-- new\n")
+        self.assertIn("-- new", playbook.load_playbook("review"))
+
+    def test_bundle_and_registry(self):
+        """Bundles carry pack partials; PlaybookRegistry flattens the same way."""
+        bundle = playbook.build_bundle("sec", self.temp_dir / "sec.pbpack")
+        import shutil
+        shutil.rmtree(str(playbook.PACKS_DIR / "sec"))
+        shutil.move(str(bundle), str(playbook.PACKS_DIR / "sec.pbpack"))
+        expected = "Deep RULES for {{repo}}\n-- sec {{ticket}}"
+        self.assertEqual(playbook.load_playbook("deep", pack="sec"), expected)
+        registry = playbook.PlaybookRegistry(playbook.PLAYBOOKS_DIR, playbook.PACKS_DIR)
+        self.assertEqual(registry.template("deep", pack="sec").source, expected)
+        registry.template("review")
+        self.edit(self.partials / "footer.md", "{{> footer}}")
+        with self.assertRaises(ValueError):
+            registry.template("review")
+
 class TestParseVars(unittest.TestCase):
     """Test variable parsing from command line."""
 
@@ -99,8 +254,11 @@ class TestPackManagement(unittest.TestCase):
     def setUp(self):
         """Create temporary pack structure."""
         self.temp_dir = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
         self.orig_packs_dir = playbook.PACKS_DIR
+        self.orig_cache_dir = playbook.CACHE_DIR
         playbook.PACKS_DIR = Path(self.temp_dir)
+        playbook.CACHE_DIR = Path(self.cache_dir)
 
         # Create sample pack
         pack_dir = playbook.PACKS_DIR / "test-pack"
@@ -122,8 +280,11 @@ class TestPackManagement(unittest.TestCase):
     def tearDown(self):
         """Clean up temporary files."""
         playbook.PACKS_DIR = self.orig_packs_dir
+        playbook.CACHE_DIR = self.orig_cache_dir
+        playbook._pack_indexes.clear()
         import shutil
         shutil.rmtree(self.temp_dir)
+        shutil.rmtree(self.cache_dir)
 
     def test_load_manifest(self):
         """Manifest loads and parses correctly."""
@@ -197,6 +358,289 @@ class TestPackManagement(unittest.TestCase):
         packs = playbook.discover_packs()
         self.assertIn("test-pack", packs)
 
+    def test_pack_index_persisted(self):
+        """The pack index is written to disk with versions and file hashes."""
+        playbook.discover_packs()
+        index = json.loads(playbook.pack_index_path().read_text())
+        entry = index["packs"]["test-pack"]
+        self.assertEqual(entry["version"], "1.0.0")
+        self.assertEqual(entry["playbooks"], ["test_playbook"])
+        self.assertEqual(len(entry["files"]["test_playbook"]["sha256"]), 64)
+
+    def test_pack_index_reindexes_changed_pack_only(self):
+        """Unchanged packs are served from the index without reparsing."""
+        other = playbook.PACKS_DIR / "other"
+        (other / "meta").mkdir(parents=True)
+        (other / "meta" / "manifest.json").write_text(
+            json.dumps({"name": "other", "version": "1.0.0", "playbooks": []}))
+        playbook.discover_packs()
+        playbook._pack_indexes.clear()
+
+        manifest_path = playbook.PACKS_DIR / "test-pack" / "meta" / "manifest.json"
+        manifest_path.write_text(json.dumps(dict(self.manifest, version="2.0.0")))
+        os.utime(manifest_path, ns=(1, 1))
+        indexed = []
+        orig_index_pack = playbook._index_pack
+        playbook._index_pack = lambda name, stamp: indexed.append(name) or orig_index_pack(name, stamp)
+        try:
+            packs = playbook.refresh_pack_index()
+        finally:
+            playbook._index_pack = orig_index_pack
+        self.assertEqual(indexed, ["test-pack"])
+        self.assertEqual(packs["test-pack"]["version"], "2.0.0")
+
+    def test_pack_index_reports_invalid_manifest(self):
+        """Invalid manifests stay listed but fail when used."""
+        manifest_path = playbook.PACKS_DIR / "test-pack" / "meta" / "manifest.json"
+        manifest_path.write_text(json.dumps({"name": "test-pack"}))
+        os.utime(manifest_path, ns=(2, 2))
+        self.assertIn("test-pack", playbook.discover_packs())
+        with self.assertRaises(ValueError):
+            playbook.load_playbook("test_playbook", pack="test-pack")
+
+class TestPackBundles(unittest.TestCase):
+    """Test single-file pack bundles."""
+
+    def setUp(self):
+        """Create a pack directory and a separate packs dir for the bundle."""
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.orig = (playbook.PACKS_DIR, playbook.CACHE_DIR)
+        playbook.CACHE_DIR = self.temp_dir / "cache"
+        playbook.PACKS_DIR = self.temp_dir / "src"
+        pack_dir = playbook.PACKS_DIR / "bundled"
+        (pack_dir / "meta").mkdir(parents=True)
+        (pack_dir / "playbooks").mkdir()
+        (pack_dir / "meta" / "manifest.json").write_text(json.dumps(
+            {"name": "bundled", "version": "1.2.0", "playbooks": ["greet"]}))
+        (pack_dir / "playbooks" / "greet.md").write_text("Hi {{who}}")
+        self.bundle = playbook.build_bundle("bundled", self.temp_dir / "installed" / "bundled.pbpack")
+        playbook.PACKS_DIR = self.temp_dir / "installed"
+
+    def tearDown(self):
+        """Restore paths and clean up."""
+        playbook.PACKS_DIR, playbook.CACHE_DIR = self.orig
+        import shutil
+        shutil.rmtree(self.temp_dir)
+
+    def test_bundle_is_one_stored_zip(self):
+        """Bundles hold the manifest and playbooks uncompressed."""
+        import zipfile
+        with zipfile.ZipFile(str(self.bundle)) as zf:
+            self.assertEqual(zf.namelist(), ["meta/manifest.json", "playbooks/greet.md"])
+            self.assertTrue(all(i.compress_type == zipfile.ZIP_STORED for i in zf.infolist()))
+
+    def test_load_from_bundle(self):
+        """Manifests and playbooks are read straight from the bundle."""
+        self.assertIn("bundled", playbook.discover_packs())
+        self.assertEqual(playbook.load_manifest("bundled")["version"], "1.2.0")
+        self.assertEqual(playbook.discover_playbooks(pack="bundled"), ["greet"])
+        self.assertEqual(playbook.load_playbook("greet", pack="bundled"), "Hi {{who}}")
+        self.assertEqual(playbook.playbook_path("greet", pack="bundled"), self.bundle)
+
+    def test_bundle_build_is_reproducible(self):
+        """Rebuilding an unchanged pack gives identical bytes."""
+        playbook.PACKS_DIR = self.temp_dir / "src"
+        again = playbook.build_bundle("bundled", self.temp_dir / "again.pbpack")
+        self.assertEqual(again.read_bytes(), self.bundle.read_bytes())
+
+    def test_invalid_bundle(self):
+        """A corrupt bundle raises ValueError."""
+        (playbook.PACKS_DIR / "broken.pbpack").write_bytes(b"not a zip")
+        with self.assertRaises(ValueError):
+            playbook.load_manifest("broken")
+
+class TestVarsIndex(unittest.TestCase):
+    """Test the cached placeholder index, list --vars and the missing-vars check."""
+
+    def setUp(self):
+        """Create core playbooks and a pack in a temporary tree."""
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.orig = (playbook.PLAYBOOKS_DIR, playbook.PACKS_DIR, playbook.CACHE_DIR, playbook.OUT_DIR)
+        playbook.PLAYBOOKS_DIR = self.temp_dir / "playbooks"
+        playbook.PACKS_DIR = self.temp_dir / "packs"
+        playbook.CACHE_DIR = self.temp_dir / "cache"
+        playbook.OUT_DIR = self.temp_dir / "out"
+        playbook.PLAYBOOKS_DIR.mkdir()
+        (playbook.PLAYBOOKS_DIR / "review.md").write_text("{{repo}} {{date}} {{input}} {{repo}} {{risk}}")
+        (playbook.PLAYBOOKS_DIR / "plain.md").write_text("No vars on {{date}}")
+        pack_dir = playbook.PACKS_DIR / "p"
+        (pack_dir / "meta").mkdir(parents=True)
+        (pack_dir / "playbooks").mkdir()
+        (pack_dir / "meta" / "manifest.json").write_text(
+            json.dumps({"name": "p", "version": "1.0.0", "playbooks": ["greet"]}))
+        (pack_dir / "playbooks" / "greet.md").write_text("Hi {{who}}")
+
+    def tearDown(self):
+        """Restore paths and clean up."""
+        playbook.PLAYBOOKS_DIR, playbook.PACKS_DIR, playbook.CACHE_DIR, playbook.OUT_DIR = self.orig
+        playbook._vars_indexes.clear()
+        playbook._pack_indexes.clear()
+        import shutil
+        shutil.rmtree(self.temp_dir)
+
+    def test_pack_playbook_edited_in_place(self):
+        """Editing a pack playbook refreshes its vars though the directory mtime is unchanged."""
+        self.assertEqual(playbook.playbook_vars("greet", pack="p"), ["who"])
+        path = playbook.PACKS_DIR / "p" / "playbooks" / "greet.md"
+        dir_stamp = path.parent.stat().st_mtime_ns
+        path.write_text("Hello {{name}}, {{who}}")
+        os.utime(str(path.parent), ns=(dir_stamp, dir_stamp))
+        self.assertEqual(playbook.playbook_vars("greet", pack="p"), ["name", "who"])
+
+    def test_python_pre_hook_skips_missing_check(self):
+        """A pre.py hook may supply vars, so run does not reject them up front."""
+        orig_hooks = playbook.HOOKS_DIR
+        playbook.HOOKS_DIR = self.temp_dir / "hooks"
+        playbook.HOOKS_DIR.mkdir()
+        (playbook.HOOKS_DIR / "pre.py").write_text("def hook(vars, out_file):\n    vars['who'] = 'hook'\n")
+        args = playbook.parse_run_args(["run", "greet", "--pack", "p", "--print-only", "--no-cache"])
+        import io
+        from contextlib import redirect_stdout
+        stdout = io.StringIO()
+        try:
+            with redirect_stdout(stdout):
+                playbook.cmd_run(args)
+        finally:
+            playbook.HOOKS_DIR = orig_hooks
+        self.assertIn("Hi hook", stdout.getvalue())
+
+    def test_vars_in_order_once(self):
+        """Placeholders are listed once each; built-ins are not required."""
+        self.assertEqual(playbook.playbook_vars("review"), ["repo", "date", "input", "risk"])
+        self.assertEqual(playbook.required_vars(playbook.playbook_vars("review")), ["repo", "input", "risk"])
+        self.assertEqual(playbook.playbook_vars("greet", pack="p"), ["who"])
+        with self.assertRaises(FileNotFoundError):
+            playbook.playbook_vars("nope")
+
+    def test_index_is_reused_until_mtime_changes(self):
+        """Unchanged files are not read again, even by a fresh process."""
+        playbook.refresh_vars_index()
+        playbook._vars_indexes.clear()  # as if in a new process
+        orig_load = playbook.load_template_file
+        playbook.load_template_file = None
+        try:
+            self.assertEqual(playbook.playbook_vars("review"), ["repo", "date", "input", "risk"])
+        finally:
+            playbook.load_template_file = orig_load
+        path = playbook.PLAYBOOKS_DIR / "review.md"
+        stamp = path.stat().st_mtime_ns + 10 ** 9
+        path.write_text("{{title}}")
+        os.utime(str(path), ns=(stamp, stamp))
+        self.assertEqual(playbook.playbook_vars("review"), ["title"])
+
+    def test_list_vars(self):
+        """list --vars shows the required vars of core and pack playbooks."""
+        import argparse
+        import io
+        from contextlib import redirect_stdout
+        stdout = io.StringIO()
+        with redirect_stdout(stdout):
+            playbook.cmd_list(argparse.Namespace(pack=None, vars=True))
+        lines = stdout.getvalue().splitlines()
+        self.assertIn("  plain   (none)", lines)
+        self.assertIn("  review  repo, input, risk", lines)
+        self.assertIn("Pack 'p':", lines)
+        self.assertIn("  greet  who", lines)
+
+    def test_run_fails_fast_on_missing_vars(self):
+        """run names the missing vars before reading input or running hooks."""
+        import argparse
+        args = argparse.Namespace(name="review", pack=None, vars=["repo=x"], input=None, stdin=False,
+                                  allow_missing=False, git_diff=None, git_path=[], git_stat=False)
+        with self.assertRaises(ValueError) as cm:
+            playbook.cmd_run(args)
+        self.assertIn("'review': input, risk", str(cm.exception))
+        self.assertEqual(playbook.missing_vars("review", None, {"repo": "x", "risk": "y"}, has_input=True), [])
+
+class TestPlaybookRegistry(unittest.TestCase):
+    """Test the embeddable PlaybookRegistry API."""
+
+    def setUp(self):
+        """Create core playbooks, a pack directory, a bundle and a licensed pack."""
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.core = self.temp_dir / "playbooks"
+        self.core.mkdir()
+        (self.core / "hello.md").write_text("Hello {{who}} on {{date}}")
+        self.packs = self.temp_dir / "packs"
+        for pack, extra in (("team", {}), ("paid", {"requires_license": True, "license_env": "PAID_KEY"}),
+                            ("misnamed", {"name": "other"})):
+            (self.packs / pack / "meta").mkdir(parents=True)
+            (self.packs / pack / "playbooks").mkdir()
+            manifest = dict({"name": pack, "version": "1.0.0", "playbooks": ["greet"]}, **extra)
+            (self.packs / pack / "meta" / "manifest.json").write_text(json.dumps(manifest))
+            (self.packs / pack / "playbooks" / "greet.md").write_text(f"{pack}: hi {{{{who}}}}")
+        orig = playbook.PACKS_DIR
+        playbook.PACKS_DIR = self.packs
+        try:
+            playbook.build_bundle("team", self.packs / "boxed.pbpack")
+        finally:
+            playbook.PACKS_DIR = orig
+        self.registry = playbook.PlaybookRegistry(self.core, self.packs, environ={})
+
+    def tearDown(self):
+        """Clean up."""
+        import shutil
+        shutil.rmtree(self.temp_dir)
+
+    def test_render_core_and_packs(self):
+        """Core, pack directory and bundle playbooks all render."""
+        self.assertEqual(self.registry.playbooks(), ["hello"])
+        self.assertEqual(self.registry.packs(), ["boxed", "misnamed", "paid", "team"])
+        self.assertTrue(self.registry.render("hello", {"who": "you"}).startswith("Hello you on 2"))
+        self.assertEqual(self.registry.render("greet", {"who": "x"}, pack="team"), "team: hi x")
+        self.assertEqual(self.registry.render("greet", {"who": "x"}, pack="boxed"), "team: hi x")
+
+    def test_render_to(self):
+        """render_to writes bytes and accepts bytes-like values."""
+        import io
+        out = io.BytesIO()
+        written = self.registry.render_to(out, "greet", {"who": b"bytes"}, pack="team")
+        self.assertEqual(out.getvalue(), b"team: hi bytes")
+        self.assertEqual(written, len(out.getvalue()))
+
+    def test_errors_raise_without_output(self):
+        """Missing playbooks and licenses raise; nothing is printed or exits."""
+        import io
+        from contextlib import redirect_stdout, redirect_stderr
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            with self.assertRaises(playbook.LicenseError):
+                self.registry.template("greet", pack="paid")
+            with self.assertRaises(FileNotFoundError):
+                self.registry.template("nope")
+            with self.assertRaises(FileNotFoundError):
+                self.registry.template("nope", pack="team")
+            with self.assertRaises(FileNotFoundError):
+                self.registry.template("greet", pack="ghost")
+            self.registry.template("greet", pack="misnamed")
+        self.assertEqual((stdout.getvalue(), stderr.getvalue()), ("", ""))
+        licensed = playbook.PlaybookRegistry(self.core, self.packs, environ={"PAID_KEY": "k"})
+        self.assertEqual(licensed.render("greet", {"who": "x"}, pack="paid"), "paid: hi x")
+
+    def test_templates_reused_until_changed(self):
+        """The compiled Template is cached and recompiled after an edit."""
+        first = self.registry.template("hello")
+        self.assertIs(self.registry.template("hello"), first)
+        self.assertIsInstance(first, playbook.Template)
+        self.assertFalse(hasattr(first, "__dict__"))
+        path = self.core / "hello.md"
+        stamp = path.stat().st_mtime_ns + 10 ** 9
+        path.write_text("Bye {{who}}")
+        os.utime(str(path), ns=(stamp, stamp))
+        self.assertEqual(self.registry.template("hello").keys, ("who",))
+        pinned = playbook.PlaybookRegistry(self.core, self.packs, auto_reload=False)
+        template = pinned.template("hello")
+        path.unlink()
+        self.assertIs(pinned.template("hello"), template)
+
+    def test_shared_across_threads(self):
+        """Many threads can render through one registry."""
+        from concurrent.futures import ThreadPoolExecutor
+        jobs = [("greet", {"who": str(i)}, pack) for i in range(200) for pack in ("team", "boxed")]
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(lambda job: self.registry.render(job[0], job[1], pack=job[2]), jobs))
+        self.assertEqual(results, [f"team: hi {vars_dict['who']}" for _, vars_dict, _ in jobs])
+
 class TestPlaybookLoading(unittest.TestCase):
     """Test playbook loading from core and packs."""
 
@@ -222,6 +666,1597 @@ class TestPlaybookLoading(unittest.TestCase):
         with self.assertRaises(FileNotFoundError):
             playbook.load_playbook("nonexistent_playbook_xyz")
 
+class TestBatch(unittest.TestCase):
+    """Test JSONL batch rendering."""
+
+    def setUp(self):
+        """Redirect output and hooks into a temporary directory."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.orig_out_dir = playbook.OUT_DIR
+        self.orig_hooks_dir = playbook.HOOKS_DIR
+        self.orig_cache_dir = playbook.CACHE_DIR
+        playbook.OUT_DIR = Path(self.temp_dir) / "out"
+        playbook.HOOKS_DIR = Path(self.temp_dir) / "hooks"
+        playbook.CACHE_DIR = Path(self.temp_dir) / "cache"
+
+    def tearDown(self):
+        """Restore paths and clean up."""
+        playbook.OUT_DIR = self.orig_out_dir
+        playbook.HOOKS_DIR = self.orig_hooks_dir
+        playbook.CACHE_DIR = self.orig_cache_dir
+        import shutil
+        shutil.rmtree(self.temp_dir)
+
+    def run_batch(self, lines, print_only=False, jobs=1, out_format="file"):
+        """Run cmd_batch over lines and return (records, exit_code)."""
+        import argparse
+        import io
+        from contextlib import redirect_stdout, redirect_stderr
+        jobs_file = Path(self.temp_dir) / "jobs.jsonl"
+        jobs_file.write_text("\n".join(lines) + "\n")
+        args = argparse.Namespace(jobs_file=str(jobs_file), print_only=print_only,
+                                  no_hooks=True, jobs=jobs, no_cache=True, hook_mode="each",
+                                  store=None, out_format=out_format, sink=None)
+        stdout = io.StringIO()
+        code = 0
+        with redirect_stdout(stdout), redirect_stderr(io.StringIO()):
+            try:
+                playbook.cmd_batch(args)
+            except SystemExit as e:
+                code = e.code
+        records = [json.loads(l) for l in stdout.getvalue().splitlines()]
+        return records, code
+
+    def test_parse_job(self):
+        """Job lines accept vars as an object or key=value list."""
+        job = playbook.parse_job('{"name": "review_pr", "vars": ["repo=x"]}')
+        self.assertEqual(job["vars"], {"repo": "x"})
+        self.assertIsNone(job["pack"])
+        job = playbook.parse_job('{"name": "review_pr", "vars": {"n": 1}}')
+        self.assertEqual(job["vars"], {"n": "1"})
+
+    def test_parse_job_missing_name(self):
+        """Jobs without a name raise ValueError."""
+        with self.assertRaises(ValueError):
+            playbook.parse_job('{"vars": {}}')
+
+    def test_batch_matches_run_output(self):
+        """Batch jobs render the same prompt as a single run."""
+        input_file = Path(self.temp_dir) / "change.diff"
+        input_file.write_text("+ added line")
+        job = {"name": "review_pr", "vars": {"repo": "r", "date": "d", "time_utc": "t"},
+               "input": str(input_file)}
+        records, code = self.run_batch([json.dumps(job), json.dumps(job)])
+        self.assertEqual(code, 0)
+        self.assertEqual([r["status"] for r in records], ["ok", "ok"])
+
+        single = playbook.make_job("review_pr", vars_dict=job["vars"], input_path=str(input_file))
+        expected, _ = playbook.run_job(single, print_only=True, hooks=False)
+        for record in records:
+            self.assertEqual(Path(record["out_file"]).read_text(), expected)
+        self.assertNotEqual(records[0]["out_file"], records[1]["out_file"])
+
+    def test_hook_output_stays_off_stdout(self):
+        """Hook output goes to stderr, so batch stdout stays JSON lines."""
+        import subprocess
+        hooks = Path(self.temp_dir) / "hooks"
+        (hooks / "post.d").mkdir(parents=True)
+        (hooks / "pre.sh").write_text('echo "[pre] running for $PLAYBOOK_NAME"\n')
+        (hooks / "post.py").write_text("def hook(vars, out_file):\n    print('[post] python')\n")
+        (hooks / "post.d" / "notify.sh").write_text("echo '[post.d] notify'\n")
+        jobs_file = Path(self.temp_dir) / "jobs.jsonl"
+        jobs_file.write_text('{"name": "review_pr", "vars": {"repo": "r"}}\n' * 2)
+        code = (
+            "import sys; from pathlib import Path; sys.path.insert(0, sys.argv[1]); import playbook; "
+            "root = Path(sys.argv[2]); playbook.OUT_DIR = root / 'out'; playbook.HOOKS_DIR = root / 'hooks'; "
+            "playbook.CACHE_DIR = root / 'cache'; "
+            "sys.argv = ['playbook', 'batch', str(root / 'jobs.jsonl')]; playbook.main()"
+        )
+        out = subprocess.run([sys.executable, "-c", code, str(Path(playbook.__file__).parent), self.temp_dir],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+                             universal_newlines=True)
+        records = [json.loads(line) for line in out.stdout.splitlines()]
+        self.assertEqual([r["status"] for r in records], ["ok", "ok"])
+        self.assertEqual(out.stderr.count("[pre] running for review_pr"), 2)
+        self.assertEqual(out.stderr.count("[post] python"), 2)
+        self.assertEqual(out.stderr.count("[post.d] notify"), 2)
+
+    def test_batch_reports_errors_per_job(self):
+        """A failing job is reported without stopping the batch."""
+        records, code = self.run_batch([
+            '{"name": "nonexistent_playbook_xyz"}',
+            'not json',
+            '{"name": "review_pr"}',
+        ], print_only=True)
+        self.assertEqual(code, 1)
+        self.assertEqual([r["status"] for r in records], ["error", "error", "ok"])
+        self.assertIn("Playbook not found", records[0]["error"])
+        self.assertIn("PR reviews", records[2]["prompt"])
+
+    def test_parallel_batch_keeps_order(self):
+        """Worker processes return the same records in input order."""
+        lines = [json.dumps({"name": "review_pr", "vars": {"repo": str(i), "date": "d", "time_utc": "t"}})
+                 for i in range(6)]
+        lines.insert(3, '{"name": "nonexistent_playbook_xyz"}')
+        serial, _ = self.run_batch(lines, print_only=True)
+        parallel, code = self.run_batch(lines, print_only=True, jobs=3)
+        self.assertEqual(code, 1)
+        self.assertEqual(parallel, serial)
+
+    def test_parallel_batch_into_sink(self):
+        """Every worker commits its records to the shared sink."""
+        lines = [json.dumps({"name": "review_pr", "vars": {"repo": str(i)}}) for i in range(6)]
+        records, code = self.run_batch(lines, jobs=3, out_format="jsonl")
+        self.assertEqual(code, 0)
+        sink = playbook.OUT_DIR / "prompts.jsonl"
+        self.assertEqual({r["out_file"] for r in records}, {str(sink)})
+        saved = list(playbook.iter_sink(sink))
+        self.assertEqual(sorted(r["vars"]["repo"] for r in saved), [str(i) for i in range(6)])
+        self.assertEqual(sorted(r["tag"] for r in saved), [str(i) for i in range(1, 7)])
+
+    def test_resolve_workers(self):
+        """--jobs 0 means one worker per core."""
+        self.assertEqual(playbook.resolve_workers(4), 4)
+        self.assertGreaterEqual(playbook.resolve_workers(0), 1)
+        with self.assertRaises(ValueError):
+            playbook.resolve_workers(-1)
+
+class TestFanOut(unittest.TestCase):
+    """Test --input globs and directories."""
+
+    def setUp(self):
+        """Create an input tree and redirect output and hooks."""
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.orig_out_dir = playbook.OUT_DIR
+        self.orig_hooks_dir = playbook.HOOKS_DIR
+        self.orig_cache_dir = playbook.CACHE_DIR
+        playbook.OUT_DIR = self.temp_dir / "out"
+        playbook.HOOKS_DIR = self.temp_dir / "hooks"
+        playbook.CACHE_DIR = self.temp_dir / "cache"
+        self.src = self.temp_dir / "contracts"
+        for rel in ("A.sol", "notes.md", "sub/B.sol", "test/Mock.sol", ".git/config"):
+            path = self.src / rel
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(f"// {rel}\n")
+
+    def tearDown(self):
+        """Restore paths and clean up."""
+        playbook.OUT_DIR = self.orig_out_dir
+        playbook.HOOKS_DIR = self.orig_hooks_dir
+        playbook.CACHE_DIR = self.orig_cache_dir
+        import shutil
+        shutil.rmtree(self.temp_dir)
+
+    def tags(self, value, **kwargs):
+        return [tag for _, tag in playbook.expand_inputs(value, **kwargs)]
+
+    def test_expand_directory(self):
+        """Directories list their files; --recursive descends, hidden entries are skipped."""
+        self.assertEqual(self.tags(str(self.src)), ["A.sol", "notes.md"])
+        self.assertEqual(self.tags(str(self.src), recursive=True),
+                         ["A.sol", "notes.md", "sub__B.sol", "test__Mock.sol"])
+        self.assertEqual(self.tags(str(self.src), recursive=True, include=["*.sol"], exclude=["test/*"]),
+                         ["A.sol", "sub__B.sol"])
+
+    def test_expand_glob(self):
+        """Globs support ** and tag outputs relative to their fixed prefix."""
+        self.assertEqual(self.tags(str(self.src / "**" / "*.sol")), ["A.sol", "sub__B.sol", "test__Mock.sol"])
+        self.assertEqual(self.tags(str(self.src / "*" / "*.sol")), ["sub__B.sol", "test__Mock.sol"])
+        with self.assertRaises(FileNotFoundError):
+            playbook.expand_inputs(str(self.src / "*.rs"))
+
+    def test_existing_file_with_glob_characters(self):
+        """A file named like a glob is a single input, not a pattern."""
+        notes = self.src / "notes[1].txt"
+        notes.write_text("bracketed\n")
+        self.assertFalse(playbook.is_input_pattern(str(notes)))
+        self.assertTrue(playbook.is_input_pattern(str(self.src / "notes[2].txt")))
+        self.assertTrue(playbook.is_input_pattern(str(self.src)))
+
+        import argparse
+        import io
+        from contextlib import redirect_stdout, redirect_stderr
+        args = argparse.Namespace(
+            name="review_pr", input=str(notes), stdin=False, vars=[], pack=None, print_only=True,
+            copy=False, no_cache=True, store=None, out_format="file", sink=None, stream=False,
+            recursive=False, include=[], exclude=[], max_tokens=None, chunk_by="auto", filter=[],
+            no_filters=False, hook_mode="each", allow_missing=True, git_diff=None, git_path=[],
+            git_stat=False,
+        )
+        stdout = io.StringIO()
+        with redirect_stdout(stdout), redirect_stderr(io.StringIO()):
+            playbook.cmd_run(args)
+        self.assertIn("bracketed", stdout.getvalue())
+
+    def test_read_inputs_keeps_order(self):
+        """Files come back in order, with read errors reported per file."""
+        paths = [self.src / "A.sol", self.src / "missing.sol", self.src / "sub" / "B.sol"]
+        results = list(playbook.read_inputs(paths, workers=2))
+        self.assertEqual([p for p, _, _ in results], paths)
+        self.assertEqual(results[0][1], "// A.sol\n")
+        self.assertIsInstance(results[1][2], FileNotFoundError)
+
+    def test_run_renders_one_prompt_per_file(self):
+        """`run --input <glob>` saves one prompt per file, named after the input."""
+        import argparse
+        import io
+        from contextlib import redirect_stdout, redirect_stderr
+        (self.src / "bad.sol").write_bytes(b"\xff\xfe")
+        args = argparse.Namespace(
+            name="audit_contract", input=str(self.src / "**" / "*.sol"), stdin=False, vars=["project=X"],
+            pack=None, print_only=False, copy=False, no_cache=True, store=None, out_format="file",
+            sink=None, stream=False, recursive=False, include=[], exclude=["test/*"],
+            max_tokens=None, chunk_by="auto", filter=[], no_filters=False, hook_mode="each",
+            allow_missing=True, git_diff=None, git_path=[], git_stat=False,
+        )
+        stdout = io.StringIO()
+        with redirect_stdout(stdout), redirect_stderr(io.StringIO()):
+            with self.assertRaises(SystemExit) as cm:
+                playbook.cmd_run(args)
+        self.assertEqual(cm.exception.code, 1)
+        results = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual([r["status"] for r in results], ["ok", "error", "ok"])
+        self.assertTrue(results[2]["out_file"].endswith("_audit_contract_sub__B.sol.prompt.txt"))
+        self.assertIn("// sub/B.sol", Path(results[2]["out_file"]).read_text())
+
+class TestInputFilters(unittest.TestCase):
+    """Test the input filter pipeline."""
+
+    DIFF = (
+        "diff --git a/src/app.py b/src/app.py\n--- a/src/app.py\n+++ b/src/app.py\n"
+        "@@ -1,3 +1,3 @@\n-old   \n+new\t\n+new\t\n\n\n\n context\n"
+        "diff --git a/package-lock.json b/package-lock.json\n--- a/package-lock.json\n+++ b/package-lock.json\n"
+        "@@ -1 +1 @@\n-\"lock\": 1\n+\"lock\": 2\n"
+        "diff --git a/logo.png b/logo.png\nindex 1..2 100644\nBinary files a/logo.png and b/logo.png differ\n"
+        "diff --git a/vendor/lib/x.go b/vendor/lib/x.go\n@@ -1 +1 @@\n-a\n+b\n"
+    )
+
+    def setUp(self):
+        """Use a temporary playbook directory."""
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.orig = (playbook.PLAYBOOKS_DIR, playbook.OUT_DIR, playbook.CACHE_DIR)
+        playbook.PLAYBOOKS_DIR = self.temp_dir / "playbooks"
+        playbook.CACHE_DIR = self.temp_dir / "cache"
+        playbook.OUT_DIR = self.temp_dir / "out"
+        playbook.PLAYBOOKS_DIR.mkdir()
+        (playbook.PLAYBOOKS_DIR / "review.md").write_text("IN:\n{{input}}")
+
+    def tearDown(self):
+        """Restore directories."""
+        playbook.PLAYBOOKS_DIR, playbook.OUT_DIR, playbook.CACHE_DIR = self.orig
+        import shutil
+        shutil.rmtree(self.temp_dir)
+
+    def filtered(self, specs, text=None):
+        return playbook.filter_text(self.DIFF if text is None else text, playbook.parse_filters(specs))
+
+    def test_drop_generated_and_paths(self):
+        """Lockfile and vendored sections go; matching is by path or file name."""
+        out = self.filtered(["drop-generated"])
+        self.assertIn("src/app.py", out)
+        self.assertNotIn("package-lock.json", out)
+        self.assertNotIn("vendor/lib", out)
+        self.assertNotIn("src/app.py", self.filtered(["drop-paths:*.py"]))
+
+    def test_drop_paths_plain_unified_diff(self):
+        """Diffs without git headers are split at ---/+++ pairs."""
+        text = "--- a/x.lock\n+++ b/x.lock\n@@ -1 +1 @@\n-1\n+2\n--- a/y.txt\n+++ b/y.txt\n@@ -1 +1 @@\n-a\n+b\n"
+        self.assertEqual(self.filtered(["drop-paths:*.lock"], text),
+                         "--- a/y.txt\n+++ b/y.txt\n@@ -1 +1 @@\n-a\n+b\n")
+
+    def test_drop_binary(self):
+        """Binary stubs are dropped with their header; text sections are kept."""
+        out = self.filtered(["drop-binary"])
+        self.assertNotIn("logo.png", out)
+        self.assertIn("vendor/lib/x.go\n@@", out)
+        self.assertIn("package-lock.json", out)
+
+    def test_collapse_whitespace_and_dedupe(self):
+        """Trailing whitespace, blank runs and repeated lines are squeezed."""
+        out = self.filtered(["collapse-whitespace", "dedupe"])
+        self.assertIn("-old\n+new\n\n context\n", out)
+
+    def test_max_hunk_lines(self):
+        """Long hunks are cut with a note of how much was dropped."""
+        out = self.filtered(["max-hunk-lines:2"])
+        self.assertIn("-old   \n+new\t\n... [5 more lines truncated]\ndiff --git a/package-lock.json", out)
+
+    def test_stages_are_lazy(self):
+        """Stages pull lines on demand, so input is never held whole."""
+        def lines():
+            yield "a\n"
+            raise AssertionError("read too far")
+        stages = playbook.parse_filters(["collapse-whitespace", "dedupe"])
+        self.assertEqual(next(playbook.apply_filters(lines(), stages)), "a\n")
+
+    def test_invalid_specs(self):
+        """Unknown filters and missing arguments fail before rendering."""
+        for specs in (["nope"], ["max-hunk-lines"], ["max-hunk-lines:x"], ["drop-paths"], "dedupe"):
+            with self.assertRaises(ValueError, msg=specs):
+                playbook.parse_filters(specs)
+        with self.assertRaises(ValueError):
+            playbook.parse_job('{"name": "review", "filters": ["nope"]}')
+
+    def test_playbook_defaults(self):
+        """filters.json gives defaults; a job's own filters replace them."""
+        (playbook.PLAYBOOKS_DIR / "filters.json").write_text(
+            json.dumps({"*": ["dedupe"], "review": ["drop-generated"]}))
+        self.assertEqual(playbook.default_filters("review"), ["drop-generated"])
+        self.assertEqual(playbook.default_filters("other"), ["dedupe"])
+        diff_file = self.temp_dir / "change.diff"
+        diff_file.write_text(self.DIFF)
+        job = playbook.make_job("review", input_path=str(diff_file))
+        rendered, _ = playbook.run_job(job, print_only=True, hooks=False)
+        self.assertNotIn("package-lock.json", rendered)
+        job = playbook.make_job("review", input_path=str(diff_file), filters=[])
+        rendered, _ = playbook.run_job(job, print_only=True, hooks=False)
+        self.assertIn("package-lock.json", rendered)
+
+    def test_streamed_input_is_filtered(self):
+        """--stream filters through a temporary file and still maps it."""
+        import io
+        diff_file = self.temp_dir / "change.diff"
+        diff_file.write_text(self.DIFF)
+        job = playbook.make_job("review", input_path=str(diff_file), filters=["drop-generated", "drop-binary"])
+        out = io.BytesIO()
+        playbook.run_job(job, print_only=True, hooks=False, stream=out)
+        self.assertEqual(out.getvalue().decode(), "IN:\n" + self.filtered(["drop-generated", "drop-binary"]))
+
+class TestWatch(unittest.TestCase):
+    """Test incremental re-rendering for `playbook watch`."""
+
+    def setUp(self):
+        """Use temporary playbook, input and output directories."""
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.orig = (playbook.PLAYBOOKS_DIR, playbook.OUT_DIR, playbook.CACHE_DIR)
+        playbook.PLAYBOOKS_DIR = self.temp_dir / "playbooks"
+        playbook.CACHE_DIR = self.temp_dir / "cache"
+        playbook.OUT_DIR = self.temp_dir / "out"
+        playbook.PLAYBOOKS_DIR.mkdir()
+        self.template = playbook.PLAYBOOKS_DIR / "notes.md"
+        self.template.write_text("Notes: {{input}}")
+        self.src = self.temp_dir / "src"
+        self.src.mkdir()
+        (self.src / "a.txt").write_text("A")
+        (self.src / "b.txt").write_text("B")
+
+    def tearDown(self):
+        """Restore directories."""
+        playbook.PLAYBOOKS_DIR, playbook.OUT_DIR, playbook.CACHE_DIR = self.orig
+        import shutil
+        shutil.rmtree(self.temp_dir)
+
+    def session(self, input_path):
+        job = playbook.make_job("notes", input_path=str(input_path))
+        return playbook.WatchSession(job, playbook.FixedStore(), hooks=False, debounce=0)
+
+    def bump(self, path, text):
+        """Rewrite path with a later mtime, whatever the filesystem resolution."""
+        stamp = path.stat().st_mtime_ns
+        path.write_text(text)
+        os.utime(str(path), ns=(stamp + 10 ** 9, stamp + 10 ** 9))
+
+    def test_renders_once_into_stable_file(self):
+        """Nothing is re-rendered until a file changes; the output path is stable."""
+        session = self.session(self.src / "a.txt")
+        first = session.poll()
+        self.assertEqual([r["status"] for r in first], ["ok"])
+        out_file = Path(first[0]["out_file"])
+        self.assertEqual(out_file.name, "notes.prompt.txt")
+        self.assertEqual(session.poll(), [])
+        self.bump(self.src / "a.txt", "A2")
+        self.assertEqual(session.poll()[0]["out_file"], str(out_file))
+        self.assertEqual(out_file.read_text(), "Notes: A2")
+        self.assertEqual(list(playbook.OUT_DIR.iterdir()), [out_file])
+
+    def test_only_changed_inputs_rerender(self):
+        """With a directory, an input change re-renders that file; a template change all."""
+        session = self.session(self.src)
+        self.assertEqual(len(session.poll()), 2)
+        self.bump(self.src / "b.txt", "B2")
+        self.assertEqual([Path(r["input"]).name for r in session.poll()], ["b.txt"])
+        self.bump(self.template, "Changed: {{input}}")
+        results = session.poll()
+        self.assertEqual(len(results), 2)
+        self.assertEqual(Path(results[0]["out_file"]).read_text(), "Changed: A")
+
+    def test_new_and_deleted_inputs(self):
+        """New files are picked up; a deleted single input is reported."""
+        session = self.session(self.src)
+        session.poll()
+        (self.src / "c.txt").write_text("C")
+        self.assertEqual([Path(r["input"]).name for r in session.poll()], ["c.txt"])
+        single = self.session(self.src / "a.txt")
+        single.poll()
+        (self.src / "a.txt").unlink()
+        self.assertEqual(single.poll()[0]["status"], "error")
+
+    def test_outputs_are_not_inputs(self):
+        """Watching a tree that contains out/ does not feed outputs back in."""
+        playbook.OUT_DIR = self.src / "out"
+        session = self.session(self.src)
+        session.poll()
+        self.assertEqual(sorted(p.name for p in session.inputs()), ["a.txt", "b.txt"])
+
+    def test_open_watcher(self):
+        """Polling is used on request; inotify otherwise where available."""
+        self.assertIsInstance(playbook.open_watcher(poll=True), playbook.PollWatcher)
+        watcher = playbook.open_watcher()
+        try:
+            if sys.platform.startswith("linux"):
+                self.assertIsInstance(watcher, playbook.InotifyWatcher)
+            watcher.watch([self.src / "a.txt"])
+        finally:
+            watcher.close()
+
+class TestChunking(unittest.TestCase):
+    """Test token-budget chunking of oversized inputs."""
+
+    DIFF = (
+        "diff --git a/a.py b/a.py\n--- a/a.py\n+++ b/a.py\n"
+        "@@ -1,2 +1,2 @@\n-" + "a" * 200 + "\n+" + "b" * 200 + "\n"
+        "@@ -10,2 +10,2 @@\n-" + "c" * 200 + "\n+" + "d" * 200 + "\n"
+        "diff --git a/b.py b/b.py\n--- a/b.py\n+++ b/b.py\n"
+        "@@ -1 +1 @@\n-x\n+y\n"
+    )
+    SOL = (
+        "pragma solidity ^0.8.0;\nimport \"./Base.sol\";\n\n"
+        "contract Vault {\n    uint256 total;\n\n"
+        "    /// Deposit funds\n    function deposit() external {\n        " + "total += 1;\n        " * 20 + "\n    }\n\n"
+        "    function withdraw() external {\n        " + "total -= 1;\n        " * 20 + "\n    }\n}\n\n"
+        "library Math {\n    function add(uint a, uint b) internal pure returns (uint) { return a + b; }\n}\n"
+    )
+
+    def setUp(self):
+        """Use a temporary playbook and output directory."""
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.orig = (playbook.PLAYBOOKS_DIR, playbook.OUT_DIR, playbook.HOOKS_DIR, playbook.CACHE_DIR)
+        playbook.PLAYBOOKS_DIR = self.temp_dir / "playbooks"
+        playbook.CACHE_DIR = self.temp_dir / "cache"
+        playbook.OUT_DIR = self.temp_dir / "out"
+        playbook.HOOKS_DIR = self.temp_dir / "hooks"
+        playbook.PLAYBOOKS_DIR.mkdir()
+        (playbook.PLAYBOOKS_DIR / "review.md").write_text("Review part {{chunk}}/{{chunks}}:\n{{input}}\n")
+        playbook.compile_template.cache_clear()
+
+    def tearDown(self):
+        """Restore directories."""
+        playbook.PLAYBOOKS_DIR, playbook.OUT_DIR, playbook.HOOKS_DIR, playbook.CACHE_DIR = self.orig
+        playbook.compile_template.cache_clear()
+        import shutil
+        shutil.rmtree(self.temp_dir)
+
+    def test_input_kind(self):
+        """Diffs and Solidity are recognised by suffix or content."""
+        self.assertEqual(playbook.input_kind(self.DIFF), "diff")
+        self.assertEqual(playbook.input_kind("x", "change.patch"), "diff")
+        self.assertEqual(playbook.input_kind(self.SOL), "solidity")
+        self.assertEqual(playbook.input_kind("Meeting notes\n\nMore"), "text")
+
+    def test_small_input_is_one_chunk(self):
+        """Input that fits is left alone."""
+        self.assertEqual(playbook.chunk_text(self.DIFF, 10000, "diff"), [self.DIFF])
+
+    def test_diff_splits_per_file_then_hunk(self):
+        """Files stay whole when they fit; big files split per hunk under their header."""
+        chunks = playbook.chunk_text(self.DIFF, 150, "diff")
+        self.assertEqual(len(chunks), 3)
+        self.assertTrue(all(c.startswith("diff --git a/a.py") for c in chunks[:2]))
+        self.assertIn("@@ -10,2", chunks[1])
+        self.assertTrue(chunks[2].startswith("diff --git a/b.py"))
+        self.assertTrue(all(playbook.estimate_tokens(c) <= 150 for c in chunks))
+
+    def test_solidity_splits_per_contract_then_function(self):
+        """Functions keep their doc comment, contract declaration and pragma."""
+        chunks = playbook.chunk_text(self.SOL, 120, "solidity")
+        self.assertGreater(len(chunks), 2)
+        deposit = next(c for c in chunks if "function deposit" in c)
+        self.assertIn("/// Deposit funds", deposit)
+        self.assertIn("contract Vault {", deposit)
+        self.assertTrue(deposit.startswith("pragma solidity"))
+        self.assertNotIn("function withdraw", deposit)
+        self.assertTrue(all(playbook.estimate_tokens(c) <= 120 for c in chunks))
+
+    def test_text_falls_back_to_lines_and_characters(self):
+        """Paragraphs, then lines, then raw characters keep every chunk within budget."""
+        text = "para one\n\n" + "x" * 100
+        chunks = playbook.chunk_text(text, 10, "text")
+        self.assertEqual("".join(chunks), text)
+        self.assertTrue(all(playbook.estimate_tokens(c) <= 10 for c in chunks))
+
+    def test_prompts_fit_budget_with_template_overhead(self):
+        """Every rendered prompt fits --max-tokens and knows its position."""
+        job = playbook.make_job("review", vars_dict={"input": self.DIFF})
+        results = list(playbook.iter_chunk_results(job, 170, print_only=True, hooks=False))
+        self.assertEqual([r["chunk"] for r in results], [1, 2, 3])
+        self.assertTrue(all(r["status"] == "ok" and r["tokens"] <= 170 for r in results))
+        self.assertTrue(results[0]["prompt"].startswith("Review part 1/3:"))
+
+    def test_many_chunks_fit_budget(self):
+        """Multi-digit {{chunk}}/{{chunks}} values are budgeted for as well."""
+        text = "".join(f"{i:04d} " + "w" * (i % 37) + "\n" for i in range(1500))
+        for budget in (17, 23, 31):
+            job = playbook.make_job("review", vars_dict={"input": text})
+            results = list(playbook.iter_chunk_results(job, budget, chunk_by="text", print_only=True, hooks=False))
+            self.assertGreaterEqual(len(results), 100)
+            self.assertEqual([r for r in results if r["status"] != "ok" or r["tokens"] > budget], [], budget)
+
+    def test_saved_chunks_are_tagged(self):
+        """Each chunk is saved under a partIofN tag."""
+        diff_file = self.temp_dir / "change.diff"
+        diff_file.write_text(self.DIFF)
+        job = playbook.make_job("review", input_path=str(diff_file))
+        results = list(playbook.iter_chunk_results(job, 170, hooks=False))
+        self.assertTrue(results[2]["out_file"].endswith("_review_part3of3.prompt.txt"))
+
+    def test_budget_smaller_than_template(self):
+        """A budget the template alone exceeds is reported, not looped on."""
+        job = playbook.make_job("review", vars_dict={"input": self.DIFF})
+        results = list(playbook.iter_chunk_results(job, 3, print_only=True, hooks=False))
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]["status"], "error")
+        self.assertIn("leaves no room", results[0]["error"])
+
+class TestStreaming(unittest.TestCase):
+    """Test the memory-mapped streaming render path."""
+
+    def setUp(self):
+        """Redirect output into a temporary directory."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.orig_out_dir = playbook.OUT_DIR
+        playbook.OUT_DIR = Path(self.temp_dir) / "out"
+        playbook.OUT_DIR.mkdir()
+        self.vars = {"repo": "r", "date": "d", "time_utc": "t"}
+
+    def tearDown(self):
+        """Restore paths and clean up."""
+        playbook.OUT_DIR = self.orig_out_dir
+        import shutil
+        shutil.rmtree(self.temp_dir)
+
+    def stream_job(self, content, print_only=False):
+        """Stream review_pr over content and return (stdout bytes, out_file)."""
+        import io
+        input_file = Path(self.temp_dir) / "big.diff"
+        input_file.write_bytes(content)
+        job = playbook.make_job("review_pr", vars_dict=self.vars, input_path=str(input_file))
+        stdout = io.BytesIO()
+        rendered, out_file = playbook.run_job(job, print_only=print_only, hooks=False, stream=stdout)
+        self.assertIsNone(rendered)
+        return stdout.getvalue(), out_file, job
+
+    def test_stream_matches_render(self):
+        """Streaming writes the same prompt to stdout and the output file."""
+        content = ("+ línea ünïcode\n" * 200000).encode("utf-8")
+        streamed, out_file, job = self.stream_job(content)
+        expected, _ = playbook.run_job(job, print_only=True, hooks=False)
+        self.assertEqual(streamed, expected.encode("utf-8"))
+        self.assertEqual(out_file.read_bytes(), streamed)
+
+    def test_stream_empty_input(self):
+        """An empty input file streams without mapping."""
+        streamed, out_file, _ = self.stream_job(b"", print_only=True)
+        self.assertIn(b"INPUT\n\n", streamed)
+        self.assertFalse(out_file.exists())
+
+    def test_render_to_accepts_bytes_like_values(self):
+        """render_to writes str and bytes-like values and counts bytes."""
+        import io
+        out = io.BytesIO()
+        written = playbook.Template("<{{a}}|{{b}}|{{c}}>").render_to(out, {"a": "é", "b": bytearray(b"xy")})
+        self.assertEqual(out.getvalue(), "<é|xy|{{c}}>".encode("utf-8"))
+        self.assertEqual(written, len(out.getvalue()))
+
+class TestHookEnv(unittest.TestCase):
+    """Test how variables are passed to hook scripts."""
+
+    def tearDown(self):
+        """Reset the size threshold."""
+        os.environ.pop(playbook.HOOK_ENV_MAX_ENV, None)
+
+    def test_small_vars_in_env(self):
+        """Small variables are still exported as PB_<VAR>."""
+        with playbook.hook_env("review_pr", "pack", {"repo": "x"}) as env:
+            self.assertEqual(env["PB_REPO"], "x")
+            self.assertEqual(env["PB_PACK"], "pack")
+            self.assertEqual(env["PLAYBOOK_NAME"], "review_pr")
+
+    def test_large_vars_spill_to_temp_file(self):
+        """Oversized variables are written to a temp file removed on exit."""
+        os.environ[playbook.HOOK_ENV_MAX_ENV] = "8"
+        with playbook.hook_env("review_pr", None, {"input": "é" * 10, "repo": "x"}) as env:
+            self.assertNotIn("PB_INPUT", env)
+            spilled = Path(env["PB_INPUT_FILE"])
+            self.assertEqual(spilled.read_text(encoding="utf-8"), "é" * 10)
+            self.assertEqual(env["PB_INPUT_SIZE"], "20")
+            self.assertEqual(env["PB_REPO"], "x")
+        self.assertFalse(spilled.exists())
+
+    def test_large_input_points_at_source_file(self):
+        """A large value read from a file is passed by its original path."""
+        os.environ[playbook.HOOK_ENV_MAX_ENV] = "4"
+        with tempfile.NamedTemporaryFile("w", suffix=".diff", delete=False) as fh:
+            fh.write("0123456789")
+        source = Path(fh.name)
+        try:
+            with playbook.hook_env("review_pr", None, {"input": "0123456789"}, {"input": source}) as env:
+                self.assertEqual(env["PB_INPUT_FILE"], str(source))
+                self.assertEqual(env["PB_INPUT_SIZE"], "10")
+            self.assertTrue(source.exists())
+        finally:
+            source.unlink()
+
+    def test_filtered_input_reaches_hooks(self):
+        """Hooks see the filtered input, not the original file, whether streamed or not."""
+        import io
+        temp_dir = Path(tempfile.mkdtemp())
+        orig = (playbook.HOOKS_DIR, playbook.OUT_DIR)
+        playbook.HOOKS_DIR = temp_dir / "hooks"
+        playbook.OUT_DIR = temp_dir / "out"
+        try:
+            playbook.HOOKS_DIR.mkdir()
+            seen = temp_dir / "seen.txt"
+            (playbook.HOOKS_DIR / "pre.sh").write_text(f'cat "$PB_INPUT_FILE" >> {seen}\n')
+            source = temp_dir / "change.diff"
+            source.write_text("same\nsame\nsame\nother\n")
+            os.environ[playbook.HOOK_ENV_MAX_ENV] = "4"
+            job = playbook.make_job("review_pr", vars_dict={"repo": "r"}, input_path=str(source),
+                                    filters=["dedupe"])
+            playbook.run_job(job, print_only=True)
+            playbook.run_job(job, print_only=True, stream=io.BytesIO())
+            self.assertEqual(seen.read_text(), "same\nother\n" * 2)
+        finally:
+            playbook.HOOKS_DIR, playbook.OUT_DIR = orig
+            import shutil
+            shutil.rmtree(temp_dir)
+
+    def test_env_built_only_when_hooks_run(self):
+        """No hook env (or spill file) is prepared for jobs that run no hooks."""
+        temp_dir = Path(tempfile.mkdtemp())
+        orig = (playbook.HOOKS_DIR, playbook.OUT_DIR, playbook.hook_env)
+        playbook.HOOKS_DIR = temp_dir / "hooks"
+        playbook.OUT_DIR = temp_dir / "out"
+        calls = []
+
+        def counting_hook_env(*args):
+            calls.append(args[0])
+            return orig[2](*args)
+
+        playbook.hook_env = counting_hook_env
+        try:
+            playbook.HOOKS_DIR.mkdir()
+            job = playbook.make_job("review_pr", vars_dict={"repo": "r", "input": "x" * 100000})
+            playbook.run_job(job, print_only=True, hooks=False)
+            playbook.run_job(job, print_only=True)
+            self.assertEqual(calls, [])
+            (playbook.HOOKS_DIR / "post.sh").write_text("true\n")
+            playbook.run_job(job, print_only=True, hooks=False)
+            playbook.run_job(job, print_only=True, hooks="pre")
+            self.assertEqual(calls, [])
+            playbook.run_job(job, print_only=True)
+            self.assertEqual(calls, ["review_pr"])
+        finally:
+            playbook.HOOKS_DIR, playbook.OUT_DIR, playbook.hook_env = orig
+            import shutil
+            shutil.rmtree(temp_dir)
+
+    def test_invalid_limit(self):
+        """A non-numeric threshold raises ValueError."""
+        os.environ[playbook.HOOK_ENV_MAX_ENV] = "big"
+        with self.assertRaises(ValueError):
+            playbook.hook_env_limit()
+
+class TestPythonHooks(unittest.TestCase):
+    """Test in-process Python hooks and the shell fallback."""
+
+    def setUp(self):
+        """Create temporary hook, pack and output directories."""
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.orig = (playbook.HOOKS_DIR, playbook.PACKS_DIR, playbook.OUT_DIR, playbook.CACHE_DIR)
+        playbook.CACHE_DIR = self.temp_dir / "cache"
+        playbook.HOOKS_DIR = self.temp_dir / "hooks"
+        playbook.PACKS_DIR = self.temp_dir / "packs"
+        playbook.OUT_DIR = self.temp_dir / "out"
+        playbook.HOOKS_DIR.mkdir()
+        playbook.OUT_DIR.mkdir()
+        self.log = self.temp_dir / "log.txt"
+
+        pack_dir = playbook.PACKS_DIR / "p"
+        (pack_dir / "meta").mkdir(parents=True)
+        (pack_dir / "playbooks").mkdir()
+        (pack_dir / "hooks").mkdir()
+        (pack_dir / "meta" / "manifest.json").write_text(
+            json.dumps({"name": "p", "version": "1.0.0", "playbooks": ["t"]}))
+        (pack_dir / "playbooks" / "t.md").write_text("who={{who}}")
+
+    def tearDown(self):
+        """Restore paths and clean up."""
+        playbook.HOOKS_DIR, playbook.PACKS_DIR, playbook.OUT_DIR, playbook.CACHE_DIR = self.orig
+        import shutil
+        shutil.rmtree(self.temp_dir)
+
+    def write_hook(self, path, body):
+        path.write_text("LOG = %r\n\ndef hook(vars, out_file):\n%s\n" % (str(self.log), body))
+
+    def test_python_hooks_run_in_process(self):
+        """Core and pack Python hooks receive vars and the output path in order."""
+        self.write_hook(playbook.HOOKS_DIR / "pre.py",
+                        "    vars['who'] = 'core-pre'\n    open(LOG, 'a').write('core-pre\\n')")
+        self.write_hook(playbook.HOOKS_DIR / "post.py",
+                        "    open(LOG, 'a').write('core-post %s\\n' % out_file.name)")
+        self.write_hook(playbook.PACKS_DIR / "p" / "hooks" / "pre.py",
+                        "    open(LOG, 'a').write('pack-pre %s\\n' % vars['who'])")
+        job = playbook.make_job("t", pack="p")
+        rendered, out_file = playbook.run_job(job)
+        self.assertEqual(rendered, "who=core-pre")
+        self.assertEqual(self.log.read_text().splitlines(),
+                         ["core-pre", "pack-pre core-pre", "core-post " + out_file.name])
+
+    def test_python_hook_loaded_once(self):
+        """A hook module is imported once until the file changes."""
+        hook_file = playbook.HOOKS_DIR / "pre.py"
+        self.write_hook(hook_file, "    pass")
+        self.assertIs(playbook.load_python_hook(hook_file), playbook.load_python_hook(hook_file))
+
+    def test_shell_hook_fallback(self):
+        """Without a .py hook the .sh hook still runs."""
+        (playbook.HOOKS_DIR / "post.sh").write_text('echo "$OUT_FILE" > "%s"\n' % self.log)
+        _, out_file = playbook.run_job(playbook.make_job("t", pack="p"))
+        self.assertEqual(self.log.read_text().strip(), str(out_file))
+
+    def test_python_hook_errors_raise_value_error(self):
+        """Exceptions inside a Python hook surface as ValueError."""
+        self.write_hook(playbook.HOOKS_DIR / "pre.py", "    raise RuntimeError('boom')")
+        with self.assertRaises(ValueError) as ctx:
+            playbook.run_job(playbook.make_job("t", pack="p"))
+        self.assertIn("boom", str(ctx.exception))
+
+class TestHookDirectories(unittest.TestCase):
+    """Test pre.d/post.d hook directories, timeouts and batch hook mode."""
+
+    def setUp(self):
+        """Create temporary hook, playbook and output directories."""
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.orig = (playbook.HOOKS_DIR, playbook.PLAYBOOKS_DIR, playbook.OUT_DIR, playbook.CACHE_DIR)
+        playbook.CACHE_DIR = self.temp_dir / "cache"
+        playbook.HOOKS_DIR = self.temp_dir / "hooks"
+        playbook.PLAYBOOKS_DIR = self.temp_dir / "playbooks"
+        playbook.OUT_DIR = self.temp_dir / "out"
+        for directory in (playbook.HOOKS_DIR, playbook.PLAYBOOKS_DIR, playbook.OUT_DIR):
+            directory.mkdir()
+        (playbook.PLAYBOOKS_DIR / "t.md").write_text("x={{x}}")
+        self.log = self.temp_dir / "log"
+        self.log.mkdir()
+
+    def tearDown(self):
+        """Restore paths and clean up."""
+        playbook.HOOKS_DIR, playbook.PLAYBOOKS_DIR, playbook.OUT_DIR, playbook.CACHE_DIR = self.orig
+        os.environ.pop(playbook.HOOK_TIMEOUT_ENV, None)
+        import shutil
+        shutil.rmtree(self.temp_dir)
+
+    def script(self, phase, name, body):
+        hook_dir = playbook.HOOKS_DIR / f"{phase}.d"
+        hook_dir.mkdir(exist_ok=True)
+        path = hook_dir / name
+        path.write_text("#!/bin/sh\n" + body + "\n")
+        path.chmod(0o755)
+        return path
+
+    def test_scripts_run_concurrently(self):
+        """Scripts in post.d all run, at the same time, after the post hook."""
+        import time
+        for i in range(4):
+            self.script("post", f"{i}-wait", f"sleep 0.3; echo $OUT_FILE > {self.log}/{i}")
+        (playbook.HOOKS_DIR / "post.d" / ".hidden").write_text("exit 1")
+        self.assertTrue(playbook.has_hooks("post"))
+        started = time.monotonic()
+        _, out_file = playbook.run_job(playbook.make_job("t", vars_dict={"x": "1"}))
+        self.assertLess(time.monotonic() - started, 1.0)
+        self.assertEqual(sorted(p.name for p in self.log.iterdir()), ["0", "1", "2", "3"])
+        self.assertEqual((self.log / "0").read_text().strip(), str(out_file))
+
+    def test_failure_reported_after_all_finish(self):
+        """A failing script fails the job, but its siblings still complete."""
+        import subprocess
+        self.script("pre", "a-fail", "exit 3")
+        self.script("pre", "b-ok", f"sleep 0.1; touch {self.log}/b")
+        with self.assertRaises(subprocess.CalledProcessError):
+            playbook.run_job(playbook.make_job("t"), print_only=True)
+        self.assertTrue((self.log / "b").exists())
+
+    def test_timeout(self):
+        """A hung hook is killed after PLAYBOOK_HOOK_TIMEOUT seconds."""
+        self.script("post", "hang", "sleep 30")
+        os.environ[playbook.HOOK_TIMEOUT_ENV] = "0.2"
+        with self.assertRaises(ValueError) as cm:
+            playbook.run_job(playbook.make_job("t"))
+        self.assertIn("timed out after 0.2s", str(cm.exception))
+        os.environ[playbook.HOOK_TIMEOUT_ENV] = "soon"
+        with self.assertRaises(ValueError):
+            playbook.hook_timeout()
+        os.environ[playbook.HOOK_TIMEOUT_ENV] = "0"
+        self.assertIsNone(playbook.hook_timeout())
+
+    def test_batch_hook_mode(self):
+        """--hook-mode batch runs post hooks once with a manifest of every output."""
+        import argparse
+        import io
+        from contextlib import redirect_stdout, redirect_stderr
+        (playbook.HOOKS_DIR / "pre.sh").write_text(f"echo pre >> {self.log}/pre\n")
+        self.script("post", "collect", f"cp $MANIFEST_FILE {self.log}/manifest; echo $HOOK_MODE $OUT_COUNT >> {self.log}/post")
+        jobs_file = self.temp_dir / "jobs.jsonl"
+        jobs_file.write_text("\n".join(json.dumps({"name": "t", "vars": {"x": i}}) for i in range(3)))
+        args = argparse.Namespace(jobs_file=str(jobs_file), print_only=False, no_hooks=False, jobs=1,
+                                  no_cache=True, hook_mode="batch", store=None, out_format="file", sink=None)
+        stdout = io.StringIO()
+        with redirect_stdout(stdout), redirect_stderr(io.StringIO()):
+            playbook.cmd_batch(args)
+        self.assertEqual((self.log / "pre").read_text(), "pre\n" * 3)
+        self.assertEqual((self.log / "post").read_text(), "batch 3\n")
+        manifest = json.loads((self.log / "manifest").read_text())
+        printed = [json.loads(line)["out_file"] for line in stdout.getvalue().splitlines()]
+        self.assertEqual([o["out_file"] for o in manifest["outputs"]], printed)
+
+class TestDaemon(unittest.TestCase):
+    """Test the render daemon and its client."""
+
+    def setUp(self):
+        """Start a daemon on a temporary socket in a background thread."""
+        import threading
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.socket_path = self.temp_dir / "serve.sock"
+        server_class, handler_class = playbook.daemon_server_classes()
+        self.server = server_class(str(self.socket_path), handler_class)
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+        self.thread.start()
+        self.client = playbook.DaemonClient.connect(self.socket_path)
+
+    def tearDown(self):
+        """Stop the daemon and clean up."""
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        import shutil
+        shutil.rmtree(self.temp_dir)
+
+    def test_daemon_render_matches_local(self):
+        """Rendering through the daemon gives the local result."""
+        values = {"repo": "r", "input": "+ x"}
+        remote = self.client.load("review_pr").render(values)
+        self.assertEqual(remote, playbook.load_template("review_pr").render(values))
+
+    def test_daemon_errors(self):
+        """Daemon errors surface as the matching exception types."""
+        with self.assertRaises(FileNotFoundError):
+            self.client.load("nonexistent_playbook_xyz").render({})
+        response = self.client.request({"vars": {}})
+        self.assertFalse(response["ok"])
+        self.assertIn("name", response["error"])
+
+    def test_other_checkout_renders_locally(self):
+        """Requests for a different checkout fall back to local rendering."""
+        response = self.client.request({"root": "/elsewhere", "name": "review_pr"})
+        self.assertTrue(response["local"])
+
+    def test_license_checked_against_client_env(self):
+        """Pack license keys come from the request, not the daemon's env."""
+        manifest = {"requires_license": True, "license_env": "TEST_LICENSE_KEY"}
+        with self.assertRaises(playbook.LicenseError):
+            playbook.require_license(manifest, "p", environ={})
+        playbook.require_license(manifest, "p", environ={"TEST_LICENSE_KEY": "k"})
+
+    def test_pack_license_env_forwarded(self):
+        """A pack's own license_env reaches the daemon; without it the client renders locally."""
+        orig = (playbook.PACKS_DIR, playbook.CACHE_DIR)
+        playbook.PACKS_DIR = self.temp_dir / "packs"
+        playbook.CACHE_DIR = self.temp_dir / "cache"
+        pack_dir = playbook.PACKS_DIR / "acme"
+        (pack_dir / "meta").mkdir(parents=True)
+        (pack_dir / "playbooks").mkdir()
+        (pack_dir / "meta" / "manifest.json").write_text(json.dumps({
+            "name": "acme", "version": "1.0.0", "playbooks": ["hi"],
+            "requires_license": True, "license_env": "ACME_TOKEN"}))
+        (pack_dir / "playbooks" / "hi.md").write_text("Hi {{who}}")
+        os.environ["ACME_TOKEN"] = "k"
+        try:
+            self.assertEqual(playbook.daemon_request_env("acme"), {"ACME_TOKEN": "k"})
+            self.assertEqual(self.client.load("hi", pack="acme").render({"who": "x"}), "Hi x")
+            response = self.client.request({"name": "hi", "pack": "acme", "env": {}})
+            self.assertTrue(response["local"])
+        finally:
+            os.environ.pop("ACME_TOKEN")
+            playbook.PACKS_DIR, playbook.CACHE_DIR = orig
+            playbook._pack_indexes.clear()
+
+    def test_no_daemon(self):
+        """connect() returns None when no socket exists."""
+        self.assertIsNone(playbook.DaemonClient.connect(self.temp_dir / "missing.sock"))
+
+class TestOutputStores(unittest.TestCase):
+    """Test the flat and content-addressed output stores."""
+
+    def setUp(self):
+        """Use a temporary output directory."""
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.orig_out_dir = playbook.OUT_DIR
+        playbook.OUT_DIR = self.temp_dir
+
+    def tearDown(self):
+        """Restore paths and clean up."""
+        playbook.OUT_DIR = self.orig_out_dir
+        import shutil
+        shutil.rmtree(self.temp_dir)
+
+    def test_flat_store_never_overwrites(self):
+        """Same-second saves with the same name get distinct files."""
+        store = playbook.FlatStore()
+        paths = [store.save(text, "review_pr", "pack") for text in ("one", "two", "three")]
+        self.assertEqual(len(set(paths)), 3)
+        self.assertEqual([p.read_text() for p in paths], ["one", "two", "three"])
+        self.assertTrue(paths[0].name.endswith("_review_pr_pack.prompt.txt"))
+        self.assertEqual([p.name for p in self.temp_dir.glob(".tmp-*")], [])
+
+    def test_content_store_dedupes_and_indexes(self):
+        """Identical prompts share one sharded blob; every run is indexed."""
+        store = playbook.ContentStore()
+        first = store.save("same", "review_pr", vars_dict={"repo": "a", "input": "big"})
+        second = store.save("same", "review_pr", tag="2")
+        other = store.save("different", "audit_contract")
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other)
+        digest = hashlib.sha256(b"same").hexdigest()
+        self.assertEqual(first, self.temp_dir / "objects" / digest[:2] / digest[2:4] / f"{digest}.prompt.txt")
+
+        records = [json.loads(l) for l in store.index_path.read_text().splitlines()]
+        self.assertEqual([r["name"] for r in records], ["review_pr", "review_pr", "audit_contract"])
+        self.assertEqual(records[0]["vars"], {"repo": "a"})
+        self.assertEqual(records[0]["sha256"], digest)
+
+    def test_content_store_gc(self):
+        """gc keeps recent runs and deletes blobs nobody references."""
+        store = playbook.ContentStore()
+        old = store.save("old", "review_pr")
+        new = store.save("new", "review_pr")
+        self.assertEqual(store.gc(keep_last=1, dry_run=True), (1, 1))
+        self.assertTrue(old.exists())
+        self.assertEqual(store.gc(keep_last=1), (1, 1))
+        self.assertFalse(old.exists())
+        self.assertTrue(new.exists())
+        self.assertEqual(len(store.index_path.read_text().splitlines()), 1)
+
+    @unittest.skipUnless(hasattr(time, "tzset"), "needs time.tzset")
+    def test_content_store_gc_keep_days_ignores_local_zone(self):
+        """--keep-days is measured in UTC whatever the local time zone."""
+        orig_tz = os.environ.get("TZ")
+        try:
+            for zone in ("America/Los_Angeles", "Asia/Tokyo"):
+                os.environ["TZ"] = zone
+                time.tzset()
+                store = playbook.ContentStore()
+                fresh = store.save(f"fresh {zone}", "review_pr")
+                stale = store.save(f"stale {zone}", "review_pr")
+                records = [json.loads(l) for l in store.index_path.read_text().splitlines()]
+                three_hours_ago = time.gmtime(time.time() - 3 * 3600)
+                records[-1]["time"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", three_hours_ago)
+                store.index_path.write_text("".join(json.dumps(r) + "\n" for r in records))
+                store.gc(keep_days=0.1)
+                self.assertTrue(fresh.exists(), zone)
+                self.assertFalse(stale.exists(), zone)
+        finally:
+            if orig_tz is None:
+                os.environ.pop("TZ", None)
+            else:
+                os.environ["TZ"] = orig_tz
+            time.tzset()
+
+    def test_stream_into_content_store(self):
+        """Streamed renders are hashed on the fly and land in the store."""
+        import io
+        input_file = self.temp_dir / "in.diff"
+        input_file.write_text("+ x\n")
+        job = playbook.make_job("review_pr", vars_dict={"date": "d", "time_utc": "t"}, input_path=str(input_file))
+        stdout = io.BytesIO()
+        _, out_file = playbook.run_job(job, hooks=False, stream=stdout, store=playbook.ContentStore())
+        self.assertEqual(out_file.read_bytes(), stdout.getvalue())
+        self.assertEqual(out_file.name, hashlib.sha256(stdout.getvalue()).hexdigest() + ".prompt.txt")
+
+    def test_unknown_store(self):
+        """Unknown store names raise ValueError."""
+        with self.assertRaises(ValueError):
+            playbook.open_store("s3")
+
+class TestOutputSinks(unittest.TestCase):
+    """Test the append-only JSONL and SQLite prompt sinks."""
+
+    def setUp(self):
+        """Use a temporary output directory and small commit groups."""
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.orig_out_dir = playbook.OUT_DIR
+        self.orig_group = playbook.SINK_GROUP_RECORDS
+        playbook.OUT_DIR = self.temp_dir
+        playbook.SINK_GROUP_RECORDS = 2
+
+    def tearDown(self):
+        """Restore settings and clean up."""
+        playbook.OUT_DIR = self.orig_out_dir
+        playbook.SINK_GROUP_RECORDS = self.orig_group
+        import shutil
+        shutil.rmtree(self.temp_dir)
+
+    def test_jsonl_commits_in_groups(self):
+        """Records are buffered until a group fills or the sink closes."""
+        sink = playbook.open_output("jsonl")
+        self.assertEqual(sink.save("one", "review_pr", vars_dict={"repo": "a", "input": "x"}), sink.path)
+        self.assertFalse(sink.path.exists())
+        sink.save("two", "review_pr", pack="p", tag="2")
+        self.assertEqual(len(sink.path.read_text().splitlines()), 2)
+        sink.save("three", "audit_contract")
+        sink.close()
+
+        records = list(playbook.iter_sink(sink.path))
+        self.assertEqual([r["prompt"] for r in records], ["one", "two", "three"])
+        self.assertEqual(records[0]["vars"], {"repo": "a"})
+        self.assertEqual(records[1]["pack"], "p")
+        self.assertEqual(records[2]["sha256"], hashlib.sha256(b"three").hexdigest())
+
+    def test_sqlite_round_trip(self):
+        """SQLite sinks read back in insertion order with decoded vars."""
+        path = self.temp_dir / "bulk.sqlite"
+        sink = playbook.open_output("sqlite", path=str(path))
+        for i in range(3):
+            sink.save(f"prompt {i}", "review_pr", vars_dict={"repo": str(i)})
+        sink.close()
+        records = list(playbook.iter_sink(path))
+        self.assertEqual([r["prompt"] for r in records], ["prompt 0", "prompt 1", "prompt 2"])
+        self.assertEqual(records[2]["vars"], {"repo": "2"})
+        self.assertEqual(records[0]["size"], len("prompt 0"))
+
+    def test_run_job_flushes_before_post_hooks(self):
+        """A post hook can read the current prompt from the sink."""
+        orig_hooks = playbook.HOOKS_DIR
+        playbook.HOOKS_DIR = self.temp_dir / "hooks"
+        playbook.HOOKS_DIR.mkdir()
+        (playbook.HOOKS_DIR / "post.py").write_text(
+            "def hook(vars, out_file):\n"
+            "    assert len(out_file.read_text().splitlines()) == 1\n"
+        )
+        try:
+            sink = playbook.open_output("jsonl")
+            job = playbook.make_job("review_pr", vars_dict={"repo": "x"})
+            _, out_file = playbook.run_job(job, store=sink)
+        finally:
+            playbook.HOOKS_DIR = orig_hooks
+        self.assertEqual(out_file, sink.path)
+        self.assertEqual(len(sink.path.read_text().splitlines()), 1)
+
+    def test_open_output_rejects_bad_combinations(self):
+        """Sinks do not mix with --store or --stream."""
+        self.assertIsInstance(playbook.open_output("file"), playbook.FlatStore)
+        with self.assertRaises(ValueError):
+            playbook.open_output("jsonl", store="cas")
+        with self.assertRaises(ValueError):
+            playbook.open_output("file", path="x.jsonl")
+        with self.assertRaises(ValueError):
+            playbook.open_output("jsonl").writer("review_pr")
+
+class TestTracing(unittest.TestCase):
+    """Test per-phase trace spans and profiling."""
+
+    def setUp(self):
+        """Use a temporary output directory."""
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.orig_out_dir = playbook.OUT_DIR
+        self.orig_hooks_dir = playbook.HOOKS_DIR
+        playbook.OUT_DIR = self.temp_dir / "out"
+        playbook.HOOKS_DIR = self.temp_dir / "hooks"
+
+    def tearDown(self):
+        """Restore paths and clean up."""
+        playbook.OUT_DIR = self.orig_out_dir
+        playbook.HOOKS_DIR = self.orig_hooks_dir
+        import shutil
+        shutil.rmtree(self.temp_dir)
+
+    def test_trace_settings(self):
+        """Flags win over PLAYBOOK_TRACE; "1" means stderr."""
+        import argparse
+        self.assertEqual(playbook.trace_settings(environ={}), (None, False, None))
+        self.assertEqual(playbook.trace_settings(environ={"PLAYBOOK_TRACE": "1"})[0], "-")
+        self.assertEqual(playbook.trace_settings(environ={"PLAYBOOK_TRACE": "0"})[0], None)
+        args = argparse.Namespace(trace="spans.jsonl", trace_memory=False, profile=None)
+        self.assertEqual(playbook.trace_settings(args, {"PLAYBOOK_TRACE": "1"})[0], "spans.jsonl")
+        self.assertEqual(playbook.trace_settings(environ={"PLAYBOOK_TRACE_MEMORY": "1"})[:2], ("-", True))
+
+    def test_spans_off_by_default(self):
+        """Without a tracer, trace_span yields None."""
+        with playbook.trace_span("render") as span:
+            self.assertIsNone(span)
+
+    def test_run_job_records_phases(self):
+        """A traced run records load, render, write and hook spans with byte counts."""
+        import argparse
+        trace_file = self.temp_dir / "trace.jsonl"
+        input_file = self.temp_dir / "in.diff"
+        input_file.write_text("+ x")
+        playbook.HOOKS_DIR.mkdir()
+        (playbook.HOOKS_DIR / "post.py").write_text("def hook(vars, out_file):\n    pass\n")
+        args = argparse.Namespace(trace=str(trace_file), trace_memory=False, profile=None)
+        job = playbook.make_job("review_pr", vars_dict={"repo": "x"}, input_path=str(input_file))
+        with playbook.instrumented("run", args):
+            rendered, _ = playbook.run_job(job)
+        self.assertIsNone(playbook._tracer)
+
+        spans = [json.loads(l) for l in trace_file.read_text().splitlines()]
+        by_name = {span["span"]: span for span in spans}
+        self.assertEqual(set(by_name), {"input", "load", "render", "write", "hook", "command"})
+        self.assertEqual(by_name["input"]["bytes"], 3)
+        self.assertEqual(by_name["render"]["bytes"], len(rendered.encode("utf-8")))
+        self.assertEqual(by_name["hook"]["phase"], "post")
+        self.assertEqual(spans[-1]["span"], "command")
+        for span in spans:
+            self.assertGreaterEqual(span["ms"], 0)
+            self.assertGreaterEqual(span["start_ms"], 0)
+
+    def test_profile_and_memory(self):
+        """--profile saves pstats data; --trace-memory adds the allocation peak."""
+        import argparse
+        import pstats
+        trace_file = self.temp_dir / "trace.jsonl"
+        profile = self.temp_dir / "run.prof"
+        args = argparse.Namespace(trace=str(trace_file), trace_memory=True, profile=str(profile))
+        with playbook.instrumented("run", args):
+            playbook.run_job(playbook.make_job("review_pr"), print_only=True, hooks=False)
+        command = json.loads(trace_file.read_text().splitlines()[-1])
+        self.assertGreater(command["mem_peak"], 0)
+        self.assertTrue(command["top_allocations"])
+        self.assertIn("run_job", "".join(str(k) for k in pstats.Stats(str(profile)).stats))
+
+class TestBench(unittest.TestCase):
+    """Test the benchmark statistics and baseline comparison."""
+
+    def test_percentile(self):
+        """Percentiles use the nearest rank."""
+        samples = [5, 1, 4, 2, 3]
+        self.assertEqual(playbook.percentile(samples, 50), 3)
+        self.assertEqual(playbook.percentile(samples, 90), 5)
+        self.assertEqual(playbook.percentile([7], 99), 7)
+
+    def test_compare_bench(self):
+        """Only slowdowns beyond the tolerance are reported."""
+        baseline = {"workloads": {
+            "render_small": {"p50_ms": 1.0, "p90_ms": 2.0, "peak_rss_kb": 1000},
+            "batch": {"p50_ms": 10.0, "p90_ms": 20.0, "peak_rss_kb": 1000},
+        }}
+        results = {"workloads": {
+            "render_small": {"p50_ms": 1.2, "p90_ms": 1.0, "peak_rss_kb": 1000},
+            "batch": {"p50_ms": 15.0, "p90_ms": 20.0, "peak_rss_kb": 2000},
+            "startup": {"p50_ms": 99.0, "p90_ms": 99.0, "peak_rss_kb": 99},
+        }}
+        regressions = playbook.compare_bench(results, baseline, tolerance=0.25)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(regressions[0].startswith("batch: median latency 15"))
+        self.assertIn("peak RSS", regressions[1])
+
+    def test_bench_workload_leaves_tree_alone(self):
+        """A workload runs in a scratch tree and restores the real paths."""
+        orig = (playbook.PLAYBOOKS_DIR, playbook.OUT_DIR, playbook.CACHE_DIR)
+        stats = playbook.bench_workload("large_diff", seconds=0, min_runs=2)
+        self.assertEqual((playbook.PLAYBOOKS_DIR, playbook.OUT_DIR, playbook.CACHE_DIR), orig)
+        self.assertEqual(stats["runs"], 2)
+        self.assertGreater(stats["ops_per_sec"], 0)
+        self.assertLessEqual(stats["p50_ms"], stats["p99_ms"])
+        self.assertGreater(stats["peak_rss_kb"], 0)
+
+class TestStartup(unittest.TestCase):
+    """Test the cheap startup path for `playbook run`."""
+
+    def test_import_skips_heavy_modules(self):
+        """Importing playbook does not load subcommand-only modules."""
+        import subprocess
+        heavy = ["argparse", "socketserver", "subprocess", "tempfile", "shutil", "mmap", "hashlib"]
+        code = (
+            "import sys; sys.path.insert(0, sys.argv[1]); import playbook; "
+            f"print(','.join(m for m in {heavy!r} if m in sys.modules))"
+        )
+        out = subprocess.run([sys.executable, "-c", code, str(Path(playbook.__file__).parent)],
+                             stdout=subprocess.PIPE, check=True, universal_newlines=True)
+        self.assertEqual(out.stdout.strip(), "")
+
+    def test_launcher_ignores_modules_in_cwd(self):
+        """The install.sh launcher does not import stdlib look-alikes from the working directory."""
+        import subprocess
+        with tempfile.TemporaryDirectory() as home:
+            env = dict(os.environ, HOME=home, XDG_CACHE_HOME=home, SHELL="/bin/bash",
+                       PATH=os.environ.get("PATH", ""))
+            subprocess.run(["bash", str(Path(playbook.__file__).parent / "install.sh")], env=env,
+                           stdout=subprocess.DEVNULL, check=True)
+            work = Path(home) / "work"
+            work.mkdir()
+            for name in ("subprocess", "tempfile", "hashlib", "argparse"):
+                (work / f"{name}.py").write_text("print('SHADOWED')\n")
+            out = subprocess.run([str(Path(home) / ".local" / "bin" / "playbook"), "list"], cwd=str(work),
+                                 env=env, stdout=subprocess.PIPE, check=True, universal_newlines=True)
+        self.assertNotIn("SHADOWED", out.stdout)
+        self.assertIn("Core playbooks:", out.stdout)
+
+    def test_fast_run_args_match_argparse(self):
+        """parse_run_args builds the same namespace argparse would."""
+        parser = playbook.setup_parser()
+        for argv in (
+            ["run", "review_pr"],
+            ["run", "review_pr", "--input", "x.diff", "--vars", "a=1", "--vars=b=2", "--print-only"],
+            ["run", "--pack", "security-audits", "deep_audit", "--copy", "--no-cache", "--stdin"],
+            ["run", "review_pr", "--store", "cas", "--stream", "--trace-memory", "--profile", "p.prof"],
+            ["run", "review_pr", "--out-format=jsonl", "--sink", "s.jsonl"],
+            ["run", "audit_contract", "--input", "c", "--recursive", "--include", "*.sol", "--exclude=t/*"],
+            ["run", "review_pr", "--max-tokens", "8000", "--chunk-by=diff"],
+            ["run", "review_pr", "--filter", "drop-generated", "--filter=dedupe", "--no-filters"],
+            ["run", "review_pr", "--input", "d", "--hook-mode", "batch", "--allow-missing"],
+            ["run", "review_pr", "--git-diff", "main...HEAD", "--git-path", "src", "--git-path=docs", "--git-stat"],
+        ):
+            fast = playbook.parse_run_args(argv)
+            self.assertIsNotNone(fast, argv)
+            self.assertEqual(vars(fast), vars(parser.parse_args(argv)), argv)
+
+    def test_fast_run_args_fall_back(self):
+        """Anything unusual is left to argparse."""
+        for argv in (
+            ["list"],
+            ["run"],
+            ["run", "--help"],
+            ["run", "review_pr", "--trace"],
+            ["run", "review_pr", "--print"],
+            ["run", "review_pr", "--input"],
+            ["run", "review_pr", "--store", "s3"],
+            ["run", "review_pr", "--stdin=yes"],
+            ["run", "a", "b"],
+            ["run", "review_pr", "--max-tokens", "lots"],
+            ["run", "review_pr", "--chunk-by", "words"],
+        ):
+            self.assertIsNone(playbook.parse_run_args(argv), argv)
+
+    def test_lazy_helpers(self):
+        """batch_errors and daemon_server_classes import their modules on demand."""
+        import subprocess
+        import socketserver
+        self.assertIn(subprocess.CalledProcessError, playbook.batch_errors())
+        server, handler = playbook.daemon_server_classes()
+        self.assertTrue(issubclass(server, socketserver.UnixStreamServer))
+        self.assertTrue(issubclass(handler, socketserver.StreamRequestHandler))
+
+class TestCompletion(unittest.TestCase):
+    """Test shell completion from the completion index."""
+
+    def setUp(self):
+        """Create core playbooks and a pack in a temporary tree."""
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.orig = (playbook.PLAYBOOKS_DIR, playbook.PACKS_DIR, playbook.CACHE_DIR)
+        playbook.PLAYBOOKS_DIR = self.temp_dir / "playbooks"
+        playbook.PACKS_DIR = self.temp_dir / "packs"
+        playbook.CACHE_DIR = self.temp_dir / "cache"
+        playbook.PLAYBOOKS_DIR.mkdir()
+        for name in ("review_pr", "release_notes", "audit"):
+            (playbook.PLAYBOOKS_DIR / f"{name}.md").write_text("{{x}}")
+        pack_dir = playbook.PACKS_DIR / "sec"
+        (pack_dir / "meta").mkdir(parents=True)
+        (pack_dir / "playbooks").mkdir()
+        (pack_dir / "meta" / "manifest.json").write_text(
+            json.dumps({"name": "sec", "version": "1.0.0", "playbooks": ["deep"]}))
+        (pack_dir / "playbooks" / "deep.md").write_text("{{x}}")
+
+    def tearDown(self):
+        """Restore paths and clean up."""
+        playbook.PLAYBOOKS_DIR, playbook.PACKS_DIR, playbook.CACHE_DIR = self.orig
+        playbook._vars_indexes.clear()
+        playbook._pack_indexes.clear()
+        import shutil
+        shutil.rmtree(self.temp_dir)
+
+    CASES = [
+        ["r"],
+        ["run", "re"],
+        ["run", "--pack", ""],
+        ["run", "--pack", "sec", ""],
+        ["run", "review_pr", "--no-"],
+        ["run", "--input", ""],
+        ["list", ""],
+    ]
+
+    def test_candidates(self):
+        """Subcommands, playbooks (per pack), packs, options and file fallbacks."""
+        expected = [
+            ["run"],
+            ["release_notes", "review_pr"],
+            ["sec"],
+            ["deep"],
+            ["--no-cache", "--no-filters"],
+            ["__files__"],
+            ["__files__"],
+        ]
+        self.assertEqual([playbook.complete(words) for words in self.CASES], expected)
+
+    def test_index_refreshes_when_dirs_change(self):
+        """A new playbook invalidates the index through its directory's mtime."""
+        playbook.complete(["run", ""])
+        index = playbook.completion_index_path()
+        stamp = index.stat().st_mtime_ns - 10 ** 9
+        os.utime(str(index), ns=(stamp, stamp))
+        (playbook.PLAYBOOKS_DIR / "zebra.md").write_text("{{x}}")
+        self.assertIn("zebra", playbook.complete(["run", "z"]))
+
+    def test_index_refreshes_when_pack_manifest_changes(self):
+        """A playbook added to an existing pack's manifest shows up, though no directory changed."""
+        self.assertEqual(playbook.complete(["run", "--pack", "sec", ""]), ["deep"])
+        index = playbook.completion_index_path()
+        stamp = index.stat().st_mtime_ns - 10 ** 9
+        os.utime(str(index), ns=(stamp, stamp))
+        pack_dir = playbook.PACKS_DIR / "sec"
+        dir_stamps = [(d, d.stat().st_mtime_ns) for d in (playbook.PACKS_DIR, pack_dir / "meta")]
+        (pack_dir / "playbooks" / "wide.md").write_text("{{x}}")
+        (pack_dir / "meta" / "manifest.json").write_text(
+            json.dumps({"name": "sec", "version": "1.0.0", "playbooks": ["deep", "wide"]}))
+        for directory, mtime in dir_stamps:
+            os.utime(str(directory), ns=(mtime, mtime))
+        self.assertEqual(playbook.complete(["run", "--pack", "sec", ""]), ["deep", "wide"])
+
+    @unittest.skipUnless(shutil.which("bash"), "needs bash")
+    def test_bash_script_notices_manifest_change(self):
+        """The bash script falls back to `__complete` once a manifest is newer than its index."""
+        import shlex
+        import subprocess
+        playbook.write_completion_index()
+        index = playbook.completion_index_path()
+        command = " ".join(shlex.quote(part) for part in (sys.executable, str(Path(playbook.__file__).resolve())))
+        script = playbook.completion_script("bash").replace(command, "echo fallback; :")
+        probe = script + 'COMP_WORDS=(playbook run r); COMP_CWORD=2; _playbook; echo "${COMPREPLY[*]}"\n'
+
+        def answer():
+            return subprocess.run(["bash", "-c", probe], stdout=subprocess.PIPE, check=True,
+                                  universal_newlines=True).stdout.strip()
+
+        stamp = index.stat().st_mtime_ns - 10 ** 9
+        os.utime(str(index), ns=(stamp, stamp))
+        for directory in (playbook.PLAYBOOKS_DIR, playbook.PACKS_DIR, playbook.PACKS_DIR / "sec" / "meta"):
+            os.utime(str(directory), ns=(stamp - 10 ** 9, stamp - 10 ** 9))
+        manifest = playbook.PACKS_DIR / "sec" / "meta" / "manifest.json"
+        os.utime(str(manifest), ns=(stamp - 10 ** 9, stamp - 10 ** 9))
+        self.assertEqual(answer(), "release_notes review_pr")
+        os.utime(str(manifest), ns=(stamp + 10 ** 9, stamp + 10 ** 9))
+        self.assertEqual(answer(), "fallback")
+
+    @unittest.skipUnless(sys.platform != "win32" and Path("/usr/bin/awk").exists(), "needs awk")
+    def test_awk_matches_python(self):
+        """The shell scripts' awk program answers exactly like complete()."""
+        import subprocess
+        index = playbook.write_completion_index()
+        for words in self.CASES:
+            pack = ""
+            for i, word in enumerate(words[:-2]):
+                if word == "--pack":
+                    pack = words[i + 1]
+            out = subprocess.run(
+                ["awk", "-v", f"cmd={words[0]}", "-v", f"prev={words[-2] if len(words) > 1 else ''}",
+                 "-v", f"cur={words[-1]}", "-v", f"pack={pack}", "-v", f"pos={len(words)}",
+                 playbook.COMPLETION_AWK, str(index)],
+                stdout=subprocess.PIPE, check=True, universal_newlines=True)
+            self.assertEqual(out.stdout.split(), playbook.complete(words), words)
+
+    def test_scripts(self):
+        """Each shell's script points at the index and the fallback entry point."""
+        for shell in playbook.COMPLETION_SHELLS:
+            script = playbook.completion_script(shell)
+            self.assertIn(str(playbook.completion_index_path()), script)
+            self.assertIn("__complete", script)
+        self.assertIn("bashcompinit", playbook.completion_script("zsh"))
+
+    def test_fallback_skips_parser(self):
+        """`playbook __complete` answers without importing argparse."""
+        import subprocess
+        code = (
+            "import sys; sys.path.insert(0, sys.argv[1]); import playbook; "
+            "sys.argv = ['playbook', '__complete', 'r']; playbook.main(); "
+            "print('argparse' in sys.modules)"
+        )
+        with tempfile.TemporaryDirectory() as cache:
+            out = subprocess.run([sys.executable, "-c", code, str(Path(playbook.__file__).parent)],
+                                 env=dict(os.environ, XDG_CACHE_HOME=cache),
+                                 stdout=subprocess.PIPE, check=True, universal_newlines=True)
+        self.assertEqual(out.stdout.split(), ["run", "False"])
+
+@unittest.skipUnless(shutil.which("git"), "needs git")
+class TestGitDiff(unittest.TestCase):
+    """Test --git-diff input from a local repository."""
+
+    def setUp(self):
+        """Create a repository with two commits and a dirty working tree."""
+        import subprocess
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.orig = (playbook.PLAYBOOKS_DIR, playbook.CACHE_DIR, playbook.OUT_DIR, os.getcwd())
+        playbook.PLAYBOOKS_DIR = self.temp_dir / "playbooks"
+        playbook.CACHE_DIR = self.temp_dir / "cache"
+        playbook.OUT_DIR = self.temp_dir / "out"
+        playbook.PLAYBOOKS_DIR.mkdir()
+        (playbook.PLAYBOOKS_DIR / "review.md").write_text("Review {{repo}}:\n{{input}}")
+        self.repo = self.temp_dir / "repo"
+        (self.repo / "src").mkdir(parents=True)
+        os.chdir(str(self.repo))
+
+        def git(*args):
+            subprocess.run(["git", "-c", "user.name=t", "-c", "user.email=t@t", *args],
+                           stdout=subprocess.DEVNULL, check=True)
+        git("init", "-q")
+        (self.repo / "src" / "a.py").write_text("a = 1\n")
+        (self.repo / "README").write_text("hello\n")
+        git("add", ".")
+        git("commit", "-q", "-m", "one")
+        git("tag", "v1")
+        (self.repo / "src" / "a.py").write_text("a = 2\n")
+        (self.repo / "README").write_text("hello world\n")
+        git("commit", "-q", "-am", "two")
+        (self.repo / "README").write_text("dirty\n")
+
+    def tearDown(self):
+        """Restore paths and clean up."""
+        playbook.PLAYBOOKS_DIR, playbook.CACHE_DIR, playbook.OUT_DIR, cwd = self.orig
+        os.chdir(cwd)
+        shutil.rmtree(str(self.temp_dir))
+
+    def read(self, rng, **kwargs) -> str:
+        with playbook.git_diff_input(rng, **kwargs) as path:
+            return path.read_text()
+
+    def test_committed_range_is_cached_by_tree(self):
+        """A committed range is diffed once and then served from the cache."""
+        diff = self.read("v1..HEAD")
+        self.assertIn("+a = 2", diff)
+        self.assertIn("+hello world", diff)
+        self.assertNotIn("dirty", diff)
+        cached = list((playbook.CACHE_DIR / "git-diff").iterdir())
+        self.assertEqual(len(cached), 1)
+        cached[0].write_text("from cache")
+        self.assertEqual(self.read("v1..HEAD"), "from cache")
+        self.assertIn("+a = 2", self.read("v1..HEAD", reuse=False))
+
+    def test_paths_and_stat(self):
+        """--git-path limits the diff; --git-stat gives the summary only."""
+        diff = self.read("v1...HEAD", paths=["src"])
+        self.assertIn("src/a.py", diff)
+        self.assertNotIn("README", diff)
+        stat = self.read("v1..HEAD", stat=True)
+        self.assertIn("2 files changed", stat)
+        self.assertNotIn("@@", stat)
+
+    def test_working_tree_diff_is_not_cached(self):
+        """A single revision is compared with the working tree and left uncached."""
+        with playbook.git_diff_input("HEAD") as path:
+            self.assertIn("+dirty", path.read_text())
+        self.assertFalse(path.exists())
+        self.assertEqual(list((playbook.CACHE_DIR / "git-diff").iterdir()), [])
+
+    def test_bad_range(self):
+        """Unknown revisions and option-like ranges raise ValueError."""
+        for rng in ("nope..HEAD", "--output=x", "HEAD..--output=x"):
+            with self.assertRaises(ValueError):
+                self.read(rng)
+
+    def test_run_with_git_diff(self):
+        """`playbook run --git-diff` renders the diff as {{input}}."""
+        import io
+        from contextlib import redirect_stdout
+        args = playbook.parse_run_args(["run", "review", "--git-diff", "v1..HEAD", "--vars", "repo=api",
+                                        "--print-only"])
+        stdout = io.StringIO()
+        with redirect_stdout(stdout):
+            playbook.cmd_run(args)
+        self.assertIn("Review api:\ndiff --git a/README b/README", stdout.getvalue())
+        args.input = "x.diff"
+        with self.assertRaises(ValueError):
+            playbook.cmd_run(args)
+
+class TestRenderCache(unittest.TestCase):
+    """Test rendered-prompt memoization."""
+
+    def setUp(self):
+        """Point output, hooks and the cache at a temporary directory."""
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.orig = (playbook.OUT_DIR, playbook.HOOKS_DIR, playbook.CACHE_DIR)
+        playbook.OUT_DIR = self.temp_dir / "out"
+        playbook.HOOKS_DIR = self.temp_dir / "hooks"
+        playbook.CACHE_DIR = self.temp_dir / "cache"
+        playbook.OUT_DIR.mkdir()
+        playbook.HOOKS_DIR.mkdir()
+        self.cache = playbook.RenderCache()
+
+    def tearDown(self):
+        """Restore paths and clean up."""
+        self.cache.close()
+        playbook.OUT_DIR, playbook.HOOKS_DIR, playbook.CACHE_DIR = self.orig
+        import shutil
+        shutil.rmtree(self.temp_dir)
+
+    def test_hit_skips_render(self):
+        """A repeated job returns the first prompt and output file."""
+        job = playbook.make_job("review_pr", vars_dict={"repo": "r", "time_utc": "12:00:00"})
+        first, first_file = playbook.run_job(job, cache=self.cache)
+        second, second_file = playbook.run_job(job, cache=self.cache)
+        self.assertEqual(second, first)
+        self.assertEqual(second_file, first_file)
+        self.assertEqual(len(list(playbook.OUT_DIR.iterdir())), 1)
+
+    def test_hit_saves_to_content_store(self):
+        """A hit after a flat run still records the prompt in the content store."""
+        job = playbook.make_job("review_pr", vars_dict={"repo": "r", "time_utc": "12:00:00"})
+        first, first_file = playbook.run_job(job, cache=self.cache)
+        store = playbook.ContentStore()
+        second, blob = playbook.run_job(job, cache=self.cache, store=store)
+        self.assertEqual(second, first)
+        self.assertEqual(blob.read_text(encoding="utf-8"), first)
+        self.assertEqual(blob.parent.parent.parent, playbook.OUT_DIR / "objects")
+        records = store.index_path.read_text(encoding="utf-8").splitlines()
+        self.assertEqual(len(records), 1)
+        self.assertEqual(json.loads(records[0])["name"], "review_pr")
+        _, again = playbook.run_job(job, cache=self.cache)
+        self.assertEqual(again, first_file)
+
+    def test_no_hit_with_hooks_time_or_new_date(self):
+        """Hooks, {{time_utc}} and a new {{date}} all force a fresh render."""
+        log = self.temp_dir / "log.txt"
+        (playbook.HOOKS_DIR / "pre.py").write_text(
+            "def hook(vars, out_file):\n    open(%r, 'a').write('pre\\n')\n" % str(log))
+        job = playbook.make_job("review_pr", vars_dict={"repo": "r", "time_utc": "12:00:00"})
+        playbook.run_job(job, cache=self.cache)
+        playbook.run_job(job, cache=self.cache)
+        self.assertEqual(log.read_text(), "pre\npre\n")
+        (playbook.HOOKS_DIR / "pre.py").unlink()
+
+        playbook.run_job(playbook.make_job("review_pr", vars_dict={"repo": "r"}), cache=self.cache)
+        playbook.run_job(playbook.make_job("review_pr", vars_dict={"repo": "r"}), cache=self.cache)
+        self.assertEqual(len(list(playbook.OUT_DIR.iterdir())), 4)
+
+        for date in ("2024-01-01", "2024-01-02"):
+            job = playbook.make_job("review_pr", vars_dict={"repo": "r", "time_utc": "t", "date": date})
+            rendered, _ = playbook.run_job(job, cache=self.cache)
+            self.assertIn(date, rendered)
+
+    def test_key_ignores_unused_vars(self):
+        """Only variables referenced by the template change the key."""
+        template = playbook.Template("{{a}}")
+        key = playbook.render_key(template, "t", None, {"a": "1", "unused": "x"})
+        self.assertEqual(key, playbook.render_key(template, "t", None, {"a": "1"}))
+        self.assertNotEqual(key, playbook.render_key(template, "t", None, {"a": "2"}))
+        self.assertNotEqual(key, playbook.render_key(playbook.Template("{{a}}!"), "t", None, {"a": "1"}))
+
+    def test_eviction_by_entries_and_bytes(self):
+        """Least recently used entries are evicted past either limit."""
+        cache = playbook.RenderCache(self.temp_dir / "small.sqlite", max_entries=2, max_bytes=10)
+        try:
+            cache.put("a", "1111")
+            cache.put("b", "2222")
+            cache.get("a")
+            cache.put("c", "3333")
+            self.assertIsNone(cache.get("b"))
+            self.assertIsNotNone(cache.get("a"))
+            cache.put("d", "444444")
+            self.assertIsNone(cache.get("c"))
+            cache.put("e", "55555")
+            self.assertIsNone(cache.get("a"))
+            self.assertIsNone(cache.get("d"))
+            self.assertEqual(cache.get("e"), ("55555", None))
+            cache.put("huge", "x" * 11)
+            self.assertIsNone(cache.get("huge"))
+        finally:
+            cache.close()
+
+    def test_no_cache_env(self):
+        """PLAYBOOK_NO_CACHE disables the cache."""
+        os.environ[playbook.NO_CACHE_ENV] = "1"
+        try:
+            self.assertIsNone(playbook.open_render_cache())
+        finally:
+            os.environ.pop(playbook.NO_CACHE_ENV)
+        self.assertIsNone(playbook.open_render_cache(disabled=True))
+
 def run_tests():
     """Run all tests."""
     # Discover and run tests